@@ -3,18 +3,43 @@
 # ═══════════════════════════════════════════════════════════════════════════════
 from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from fastapi.routing import APIRoute
+from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
 from starlette.exceptions import HTTPException as StarletteHTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional, List
 from datetime import datetime, timedelta
-from math import radians, sin, cos, sqrt, atan2
+from math import radians, sin, cos, tan, sqrt, atan2, floor, log, pi
 import pytz
 import uuid
 import json
 import os
 import asyncio
+import gzip
+import hashlib
+import hmac
+import struct
+import zlib
+import shutil
+import tempfile
+import time
+import socket
+import threading
+import re
+import bisect
+import heapq
+import urllib.request
+import urllib.error
+from urllib.parse import quote, urlparse
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import contextlib
+import copy
+import itertools
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping
 
 # Türkçe karakter ve emoji desteği için ensure_ascii=False
 class UnicodeJSONResponse(JSONResponse):
@@ -46,157 +71,870 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ═══════════════════════════════════════════════════════════════════════════════
+# 🧵 DURUM MOTORU — tek yazıcı
+# ═══════════════════════════════════════════════════════════════════════════════
+# Senkron (def) endpoint'ler FastAPI'nin thread havuzunda paralel koşardı; aynı
+# anda event loop'taki arka plan görevleri de aynı dict'leri geziyordu. Artık
+# RAM'deki duruma dokunan her iş tek bir thread'de (aktör) sırayla çalışır:
+#   • def endpoint'ler _StateActorRoute ile otomatik olarak aktöre gönderilir,
+#     yanıt da aktör içinde JSON'a çevrilir (okuyan, tutarlı bir anlık görüntü alır)
+#   • arka plan görevleri ve ortak durum dinleyicisi _in_state_actor kullanır
+#   • ağ / disk gibi uzun işler aktör dışında yapılır (async endpoint'ler)
+#   • tek odaya ait uçlar (_room_scoped) aktörü beklemez; thread havuzunda o
+#     odanın RoomState kilidiyle çalışır (bkz. "Oda durumu")
+_state_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="konum-state")
+
+async def _in_state_actor(fn, *args, **kwargs):
+    """fn'i durum aktöründe çalıştır ve sonucunu bekle."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_state_executor, functools.partial(fn, *args, **kwargs))
+
+def _call_and_render(endpoint, args, kwargs):
+    translate = not getattr(endpoint, "_raw_user_ids", False)
+    fields = _endpoint_user_fields(endpoint)
+    if translate:
+        _resolve_user_args(kwargs, fields, getattr(endpoint, "_claims_user_names", False))
+    result = endpoint(*args, **kwargs)
+    if isinstance(result, Response):
+        return result
+    if translate:
+        result = _render_user_ids(result, fields)
+    try:
+        return UnicodeJSONResponse(result)
+    except TypeError:
+        return UnicodeJSONResponse(jsonable_encoder(result))
+
+def _room_from_path(kw: dict) -> str:
+    return kw["room_name"]
+
+def _room_from_body(kw: dict) -> str:
+    data = kw["data"]
+    return data.get("roomName", "Genel") if isinstance(data, dict) else data.roomName
+
+def _room_scoped(room_of=_room_from_path, writes: tuple = ()):
+    """Endpoint yalnızca tek bir odanın durumuna dokunuyor — global aktör yerine
+    o odanın kilidiyle çalıştır. room_of: endpoint argümanlarından oda adı;
+    writes: endpoint'in değiştirdiği RoomState alanları (bkz. _room_written)."""
+    def mark(endpoint):
+        endpoint._room_of = room_of
+        endpoint._room_writes = writes
+        return endpoint
+    return mark
+
+def _raw_user_ids(endpoint):
+    """Endpoint kullanıcı adı ↔ uid çevirisinden muaf (küme içi aktarım,
+    kimlik bilgisiyle giriş gibi değerlerin olduğu gibi kalması gereken uçlar)."""
+    endpoint._raw_user_ids = True
+    return endpoint
+
+def _call_in_room(room_name: str, create: bool, endpoint, args, kwargs):
+    while True:
+        st = room_state(room_name) if create else _peek_room(room_name)
+        if st is None:
+            # Okunacak durum yok; bu sırada oda oluşturulmasın
+            with _room_states_lock:
+                return _call_and_render(endpoint, args, kwargs)
+        with st.lock:
+            if st.dropped:
+                continue   # oda bu arada silindi — yeni nesneyle tekrar dene
+            try:
+                result = _call_and_render(endpoint, args, kwargs)
+                _room_written(room_name, endpoint._room_writes)
+                return result
+            finally:
+                # Olmayan odaya yazma reddedildiyse boş durumu bırakma
+                if create and st.is_empty() and room_name not in rooms and room_name != "Genel":
+                    _drop_room(room_name)
+
+def _from_room(fn, *args):
+    """Oda ucundan global duruma yazım: fn'i aktöre sıraya koy, bekleme."""
+    _state_executor.submit(fn, *args)
+
+def _room_written(room_name: str, fields):
+    """(Oda kilidi altında, aktör dışında) oda alanları değişti: diğer worker'lara
+    yayınla; kalıcı bir alan varsa "room_states" bölümü kirli işaretlenir — oda
+    verisinin tek kayıt yolu. Eklemeyle yayınlanan alanları uç kendisi yayınlar."""
+    _share_room(room_name, set(fields) - _ROOM_APPENDED_FIELDS)
+    if not set(fields).isdisjoint(RoomState.PERSISTENT_FIELDS):
+        _from_room(_mark_critical_dirty, "room_states")
+
+class _StateActorRoute(APIRoute):
+    """Senkron endpoint'i aktörde (veya _room_scoped ise oda kilidiyle thread
+    havuzunda) çalışan bir coroutine ile sarar."""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if not asyncio.iscoroutinefunction(endpoint):
+            sync_endpoint = endpoint
+            room_of = getattr(sync_endpoint, "_room_of", None)
+            create = set(kwargs.get("methods") or ()) != {"GET"}
+
+            if room_of is None:
+                @functools.wraps(sync_endpoint)
+                async def endpoint(*args, **kw):
+                    return await _in_state_actor(_call_and_render, sync_endpoint, args, kw)
+            else:
+                @functools.wraps(sync_endpoint)
+                async def endpoint(*args, **kw):
+                    return await asyncio.to_thread(_call_in_room, room_of(kw), create,
+                                                   sync_endpoint, args, kw)
+        elif not getattr(endpoint, "_raw_user_ids", False):
+            async_endpoint = endpoint
+            fields = _endpoint_user_fields(async_endpoint)
+
+            @functools.wraps(async_endpoint)
+            async def endpoint(*args, **kw):
+                _resolve_user_args(kw, fields)
+                result = await async_endpoint(*args, **kw)
+                return result if isinstance(result, Response) else _render_user_ids(result, fields)
+        super().__init__(path, endpoint, **kwargs)
+
+app.router.route_class = _StateActorRoute
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # 💾 DISK KALICILIĞI — Fly.io volume /data'ya mount edilmişse persist eder
 # ═══════════════════════════════════════════════════════════════════════════════
 
 _DATA_DIR            = "/data" if os.path.isdir("/data") else os.path.dirname(os.path.abspath(__file__))
+# Eski düz JSON dosyaları — yalnızca ilk açılışta snapshot'a taşımak için okunur
 HISTORY_FILE         = os.path.join(_DATA_DIR, "location_history.json")
 ROUTE_LIBRARY_FILE   = os.path.join(_DATA_DIR, "route_library.json")
 ROUTE_WAYPOINTS_FILE = os.path.join(_DATA_DIR, "route_waypoints.json")
 CRITICAL_DATA_FILE   = os.path.join(_DATA_DIR, "critical_data.json")
+# Sürümlü, sıkıştırılmış snapshot dosyaları
+HISTORY_SNAPSHOT         = os.path.join(_DATA_DIR, "location_history.snap")
+ROUTE_LIBRARY_SNAPSHOT   = os.path.join(_DATA_DIR, "route_library.snap")
+ROUTE_WAYPOINTS_SNAPSHOT = os.path.join(_DATA_DIR, "route_waypoints.snap")
+CRITICAL_DATA_SNAPSHOT   = os.path.join(_DATA_DIR, "critical_data.snap")
 _save_pending          = False
-_critical_save_pending = False
+_critical_save_pending = False   # tüm kritik bölümler yeniden serileştirilir
+_critical_dirty: set   = set()   # yalnızca bu kritik bölümler değişti (_mark_critical_dirty)
 
 # Ses/walkie mesajı maksimum boyutu (~2MB base64 ≈ 1.5MB ses)
 MAX_AUDIO_B64 = 2_000_000
 
+# ─── Snapshot kapsayıcısı ─────────────────────────────────────────────────────
+# Dosya düzeni:
+#   MAGIC (8 bayt) | sürüm (u16) | başlık uzunluğu (u32) | başlık JSON | bölümler
+# Başlık her bölüm için {name, codec, size, rawSize, sha256} tutar; bölümler
+# başlıktaki sırayla art arda yazılır. Her bölüm ayrı sıkıştırılır ve ayrı
+# doğrulanır — bozuk bir bölüm diğerlerinin yüklenmesini engellemez.
+SNAPSHOT_MAGIC   = b"KNMSNAP\x00"
+SNAPSHOT_VERSION = 4
+
+try:
+    import zstandard as _zstd
+except ImportError:          # zstd yoksa stdlib gzip ile devam
+    _zstd = None
+
+SNAPSHOT_CODEC = "zstd" if _zstd else "gzip"
+
+def _compress(raw: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return _zstd.ZstdCompressor(level=6).compress(raw)
+    if codec == "gzip":
+        return gzip.compress(raw, compresslevel=6, mtime=0)
+    if codec == "none":
+        return raw
+    raise ValueError(f"Bilinmeyen codec: {codec}")
+
+def _decompress(blob: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if _zstd is None:
+            raise ValueError("zstd bölümü okunamıyor — zstandard kurulu değil")
+        return _zstd.ZstdDecompressor().decompress(blob)
+    if codec == "gzip":
+        return gzip.decompress(blob)
+    if codec == "none":
+        return blob
+    raise ValueError(f"Bilinmeyen codec: {codec}")
+
+def _dump_section(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _encode_section(value, codec: str = None) -> tuple:
+    """Bir bölümü (header_entry_without_name, blob) olarak kodla.
+    bytes verilirse önceden serileştirilmiş JSON kabul edilir."""
+    codec = codec or SNAPSHOT_CODEC
+    raw = value if isinstance(value, bytes) else _dump_section(value)
+    blob = _compress(raw, codec)
+    return {"codec": codec, "size": len(blob), "rawSize": len(raw),
+            "sha256": hashlib.sha256(raw).hexdigest()}, blob
+
+def _write_snapshot(path: str, sections: dict):
+    """sections: {ad: json-uyumlu değer}. Geçici dosyaya yazıp atomik olarak değiştirir."""
+    entries, blobs = [], []
+    for name, value in sections.items():
+        entry, blob = _encode_section(value)
+        entries.append({"name": name, **entry})
+        blobs.append(blob)
+    header = json.dumps({"version": SNAPSHOT_VERSION, "createdAt": get_local_time(),
+                         "sections": entries}, ensure_ascii=False).encode("utf-8")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Her yazım kendi geçici dosyasına: periyodik kayıt, kapanış ve anlık
+    # yazımlar aynı anda çalışsa da birbirinin dosyasını bozmaz
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                               prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack("<HI", SNAPSHOT_VERSION, len(header)))
+            f.write(header)
+            for blob in blobs:
+                f.write(blob)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def _read_snapshot(path: str) -> tuple:
+    """(sürüm, {ad: değer}) döndürür. Checksum'ı tutmayan bölümler atlanır."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(SNAPSHOT_MAGIC):
+        raise ValueError("Snapshot imzası geçersiz")
+    pos = len(SNAPSHOT_MAGIC)
+    version, header_len = struct.unpack_from("<HI", data, pos)
+    pos += struct.calcsize("<HI")
+    header = json.loads(data[pos:pos + header_len].decode("utf-8"))
+    pos += header_len
+    sections = {}
+    for entry in header.get("sections", []):
+        blob = data[pos:pos + entry["size"]]
+        pos += entry["size"]
+        try:
+            raw = _decompress(blob, entry["codec"])
+            if hashlib.sha256(raw).hexdigest() != entry["sha256"]:
+                raise ValueError("checksum uyuşmuyor")
+            sections[entry["name"]] = json.loads(raw.decode("utf-8"))
+        except Exception as e:
+            print(f"❌ Snapshot bölümü atlandı ({os.path.basename(path)}/{entry['name']}): {e}")
+    return version, sections
+
+def _bench_snapshots(users: int = 200, points: int = 5000, rounds: int = 3):
+    """Ölçüm: `python server.py bench-snapshots`. 90 güne yayılmış sentetik
+    konum geçmişini (users × points) düz JSON ve her snapshot codec'iyle geçici
+    bir dizine yazıp okur; en iyi süreleri ve dosya boyutunu yazar."""
+    import random
+    import tempfile
+    global SNAPSHOT_CODEC
+    rnd = random.Random(1)
+    start = datetime(2026, 1, 1)
+    step = timedelta(days=90) / points
+    history = {}
+    for u in range(users):
+        lat, lng = 41.0 + rnd.random(), 29.0 + rnd.random()
+        track = history[f"kullanıcı_{u}"] = []
+        for i in range(points):
+            lat += rnd.uniform(-1e-4, 1e-4)
+            lng += rnd.uniform(-1e-4, 1e-4)
+            track.append({"lat": lat, "lng": lng, "speed": round(rnd.uniform(0, 15), 2),
+                          "timestamp": (start + i * step).strftime("%Y-%m-%d %H:%M:%S")})
+
+    def json_save(path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(history, f, ensure_ascii=False)
+
+    def json_load(path):
+        with open(path, "r", encoding="utf-8") as f:
+            json.load(f)
+
+    def snap_save(path):
+        _write_snapshot(path, {"location_history": history})
+
+    def snap_load(path):
+        _read_snapshot(path)
+
+    saved = SNAPSHOT_CODEC
+    codecs = [("json", json_save, json_load, "h.json")]
+    codecs += [(c, snap_save, snap_load, f"h.{c}.snap") for c in ("zstd", "gzip")
+               if c != "zstd" or _zstd is not None]
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for label, save, load, fname in codecs:
+                SNAPSHOT_CODEC = saved if label == "json" else label
+                path = os.path.join(tmp, fname)
+                t_save = min(_timed(save, path) for _ in range(rounds))
+                t_load = min(_timed(load, path) for _ in range(rounds))
+                print(f"{label:>5}  kayıt {t_save:6.2f} sn  okuma {t_load:6.2f} sn  "
+                      f"{os.path.getsize(path) / 1e6:7.1f} MB")
+    finally:
+        SNAPSHOT_CODEC = saved
+
+# Sürüm → bir üst sürüme yükselten fonksiyon. Sürüm 0 = eski düz JSON dosyaları;
+# bunlar _load_store içinde bölümlere çevrildiği için 0 → 1 dönüşümü kimliktir.
+# Şema değiştiğinde SNAPSHOT_VERSION artırılır ve buraya bir adım eklenir.
+# Sürüm 1'de oda verisi global anahtarlı ayrı bölümlerdeydi (pin_id, "oda_kullanıcı")
+_V1_ROOM_SECTIONS = ("room_messages", "pins", "scores", "pin_collection_history",
+                     "room_geofences", "transport_stops")
+
+def _split_room_key(key: str, room_names: list) -> tuple:
+    """"oda_kullanıcı" → (oda, kullanıcı). Oda adında "_" olabileceğinden
+    bilinen en uzun oda adı önce denenir."""
+    for room in room_names:
+        if key.startswith(f"{room}_"):
+            return room, key[len(room) + 1:]
+    room, _, uid = key.partition("_")
+    return room, uid
+
+def _migrate_v1_room_states(sections: dict) -> dict:
+    if not any(name in sections for name in _V1_ROOM_SECTIONS):
+        return sections
+    states: dict = {}
+    pins_v1 = sections.pop("pins", {})
+    room_names = set(sections.get("rooms", {})) | set(sections.get("room_messages", {}))
+    room_names |= {p.get("roomName", "Genel") for p in pins_v1.values()} | {"Genel"}
+    room_names = sorted(room_names, key=len, reverse=True)
+    for room, msgs in sections.pop("room_messages", {}).items():
+        states.setdefault(room, {})["messages"] = msgs
+    for pin_id, pin in pins_v1.items():
+        states.setdefault(pin.get("roomName", "Genel"), {}).setdefault("pins", {})[pin_id] = pin
+    for section, field in (("scores", "scores"), ("pin_collection_history", "collection_history")):
+        for key, value in sections.pop(section, {}).items():
+            room, uid = _split_room_key(key, room_names)
+            states.setdefault(room, {}).setdefault(field, {})[uid] = value
+    for room, gfs in sections.pop("room_geofences", {}).items():
+        states.setdefault(room, {})["geofences"] = gfs
+    for room, stops in sections.pop("transport_stops", {}).items():
+        states.setdefault(room, {})["transport_stops"] = stops
+    sections["room_states"] = states
+    return sections
+
+# Sürüm 2'de 1-1 konuşma anahtarı "a_b" idi — "_" içeren isimlerde belirsiz
+# ("a_b"+"c" ile "a"+"b_c" aynı listeye düşüyordu). Her mesaj kendi from/to
+# çiftine göre yeniden gruplanır, mesajlara seq numarası verilir.
+def _migrate_v2_conversations(sections: dict) -> dict:
+    if "messages" not in sections:
+        return sections
+    convs: dict = {}
+    for conv in sections["messages"].values():
+        for msg in conv:
+            convs.setdefault(get_conv_key(msg["from"], msg["to"]), []).append(msg)
+    for conv in convs.values():
+        conv.sort(key=lambda m: m.get("timestamp", ""))
+        for i, msg in enumerate(conv):
+            msg["seq"] = i + 1
+    sections["messages"] = convs
+    return sections
+
+# Sürüm 3'te konum geçmişi ve arşiv günleri nokta sözlüğü listesiydi; artık
+# kompakt iz biçiminde (encode_track) saklanır.
+def _migrate_v3_tracks(sections: dict) -> dict:
+    if "location_history" in sections:
+        sections["location_history"] = {uid: encode_track(pts)
+                                        for uid, pts in sections["location_history"].items()}
+    if "points" in sections:
+        sections["track"] = encode_track(sections.pop("points"))
+    return sections
+
+_SNAPSHOT_MIGRATIONS: dict = {
+    0: lambda sections: sections,
+    1: _migrate_v1_room_states,
+    2: _migrate_v2_conversations,
+    3: _migrate_v3_tracks,
+}
+
+def _migrate_sections(version: int, sections: dict) -> dict:
+    while version < SNAPSHOT_VERSION:
+        sections = _SNAPSHOT_MIGRATIONS[version](sections)
+        version += 1
+    return sections
+
+def _load_store(snapshot_path: str, legacy_path: str, legacy_to_sections) -> Optional[dict]:
+    """Snapshot'ı oku; yoksa eski JSON dosyasını bölümlere çevirip taşı.
+    İkisi de yoksa None döner."""
+    if os.path.exists(snapshot_path):
+        version, sections = _read_snapshot(snapshot_path)
+        if version > SNAPSHOT_VERSION:
+            raise ValueError(f"Snapshot sürümü ({version}) bu sunucudan yeni")
+        return _migrate_sections(version, sections)
+    if os.path.exists(legacy_path):
+        with open(legacy_path, 'r', encoding='utf-8') as f:
+            sections = _migrate_sections(0, legacy_to_sections(json.load(f)))
+        _write_snapshot(snapshot_path, sections)
+        os.replace(legacy_path, f"{legacy_path}.migrated")
+        print(f"🔁 {os.path.basename(legacy_path)} → {os.path.basename(snapshot_path)} taşındı")
+        return sections
+    return None
+
+def _history_sections() -> dict:
+    return {"location_history": _dump_section(
+                {uid: encode_track(pts) for uid, pts in location_history.items()}),
+            "trip_stats": _dump_section(trip_stats)}
+
 def _flush_history():
     """location_history'yi diske yaz."""
     try:
-        os.makedirs(_DATA_DIR, exist_ok=True)
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(location_history, f, ensure_ascii=False)
+        _write_snapshot(HISTORY_SNAPSHOT, _history_sections())
     except Exception as e:
         print(f"❌ History kayıt hatası: {e}")
 
+def _sessions_section() -> dict:
+    # Super admin sessionlarını serialize et (datetime → str)
+    sessions_str = {}
+    for tok, sess in _super_admin_sessions.items():
+        try:
+            sessions_str[tok] = _session_to_json(sess)
+        except Exception:
+            pass
+    return sessions_str
+
+# Bölüm adı → değeri üreten fonksiyon (dosyadaki sıra da budur)
+_CRITICAL_SECTIONS = {
+    "rooms":                 lambda: rooms,
+    "messages":              lambda: messages,
+    "room_states":           lambda: {name: st.to_json() for name, st in list(_room_states.items())},
+    "fcm_tokens":            lambda: fcm_tokens,
+    "visibility_settings":   lambda: visibility_settings,
+    "banned_users":          lambda: banned_users,
+    "banned_devices":        lambda: banned_devices,
+    "muted_users":           lambda: muted_users,
+    "user_geofences":        lambda: user_geofences,
+    "permission_requests":   lambda: permission_requests,
+    "friend_requests":       lambda: friend_requests,
+    "friends_map":           lambda: {uid: sorted(fs) for uid, fs in friends_map.items()},
+    "user_names":            lambda: user_display_names,
+    "super_admin_sessions":  _sessions_section,
+}
+_critical_section_cache: dict = {}   # bölüm adı → son serileştirilmiş JSON
+
+def _mark_critical_dirty(*sections: str):
+    """Yalnızca adı verilen kritik bölümler değişti; bir sonraki kayıtta diğerleri
+    yeniden serileştirilmeden önbellekten yazılır."""
+    _critical_dirty.update(sections)
+
+def _critical_sections(only=None) -> dict:
+    """Restart'ta kaybolmaması gereken kritik veriler — serileştirilmiş bölümler.
+    only verilirse yalnızca o bölümler yeniden serileştirilir (önbellek doluysa)."""
+    if only is None or len(_critical_section_cache) < len(_CRITICAL_SECTIONS):
+        only = _CRITICAL_SECTIONS
+    for name in only:
+        _critical_section_cache[name] = _dump_section(_CRITICAL_SECTIONS[name]())
+    return {name: _critical_section_cache[name] for name in _CRITICAL_SECTIONS}
+
 def _flush_critical_data():
     """Restart'ta kaybolmaması gereken kritik verileri diske yaz."""
     try:
-        os.makedirs(_DATA_DIR, exist_ok=True)
-        # Super admin sessionlarını serialize et (datetime → str)
-        sessions_str = {}
-        for tok, sess in _super_admin_sessions.items():
-            try:
-                exp = sess["expiresAt"]
-                sessions_str[tok] = {
-                    "userId":    sess["userId"],
-                    "expiresAt": exp.strftime("%Y-%m-%d %H:%M:%S") if hasattr(exp, "strftime") else str(exp),
-                    "deviceId":  sess.get("deviceId", ""),
-                }
-            except Exception:
-                pass
-        data = {
-            "rooms":                 rooms,
-            "messages":              messages,
-            "room_messages":         room_messages,
-            "pins":                  pins,
-            "scores":                scores,
-            "pin_collection_history":pin_collection_history,
-            "fcm_tokens":            fcm_tokens,
-            "visibility_settings":   visibility_settings,
-            "banned_users":          banned_users,
-            "banned_devices":        banned_devices,
-            "muted_users":           muted_users,
-            "user_geofences":        user_geofences,
-            "room_geofences":        room_geofences,
-            "transport_stops":       transport_stops,
-            "permission_requests":   permission_requests,
-            "friend_requests":       friend_requests,
-            "friends_map":           friends_map,
-            "super_admin_sessions":  sessions_str,
-        }
-        with open(CRITICAL_DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False)
+        _write_snapshot(CRITICAL_DATA_SNAPSHOT, _critical_sections())
     except Exception as e:
         print(f"❌ Kritik veri kayıt hatası: {e}")
 
+def _take_pending_snapshots() -> list:
+    """(Aktörde) bekleyen kayıtları serileştir ve bayrakları indir.
+    Sıkıştırma ve disk yazımı aktör dışında yapılır."""
+    global _save_pending, _critical_save_pending
+    pending = []
+    if _save_pending:
+        pending.append(("History", HISTORY_SNAPSHOT, _history_sections()))
+        _save_pending = False
+    if _critical_save_pending:
+        pending.append(("Kritik veri", CRITICAL_DATA_SNAPSHOT, _critical_sections()))
+        _critical_save_pending = False
+        _critical_dirty.clear()
+    elif _critical_dirty:
+        pending.append(("Kritik veri", CRITICAL_DATA_SNAPSHOT, _critical_sections(set(_critical_dirty))))
+        _critical_dirty.clear()
+    return pending
+
 async def _periodic_save():
     """Her 30 saniyede bir bekleyen kayıtları diske yaz."""
-    global _save_pending, _critical_save_pending
     while True:
         await asyncio.sleep(30)
-        if _save_pending:
-            _flush_history()
-            _save_pending = False
-        if _critical_save_pending:
-            _flush_critical_data()
-            _critical_save_pending = False
+        if not _is_persistence_leader():
+            continue
+        for label, path, sections in await _in_state_actor(_take_pending_snapshots):
+            try:
+                await asyncio.to_thread(_write_snapshot, path, sections)
+            except Exception as e:
+                print(f"❌ {label} kayıt hatası: {e}")
+        if time.monotonic() - _last_archive_run >= ARCHIVE_INTERVAL_SECS:
+            await _archive_cold_history()
 
 ROOM_AUTO_CLOSE_SECS = 3600  # 1 saat
 
-async def _auto_close_rooms():
-    """Boş kalan odaları 1 saat sonra otomatik siler (her 5 dakikada bir kontrol)."""
+def _close_idle_rooms():
+    """Boş kalan odaları 1 saat sonra otomatik siler."""
     global _critical_save_pending
+    now = datetime.now(DEFAULT_TIMEZONE)
+    to_delete = []
+    for room_name, room in list(rooms.items()):
+        online_count = sum(
+            1 for u in locations.values()
+            if u.get("roomName") == room_name and is_user_online(u.get("lastSeen", ""))
+        )
+        if online_count > 0:
+            # Aktif üye var → lastActivity güncelle
+            rooms[room_name]["lastActivity"] = now.strftime("%Y-%m-%d %H:%M:%S")
+            _share("rooms", room_name)
+            continue
+        # Üye yok → son aktivite zamanını kontrol et
+        last_str = room.get("lastActivity") or room.get("createdAt", "")
+        if not last_str:
+            continue
+        try:
+            last_dt = DEFAULT_TIMEZONE.localize(
+                datetime.strptime(last_str, "%Y-%m-%d %H:%M:%S"))
+            if (now - last_dt).total_seconds() >= ROOM_AUTO_CLOSE_SECS:
+                to_delete.append(room_name)
+        except Exception:
+            pass
+    for room_name in to_delete:
+        rooms.pop(room_name, None)
+        _share("rooms", room_name)
+        for uid in locations:
+            if locations[uid].get("roomName") == room_name:
+                locations[uid]["roomName"] = "Genel"
+                _share("locations", uid)
+                _place_location(uid)
+        _drop_room(room_name)
+        _drop_room_permission_requests(room_name)
+        _heat_drop(room_name)
+        _share_room(room_name, _ROOM_SHARED_FIELDS)
+        print(f"🗑️ '{room_name}' odası 1 saattir boş — otomatik silindi")
+    if to_delete:
+        _critical_save_pending = True
+
+async def _auto_close_rooms():
+    """_close_idle_rooms'u her 5 dakikada bir aktörde çalıştır."""
     while True:
         await asyncio.sleep(300)
-        now = datetime.now(DEFAULT_TIMEZONE)
-        to_delete = []
-        for room_name, room in list(rooms.items()):
-            online_count = sum(
-                1 for u in locations.values()
-                if u.get("roomName") == room_name and is_user_online(u.get("lastSeen", ""))
-            )
-            if online_count > 0:
-                # Aktif üye var → lastActivity güncelle
-                rooms[room_name]["lastActivity"] = now.strftime("%Y-%m-%d %H:%M:%S")
-                continue
-            # Üye yok → son aktivite zamanını kontrol et
-            last_str = room.get("lastActivity") or room.get("createdAt", "")
-            if not last_str:
-                continue
-            try:
-                last_dt = DEFAULT_TIMEZONE.localize(
-                    datetime.strptime(last_str, "%Y-%m-%d %H:%M:%S"))
-                if (now - last_dt).total_seconds() >= ROOM_AUTO_CLOSE_SECS:
-                    to_delete.append(room_name)
-            except Exception:
-                pass
-        for room_name in to_delete:
-            rooms.pop(room_name, None)
-            for uid in locations:
-                if locations[uid].get("roomName") == room_name:
-                    locations[uid]["roomName"] = "Genel"
-            for pin_id in list(pins.keys()):
-                if pins[pin_id].get("roomName") == room_name:
-                    del pins[pin_id]
-            for key in list(scores.keys()):
-                if key.startswith(f"{room_name}_"):
-                    del scores[key]
-            room_messages.pop(room_name, None)
-            room_walkie_queue.pop(room_name, None)
-            print(f"🗑️ '{room_name}' odası 1 saattir boş — otomatik silindi")
-        if to_delete:
-            _critical_save_pending = True
+        if _is_persistence_leader():
+            await _in_state_actor(_close_idle_rooms)
 
 def _flush_route_library():
     try:
-        os.makedirs(_DATA_DIR, exist_ok=True)
-        with open(ROUTE_LIBRARY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(route_library, f, ensure_ascii=False)
+        _write_snapshot(ROUTE_LIBRARY_SNAPSHOT, {"route_library": route_library})
     except Exception as e:
         print(f"❌ Rota kütüphanesi kayıt hatası: {e}")
 
 def _flush_route_waypoints():
     try:
-        os.makedirs(_DATA_DIR, exist_ok=True)
-        with open(ROUTE_WAYPOINTS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(room_route_waypoints, f, ensure_ascii=False)
+        _write_snapshot(ROUTE_WAYPOINTS_SNAPSHOT, {"room_route_waypoints": room_route_waypoints})
     except Exception as e:
         print(f"❌ POI noktaları kayıt hatası: {e}")
 
+# ─── Kompakt iz biçimi ────────────────────────────────────────────────────────
+# Geçmiş noktaları diskte ve istenirse API'de nokta başına sözlük yerine üç
+# Google polyline dizisi olarak taşınır: koordinatlar (sabit noktalı, delta),
+# başlangıca göre saniye ve hız (0.1 m/s). "coords" dizisi standart polyline
+# çözücülerle (precision=5) doğrudan okunabilir.
+TRACK_PRECISION_STORE = 6   # ~0.1 m — diskte kayıpsıza yakın
+TRACK_PRECISION_API   = 5   # ~1 m — Google polyline varsayılanı
+_TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def _polyline_encode(rows, factor: float) -> str:
+    """Satırların her sütunu ayrı delta kodlanır, satır satır art arda yazılır."""
+    out, prev = [], None
+    for row in rows:
+        if prev is None:
+            prev = [0] * len(row)
+        for i, value in enumerate(row):
+            n = int(round(value * factor))
+            delta, prev[i] = n - prev[i], n
+            delta = ~(delta << 1) if delta < 0 else delta << 1
+            while delta >= 0x20:
+                out.append(chr((0x20 | (delta & 0x1f)) + 63))
+                delta >>= 5
+            out.append(chr(delta + 63))
+    return "".join(out)
+
+def _polyline_decode(text: str, columns: int, factor: float) -> list:
+    values, prev, i = [], [0] * columns, 0
+    row = []
+    while i < len(text):
+        shift = result = 0
+        while True:
+            b = ord(text[i]) - 63
+            i += 1
+            result |= (b & 0x1f) << shift
+            shift += 5
+            if b < 0x20:
+                break
+        col = len(row)
+        prev[col] += ~(result >> 1) if result & 1 else result >> 1
+        row.append(prev[col] / factor)
+        if len(row) == columns:
+            values.append(tuple(row))
+            row = []
+    return values
+
+def encode_track(points: list, precision: int = TRACK_PRECISION_STORE) -> dict:
+    """[{lat, lng, timestamp, speed}] → kompakt iz."""
+    track = {"encoding": "polyline", "precision": precision, "count": len(points),
+             "start": points[0]["timestamp"] if points else ""}
+    if points:
+        t0 = datetime.strptime(track["start"], _TS_FORMAT)
+        track["coords"] = _polyline_encode(((p["lat"], p["lng"]) for p in points), 10 ** precision)
+        track["times"] = _polyline_encode(
+            (((datetime.strptime(p["timestamp"], _TS_FORMAT) - t0).total_seconds(),) for p in points), 1)
+        track["speeds"] = _polyline_encode(((p.get("speed", 0) or 0,) for p in points), 10)
+    return track
+
+def decode_track(track: dict) -> list:
+    if not track.get("count"):
+        return []
+    factor = 10 ** track["precision"]
+    t0 = datetime.strptime(track["start"], _TS_FORMAT)
+    coords = _polyline_decode(track["coords"], 2, factor)
+    times = _polyline_decode(track["times"], 1, 1)
+    speeds = _polyline_decode(track["speeds"], 1, 10)
+    return [{"lat": lat, "lng": lng,
+             "timestamp": (t0 + timedelta(seconds=t)).strftime(_TS_FORMAT), "speed": sp}
+            for (lat, lng), (t,), (sp,) in zip(coords, times, speeds)]
+
+def _encode_waypoints(waypoints: list) -> Optional[str]:
+    """Yalnızca koordinattan oluşan waypoint listesini polyline'a çevir; isim,
+    ikon gibi ek alan taşıyan listeler için None (olduğu gibi gönderilir)."""
+    coords = []
+    for wp in waypoints or ():
+        if isinstance(wp, dict) and wp.keys() == {"lat", "lng"}:
+            coords.append((wp["lat"], wp["lng"]))
+        elif isinstance(wp, (list, tuple)) and len(wp) == 2:
+            coords.append((wp[0], wp[1]))
+        else:
+            return None
+    return _polyline_encode(coords, 10 ** TRACK_PRECISION_API)
+
+# ─── Konum geçmişi: sıcak pencere + soğuk arşiv ──────────────────────────────
+# Son HOT_HISTORY_DAYS gün RAM'de (location_history) tutulur. Daha eski noktalar
+# kullanıcı/gün başına sıkıştırılmış snapshot dosyalarına taşınır:
+#   history_archive/<quote(userId)>/<YYYY-MM-DD>.snap
+# get_location_history month/year/all istendiğinde bu dosyalar okunur.
+# Arşiv dosyalarına yalnızca _archive_executor'da (tek thread, sırayla) dokunulur;
+# aktör yalnızca RAM'deki listeyi ayırır / değiştirir.
+HOT_HISTORY_DAYS       = int(os.getenv("HOT_HISTORY_DAYS", "7"))
+HISTORY_ARCHIVE_DIR    = os.path.join(_DATA_DIR, "history_archive")
+ARCHIVE_INTERVAL_SECS  = 3600
+_last_archive_run      = 0.0
+_archive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="konum-archive")
+
+async def _in_archive(fn, *args):
+    """fn'i arşiv thread'inde çalıştır ve sonucunu bekle (aktör beklemez)."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_archive_executor, functools.partial(fn, *args))
+
+def _archive_user_dir(user_id: str) -> str:
+    return os.path.join(HISTORY_ARCHIVE_DIR, quote(user_id, safe=""))
+
+def _hot_cutoff_date() -> str:
+    return (datetime.now(DEFAULT_TIMEZONE) - timedelta(days=HOT_HISTORY_DAYS)).strftime("%Y-%m-%d")
+
+def _read_archive_day(path: str) -> list:
+    try:
+        version, sections = _read_snapshot(path)
+        return decode_track(_migrate_sections(version, sections).get("track", {}))
+    except Exception as e:
+        print(f"❌ Arşiv okuma hatası ({path}): {e}")
+        return []
+
+def _append_archive_day(user_id: str, day: str, points: list):
+    path = os.path.join(_archive_user_dir(user_id), f"{day}.snap")
+    if os.path.exists(path):
+        points = _read_archive_day(path) + points
+        points.sort(key=lambda p: p["timestamp"])
+    _write_snapshot(path, {"track": encode_track(points)})
+
+async def _archive_cold_history():
+    """Sıcak pencereden taşan noktaları arşive al, MAX_HISTORY_DAYS'i aşan günleri sil.
+    Üç adım: aktörde soğuk noktaları seç → arşiv thread'inde diske yaz →
+    aktörde yazılanları RAM'den düş. Yazım başarısız olursa RAM'de kalırlar."""
+    global _last_archive_run
+    _last_archive_run = time.monotonic()
+    retention_cutoff = (datetime.now(DEFAULT_TIMEZONE)
+                        - timedelta(days=MAX_HISTORY_DAYS)).strftime("%Y-%m-%d")
+    cold = await _in_state_actor(_collect_cold_history, retention_cutoff)
+    written = await _in_archive(_write_cold_history, cold, retention_cutoff)
+    await _in_state_actor(_drop_archived_history, written)
+
+def _collect_cold_history(retention_cutoff: str) -> dict:
+    """(Aktörde) uid → {gün: [nokta, ...]} — sıcak pencereden taşan noktalar."""
+    _trim_trip_stats(retention_cutoff)
+    hot_cutoff = _hot_cutoff_date()
+    cold = {}
+    for uid, history in location_history.items():
+        # "%Y-%m-%d %H:%M:%S" sözlük sırasıyla da kronolojik → soğuklar baştadır
+        if not history or history[0]["timestamp"][:10] >= hot_cutoff:
+            continue
+        by_day = cold[uid] = {}
+        for p in history:
+            if p["timestamp"][:10] >= hot_cutoff:
+                break
+            by_day.setdefault(p["timestamp"][:10], []).append(p)
+    return cold
+
+def _write_cold_history(cold: dict, retention_cutoff: str) -> dict:
+    """(Arşiv thread'inde) günleri diske ekle, süresi dolan günleri sil.
+    Dönen: uid → diske yazılan son noktanın zamanı."""
+    written = {}
+    for uid, by_day in cold.items():
+        try:
+            for day in sorted(by_day):
+                _append_archive_day(uid, day, by_day[day])
+                # Yarıda hata olursa yalnızca yazılan günler RAM'den düşer
+                written[uid] = by_day[day][-1]["timestamp"]
+        except Exception as e:
+            print(f"❌ Geçmiş arşivleme hatası ({uid}): {e}")
+    try:
+        if os.path.isdir(HISTORY_ARCHIVE_DIR):
+            for user_dir in os.listdir(HISTORY_ARCHIVE_DIR):
+                full = os.path.join(HISTORY_ARCHIVE_DIR, user_dir)
+                for fname in os.listdir(full):
+                    if fname[:10] < retention_cutoff:
+                        os.remove(os.path.join(full, fname))
+                if not os.listdir(full):
+                    os.rmdir(full)
+    except Exception as e:
+        print(f"❌ Arşiv temizleme hatası: {e}")
+    return written
+
+def _drop_archived_history(written: dict):
+    """(Aktörde) arşive yazılan baştaki noktaları sıcak geçmişten çıkar. Bu arada
+    liste temizlendiyse / kısaldıysa yalnızca hâlâ baştaki yazılmış noktalar düşer."""
+    global _save_pending
+    moved = 0
+    heat_rooms = set()
+    for uid, last_ts in written.items():
+        history = location_history.get(uid)
+        if not history:
+            continue
+        n = bisect.bisect_right(history, last_ts, key=lambda p: p["timestamp"])
+        if n:
+            location_history[uid] = history[n:]
+            _share("location_history", uid)
+            heat_rooms.add(locations.get(uid, {}).get("roomName"))
+            moved += n
+    for room in heat_rooms - {None}:
+        _heat_drop(room)
+    if moved:
+        _save_pending = True
+        print(f"🧊 {moved} geçmiş noktası arşive taşındı")
+
+def _archived_history(user_id: str, since_day: str) -> list:
+    """since_day (dahil) ve sonrasındaki arşiv günlerini kronolojik sırayla döndür."""
+    user_dir = _archive_user_dir(user_id)
+    if not os.path.isdir(user_dir):
+        return []
+    result = []
+    for fname in sorted(os.listdir(user_dir)):
+        if fname.endswith(".snap") and fname[:10] >= since_day:
+            result.extend(_read_archive_day(os.path.join(user_dir, fname)))
+    return result
+
+def _drop_archive(user_id: Optional[str] = None):
+    """(Arşiv thread'inde) kullanıcının — user_id yoksa herkesin — arşivini sil."""
+    path = _archive_user_dir(user_id) if user_id is not None else HISTORY_ARCHIVE_DIR
+    shutil.rmtree(path, ignore_errors=True)
+
+# ─── Günlük özet ve yolculuklar ──────────────────────────────────────────────
+# Geçmişe eklenen her nokta trip_stats'a bir kez katlanır:
+#   trip_stats[uid] = {"last": {lat, lng, timestamp, n},
+#                      "days": {"YYYY-MM-DD": {distance, movingSeconds, maxSpeed,
+#                                              points, trips: [...]}}}
+# "last" hem önceki nokta hem de imleçtir; geçmiş arşive taşınsa ya da başka
+# worker'dan eklense de yalnızca ondan yeni noktalar işlenir. İki nokta arası
+# TRIP_GAP_SECS'i aşarsa (hareketsizlik) yeni yolculuk başlar ve bu süre
+# hareket süresine sayılmaz. /get_trip_stats gün sayısıyla orantılı çalışır.
+trip_stats: dict = {}
+
+def _new_trip(p: dict) -> dict:
+    return {"start": p["timestamp"], "end": p["timestamp"], "distance": 0.0,
+            "movingSeconds": 0, "from": [p["lat"], p["lng"]],
+            "to": [p["lat"], p["lng"]], "points": 1}
+
+def _fold_trip_point(st: dict, p: dict):
+    prev = st["last"]
+    same = prev["n"] + 1 if prev and prev["timestamp"] == p["timestamp"] else 1
+    st["last"] = {"lat": p["lat"], "lng": p["lng"], "timestamp": p["timestamp"], "n": same}
+    day = st["days"].setdefault(p["timestamp"][:10], {
+        "distance": 0.0, "movingSeconds": 0, "maxSpeed": 0,
+        "points": 0, "trips": []})
+    day["points"] += 1
+    day["maxSpeed"] = max(day["maxSpeed"], p.get("speed", 0) or 0)
+    gap = None
+    if prev is not None:
+        try:
+            gap = (datetime.strptime(p["timestamp"], _TS_FORMAT)
+                   - datetime.strptime(prev["timestamp"], _TS_FORMAT)).total_seconds()
+        except ValueError:
+            pass
+    if gap is None or gap < 0 or gap > TRIP_GAP_SECS:
+        day["trips"].append(_new_trip(p))
+        return
+    dist = haversine(prev["lat"], prev["lng"], p["lat"], p["lng"])
+    if not day["trips"]:
+        # Gece yarısını geçen yolculuk: yeni günde önceki noktadan devam et
+        day["trips"].append(_new_trip(prev))
+    trip = day["trips"][-1]
+    trip["end"] = p["timestamp"]
+    trip["to"] = [p["lat"], p["lng"]]
+    trip["distance"] += dist
+    trip["movingSeconds"] += int(gap)
+    trip["points"] += 1
+    day["distance"] += dist
+    day["movingSeconds"] += int(gap)
+
+def _fold_new_history(user_id: Optional[str] = None, points: Optional[list] = None,
+                      room: Optional[str] = None):
+    """location_history'de imleçten yeni noktaları trip_stats'a katla.
+    user_id None ise tüm kullanıcılar; ortak durumun değişim kancası da budur.
+    room: noktaların ısı haritası odası (verilmezse kullanıcının kayıtlı odası)."""
+    if user_id is None:
+        for uid in list(location_history.keys()):
+            _fold_new_history(uid)
+        return
+    if points is None:
+        points = location_history.get(user_id) or []
+    st = trip_stats.setdefault(user_id, {"last": None, "days": {}})
+    cursor = st["last"]["timestamp"] if st["last"] else ""
+    i = len(points)
+    while i > 0 and points[i - 1]["timestamp"] > cursor:
+        i -= 1
+    # Aynı saniyeye düşen noktalar: imleçteki "n" kadarı zaten katlandı
+    j = i
+    while j > 0 and points[j - 1]["timestamp"] == cursor:
+        j -= 1
+    if st["last"] and i - j > st["last"]["n"]:
+        i = j + st["last"]["n"]
+    if room is None:
+        room = locations.get(user_id, {}).get("roomName")
+    for p in points[i:]:
+        _fold_trip_point(st, p)
+        if room:
+            _heat_add(room, p["lat"], p["lng"])
+
+def _trim_trip_stats(retention_cutoff: str):
+    for st in trip_stats.values():
+        for day in [d for d in st["days"] if d < retention_cutoff]:
+            del st["days"][day]
+
+def _rebuild_trip_stats():
+    """trip_stats bölümü olmayan eski snapshot'lar için tek seferlik doldurma."""
+    since = (datetime.now(DEFAULT_TIMEZONE)
+             - timedelta(days=MAX_HISTORY_DAYS)).strftime("%Y-%m-%d")
+    for uid in list(location_history.keys()):
+        _fold_new_history(uid, _archived_history(uid, since))
+        _fold_new_history(uid)
+
 @app.on_event("startup")
 async def startup_event():
     global location_history, route_library, room_route_waypoints
-    global rooms, messages, room_messages, pins, scores, pin_collection_history
+    global rooms, messages
     global fcm_tokens, visibility_settings, banned_users, banned_devices, muted_users
-    global user_geofences, room_geofences, transport_stops, permission_requests
+    global user_geofences, permission_requests
     global friend_requests, friends_map
     try:
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                loaded = json.load(f)
-                location_history.update(loaded)
+        d = _load_store(HISTORY_SNAPSHOT, HISTORY_FILE,
+                        lambda legacy: {"location_history": legacy})
+        if d is not None:
+            location_history.update({uid: decode_track(track)
+                                     for uid, track in d.get("location_history", {}).items()})
+            if "trip_stats" in d:
+                trip_stats.update(d["trip_stats"])
+            else:
+                _rebuild_trip_stats()
             total_pts = sum(len(v) for v in location_history.values())
             print(f"✅ Geçmiş yüklendi: {len(location_history)} kullanıcı, {total_pts} nokta")
         else:
@@ -204,75 +942,92 @@ async def startup_event():
     except Exception as e:
         print(f"❌ Geçmiş yükleme hatası: {e}")
     try:
-        if os.path.exists(ROUTE_LIBRARY_FILE):
-            with open(ROUTE_LIBRARY_FILE, 'r', encoding='utf-8') as f:
-                route_library.update(json.load(f))
+        d = _load_store(ROUTE_LIBRARY_SNAPSHOT, ROUTE_LIBRARY_FILE,
+                        lambda legacy: {"route_library": legacy})
+        if d is not None:
+            route_library.update(d.get("route_library", {}))
             total_routes = sum(len(v) for v in route_library.values())
             print(f"✅ Rota kütüphanesi yüklendi: {total_routes} rota")
     except Exception as e:
         print(f"❌ Rota kütüphanesi yükleme hatası: {e}")
     try:
-        if os.path.exists(ROUTE_WAYPOINTS_FILE):
-            with open(ROUTE_WAYPOINTS_FILE, 'r', encoding='utf-8') as f:
-                room_route_waypoints.update(json.load(f))
+        d = _load_store(ROUTE_WAYPOINTS_SNAPSHOT, ROUTE_WAYPOINTS_FILE,
+                        lambda legacy: {"room_route_waypoints": legacy})
+        if d is not None:
+            room_route_waypoints.update(d.get("room_route_waypoints", {}))
             total_pois = sum(len(v) for v in room_route_waypoints.values())
             print(f"✅ POI noktaları yüklendi: {total_pois} nokta")
     except Exception as e:
         print(f"❌ POI noktaları yükleme hatası: {e}")
     # Kritik veriler (odalar, mesajlar, pinler, ban listesi vb.)
     try:
-        if os.path.exists(CRITICAL_DATA_FILE):
-            with open(CRITICAL_DATA_FILE, 'r', encoding='utf-8') as f:
-                d = json.load(f)
+        # Eski dosyanın üst seviye anahtarları zaten bölüm adları
+        d = _load_store(CRITICAL_DATA_SNAPSHOT, CRITICAL_DATA_FILE, lambda legacy: legacy)
+        if d is not None:
             rooms.update(d.get("rooms", {}))
             messages.update(d.get("messages", {}))
-            room_messages.update(d.get("room_messages", {}))
-            pins.update(d.get("pins", {}))
-            scores.update(d.get("scores", {}))
-            pin_collection_history.update(d.get("pin_collection_history", {}))
+            _reindex_messages()
+            for name, state in d.get("room_states", {}).items():
+                _room_states[name] = RoomState.from_json(name, state)
             fcm_tokens.update(d.get("fcm_tokens", {}))
             visibility_settings.update(d.get("visibility_settings", {}))
             banned_users.update(d.get("banned_users", {}))
             banned_devices.update(d.get("banned_devices", {}))
             muted_users.update(d.get("muted_users", {}))
             user_geofences.update(d.get("user_geofences", {}))
-            room_geofences.update(d.get("room_geofences", {}))
-            transport_stops.update(d.get("transport_stops", {}))
             permission_requests.update(d.get("permission_requests", {}))
+            _reindex_permission_requests()
             friend_requests.update(d.get("friend_requests", {}))
-            friends_map.update(d.get("friends_map", {}))
+            friends_map.update({uid: set(fs) for uid, fs in d.get("friends_map", {}).items()})
+            user_display_names.update(d.get("user_names", {}))
+            _reindex_user_names()
+            _reindex_friend_requests()
             # Super admin sessionlarını geri yükle (süresi dolmayanları)
             now_dt = datetime.now(DEFAULT_TIMEZONE)
             loaded_sessions = 0
             for tok, sess in d.get("super_admin_sessions", {}).items():
                 try:
-                    exp = DEFAULT_TIMEZONE.localize(
-                        datetime.strptime(sess["expiresAt"], "%Y-%m-%d %H:%M:%S"))
-                    if now_dt < exp:
-                        _super_admin_sessions[tok] = {
-                            "userId":    sess["userId"],
-                            "expiresAt": exp,
-                            "deviceId":  sess.get("deviceId", ""),
-                        }
+                    sess = _session_from_json(sess)
+                    if now_dt < sess["expiresAt"]:
+                        _super_admin_sessions[tok] = sess
                         loaded_sessions += 1
                 except Exception:
                     pass
+            _reindex_admin_sessions()
             print(f"✅ Kritik veriler yüklendi: {len(rooms)} oda, {len(messages)} konuşma, "
-                  f"{len(pins)} pin, {len(banned_users)} ban, {loaded_sessions} admin session")
+                  f"{sum(len(st.pins) for st in _room_states.values())} pin, {len(banned_users)} ban, {loaded_sessions} admin session")
         else:
             print("ℹ️ Kritik veri dosyası yok — temiz başlangıç")
     except Exception as e:
         print(f"❌ Kritik veri yükleme hatası: {e}")
+    try:
+        _init_shared_state()
+    except Exception as e:
+        print(f"❌ Ortak durum bağlantı hatası: {e}")
+        raise
+    if _state_store is not None:
+        # Referansı tut — aksi halde bekleyen görev GC tarafından toplanabilir
+        global _state_listener_task
+        _state_listener_task = asyncio.create_task(_shared_state_listener())
+    global _voice_bus, _event_loop
+    _event_loop = asyncio.get_running_loop()
+    _voice_bus = _make_voice_bus()
+    await _voice_bus.start(_deliver_voice)
+    # Eski tek parça geçmiş dosyasından gelen soğuk noktaları hemen arşive al
+    if _is_persistence_leader():
+        await _archive_cold_history()
     asyncio.create_task(_periodic_save())
     asyncio.create_task(_auto_close_rooms())
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await _voice_bus.stop()
+    if not _is_persistence_leader():
+        return
     print("💾 Kapatılıyor — veriler kaydediliyor...")
-    _flush_history()
-    _flush_route_library()
-    _flush_route_waypoints()
-    _flush_critical_data()
+    for flush in (_flush_history, _flush_route_library,
+                  _flush_route_waypoints, _flush_critical_data):
+        await _in_state_actor(flush)
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # 🗄️ VERİ SAKLAMASI (RAM)
@@ -281,18 +1036,932 @@ async def shutdown_event():
 locations = {}
 location_history = {}
 rooms = {}
-scores = {}
-pin_collection_history = {}
-pins = {}
 messages = {}
-room_messages = {}
-room_message_reads = {}   # {room_name: {user_id: lastReadMsgId}}
 visibility_settings = {}
 fcm_tokens = {}
 
+# ─── Konum ızgarası ───────────────────────────────────────────────────────────
+# locations üzerinde sabit boyutlu enlem/boylam hücreleri: "yakınımda kim var"
+# sorgusu yalnızca yarıçapın kapsadığı hücrelere bakar. update_location ve ortak
+# durum güncellemeleri hücreyi taşır; başka yerde silinen konumlar sorguda
+# fark edilip indeksten düşürülür.
+NEARBY_CELL_DEG     = 0.005    # ~550 m enlem
+NEARBY_MAX_RADIUS_M = 5000
+NEARBY_MAX_K        = 100
+BBOX_MARGIN         = 0.25     # görünüm her yönde bu oranda genişletilir
+LOCATIONS_PUSH_SECS = 2.0      # /ws/locations gönderim aralığı
+_loc_cells:   dict = {}   # (i, j) → {user_id}
+_loc_cell_of: dict = {}   # user_id → (i, j)
+_loc_merc:    dict = {}   # user_id → Web Mercator tamsayı koordinatı (kümeleme için)
+_loc_room_of: dict = {}   # user_id → oda (locations'taki roomName)
+_room_members: dict = {}  # oda → {user_id}
+_room_clusters: dict = {} # oda → {zoom: {küme hücresi: {user_id}}} — ilk istekte kurulur
+
+def _cell_of(lat: float, lng: float) -> tuple:
+    return (int(floor(lat / NEARBY_CELL_DEG)), int(floor(lng / NEARBY_CELL_DEG)))
+
+# ─── Zoom'a göre kümeleme ───
+# Her nokta bir kez MERCATOR_BITS bitlik Web Mercator koordinatına çevrilir;
+# z zoom'undaki küme hücresi bu koordinatın üst (z + CLUSTER_CELL_BITS) bitidir,
+# yani tüm zoom seviyeleri aynı anahtardan bit kaydırmayla türeyen bir dörtlü
+# ağaç oluşturur. 256 px karo ve CLUSTER_CELL_BITS=2 ile hücre 64 px'tir.
+MERCATOR_BITS     = 32
+CLUSTER_CELL_BITS = 2
+CLUSTER_MAX_ZOOM  = int(os.getenv("CLUSTER_MAX_ZOOM", "15"))   # bu zoom ve üstünde tek tek
+
+def _mercator(lat: float, lng: float) -> tuple:
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    scale = 1 << MERCATOR_BITS
+    x = (lng + 180.0) / 360.0 * scale
+    y = (1.0 - log(tan(radians(lat)) + 1.0 / cos(radians(lat))) / pi) / 2.0 * scale
+    return (min(max(int(x), 0), scale - 1), min(max(int(y), 0), scale - 1))
+
+def _cluster_key(merc: tuple, zoom: int) -> tuple:
+    shift = MERCATOR_BITS - max(0, min(zoom, CLUSTER_MAX_ZOOM)) - CLUSTER_CELL_BITS
+    return (merc[0] >> shift, merc[1] >> shift)
+
+def _cluster(points: list, zoom: int) -> tuple:
+    """points: [(x, y, lat, lng, öğe)] → (tekil öğeler, [{lat, lng, count}]).
+    Aynı hücreye düşen iki veya daha fazla nokta ağırlık merkezinde tek küme olur."""
+    cells: dict = {}
+    for x, y, lat, lng, item in points:
+        cells.setdefault(_cluster_key((x, y), zoom), []).append((lat, lng, item))
+    singles, clusters = [], []
+    for members in cells.values():
+        if len(members) == 1:
+            singles.append(members[0][2])
+        else:
+            clusters.append({"lat": sum(m[0] for m in members) / len(members),
+                             "lng": sum(m[1] for m in members) / len(members),
+                             "count": len(members)})
+    return singles, clusters
+
+def _room_cluster_cells(room_name: str, zoom: int) -> dict:
+    """Odanın zoom'daki küme hücreleri (hücre → {uid}). İlk istekte üyelerden
+    kurulur; sonra _place_location yalnızca taşınan üyenin hücresini düzeltir."""
+    zoom = max(0, min(zoom, CLUSTER_MAX_ZOOM))
+    if room_name not in _room_members:
+        return {}
+    grids = _room_clusters.setdefault(room_name, {})
+    cells = grids.get(zoom)
+    if cells is None:
+        cells = grids[zoom] = {}
+        for uid in _room_members[room_name]:
+            cells.setdefault(_cluster_key(_loc_merc[uid], zoom), set()).add(uid)
+    return cells
+
+def _move_room_member(uid: str, old_room, old_merc, room, merc):
+    if old_room is not None:
+        for zoom, cells in _room_clusters.get(old_room, {}).items():
+            key = _cluster_key(old_merc, zoom)
+            cells[key].discard(uid)
+            if not cells[key]:
+                del cells[key]
+        members = _room_members[old_room]
+        members.discard(uid)
+        if not members:
+            del _room_members[old_room]
+            _room_clusters.pop(old_room, None)
+        del _loc_room_of[uid]
+    if room is not None:
+        _room_members.setdefault(room, set()).add(uid)
+        _loc_room_of[uid] = room
+        for zoom, cells in _room_clusters.get(room, {}).items():
+            cells.setdefault(_cluster_key(merc, zoom), set()).add(uid)
+
+def _place_location(uid: str):
+    """uid'in hücresini, odasını ve küme hücrelerini locations'taki güncel
+    konuma göre düzelt."""
+    data = locations.get(uid)
+    cell = _cell_of(data["lat"], data["lng"]) if data else None
+    merc = _mercator(data["lat"], data["lng"]) if data else None
+    room = data.get("roomName", "Genel") if data else None
+    old_merc, old_room = _loc_merc.get(uid), _loc_room_of.get(uid)
+    if (room, merc) != (old_room, old_merc):
+        _move_room_member(uid, old_room, old_merc, room, merc)
+    if data:
+        _loc_merc[uid] = merc
+    else:
+        _loc_merc.pop(uid, None)
+    old = _loc_cell_of.get(uid)
+    if old == cell:
+        return
+    if old is not None:
+        members = _loc_cells.get(old)
+        if members is not None:
+            members.discard(uid)
+            if not members:
+                del _loc_cells[old]
+        del _loc_cell_of[uid]
+    if cell is not None:
+        _loc_cells.setdefault(cell, set()).add(uid)
+        _loc_cell_of[uid] = cell
+
+def _reindex_locations(key=None):
+    if key is not None:
+        _place_location(key)
+        return
+    _loc_cells.clear(); _loc_cell_of.clear(); _loc_merc.clear()
+    _loc_room_of.clear(); _room_members.clear(); _room_clusters.clear()
+    for uid in list(locations):
+        _place_location(uid)
+
+def _users_near(lat: float, lng: float, radius: float) -> list:
+    """Yarıçapı kapsayan hücrelerdeki uid'ler (kesin mesafe süzmesi çağıranda)."""
+    dlat = radius / 111320
+    dlng = radius / (111320 * max(cos(radians(lat)), 0.01))
+    return _users_in_box(lat - dlat, lng - dlng, lat + dlat, lng + dlng)
+
+def _users_in_box(south: float, west: float, north: float, east: float) -> list:
+    """Kutuyu kesen hücrelerdeki uid'ler (kutu kenarındaki hücreler taşabilir)."""
+    i0, j0 = _cell_of(south, west)
+    i1, j1 = _cell_of(north, east)
+    if (i1 - i0 + 1) * (j1 - j0 + 1) > len(_loc_cells):
+        cells = [members for (i, j), members in _loc_cells.items()
+                 if i0 <= i <= i1 and j0 <= j <= j1]
+    else:
+        cells = [_loc_cells[(i, j)] for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)
+                 if (i, j) in _loc_cells]
+    stale, result = [], []
+    for members in cells:
+        for uid in members:
+            (result if uid in locations else stale).append(uid)
+    for uid in stale:
+        _place_location(uid)
+    return result
+
+# ─── Isı haritası karoları ────────────────────────────────────────────────────
+# Oda başına, HEATMAP_MAX_ZOOM'a kadar her zoom için karo başına seyrek yoğunluk
+# ızgarası: _heat_grids[oda][(z, x, y)] = {kutu: nokta sayısı}, karo başına
+# HEATMAP_BINS × HEATMAP_BINS kutu. Izgara oda ilk istendiğinde üyelerin sıcak
+# geçmişinden kurulur, sonra geçmişe eklenen her nokta her zoomda tek kutuyu
+# artırır ve yalnızca o karonun önbellekteki PNG'sini düşürür. Karolar yalnızca
+# sıcak geçmişi (son HOT_HISTORY_DAYS gün) gösterir; arşiv dosyaları okunmaz.
+# Arşivleme bir kullanıcının noktalarını taşıyınca yalnızca o kullanıcının
+# odasının ızgarası düşer ve bir sonraki istekte yeniden kurulur.
+HEATMAP_MAX_ZOOM    = int(os.getenv("HEATMAP_MAX_ZOOM", "17"))
+HEATMAP_BIN_BITS    = 6        # karo başına 64×64 kutu (256 px'de 4 px)
+HEATMAP_BINS        = 1 << HEATMAP_BIN_BITS
+HEATMAP_TILE_PX     = 256
+HEATMAP_CACHE_TILES = int(os.getenv("HEATMAP_CACHE_TILES", "1024"))
+_heat_grids: dict = {}
+_heat_tiles: OrderedDict = OrderedDict()   # (oda, z, x, y) → PNG, LRU sırasıyla
+
+def _heat_add(room_name: str, lat: float, lng: float):
+    grids = _heat_grids.get(room_name)
+    if grids is None:
+        return   # oda henüz istenmedi — ilk istekte geçmişten kurulur
+    x, y = _mercator(lat, lng)
+    mask = HEATMAP_BINS - 1
+    for z in range(HEATMAP_MAX_ZOOM + 1):
+        shift = MERCATOR_BITS - z - HEATMAP_BIN_BITS
+        bx, by = x >> shift, y >> shift
+        key = (z, bx >> HEATMAP_BIN_BITS, by >> HEATMAP_BIN_BITS)
+        tile = grids.get(key)
+        if tile is None:
+            tile = grids[key] = {}
+        b = ((by & mask) << HEATMAP_BIN_BITS) | (bx & mask)
+        tile[b] = tile.get(b, 0) + 1
+        _heat_tiles.pop((room_name,) + key, None)
+
+def _heat_grid(room_name: str) -> dict:
+    grids = _heat_grids.get(room_name)
+    if grids is None:
+        grids = _heat_grids[room_name] = {}
+        for uid, data in locations.items():
+            if data.get("roomName") == room_name:
+                for p in location_history.get(uid, []):
+                    _heat_add(room_name, p["lat"], p["lng"])
+    return grids
+
+def _heat_drop(room_name: Optional[str] = None):
+    """Oda (None → tümü) ızgarasını ve karolarını at; sonraki istek yeniden kurar."""
+    if room_name is None:
+        _heat_grids.clear()
+        _heat_tiles.clear()
+        return
+    _heat_grids.pop(room_name, None)
+    for key in [k for k in _heat_tiles if k[0] == room_name]:
+        del _heat_tiles[key]
+
+def _heat_palette() -> tuple:
+    """0 saydam; 1..255 mavi → yeşil → sarı → kırmızı, giderek opaklaşan."""
+    stops = [(0.0, (0, 0, 255)), (0.4, (0, 255, 0)), (0.7, (255, 255, 0)), (1.0, (255, 0, 0))]
+    rgb, alpha = bytearray(3), bytearray(1)
+    for i in range(1, 256):
+        t = (i - 1) / 254
+        for (t0, c0), (t1, c1) in zip(stops, stops[1:]):
+            if t <= t1:
+                f = (t - t0) / (t1 - t0)
+                rgb += bytes(round(a + (b - a) * f) for a, b in zip(c0, c1))
+                break
+        alpha.append(round(90 + 165 * t))
+    return bytes(rgb), bytes(alpha)
+
+_HEAT_PLTE, _HEAT_TRNS = _heat_palette()
+
+def _png_indexed(rows: list, palette: bytes, alpha: bytes) -> bytes:
+    """8 bit paletli PNG; rows: satır başına piksel başına bir palet indeksi."""
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return (struct.pack(">I", len(data)) + tag + data
+                + struct.pack(">I", zlib.crc32(tag + data)))
+    raw = b"".join(b"\x00" + row for row in rows)
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", len(rows[0]), len(rows), 8, 3, 0, 0, 0))
+            + chunk(b"PLTE", palette) + chunk(b"tRNS", alpha)
+            + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+
+_HEAT_EMPTY_PNG = _png_indexed([bytes(HEATMAP_TILE_PX)] * HEATMAP_TILE_PX,
+                               _HEAT_PLTE, _HEAT_TRNS)
+
+def _heat_cells(room_name: str, z: int, x: int, y: int) -> tuple:
+    """Karonun kutuları: (kenar kutu sayısı, {(sütun, satır): sayı}).
+    HEATMAP_MAX_ZOOM üstünde atadaki karonun ilgili çeyreği büyütülür."""
+    dz = max(0, z - HEATMAP_MAX_ZOOM)
+    tile = _heat_grid(room_name).get((z - dz, x >> dz, y >> dz))
+    span = HEATMAP_BINS >> dz
+    if not tile:
+        return span, {}
+    ox, oy = (x & ((1 << dz) - 1)) * span, (y & ((1 << dz) - 1)) * span
+    mask = HEATMAP_BINS - 1
+    cells = {}
+    for b, n in tile.items():
+        c, r = (b & mask) - ox, (b >> HEATMAP_BIN_BITS) - oy
+        if 0 <= c < span and 0 <= r < span:
+            cells[(c, r)] = n
+    return span, cells
+
+def _heat_render(span: int, cells: dict) -> bytes:
+    if not cells:
+        return _HEAT_EMPTY_PNG
+    scale = HEATMAP_TILE_PX // span
+    top = log(1 + max(cells.values()))
+    rows = []
+    for r in range(span):
+        row = bytearray(span)
+        for c in range(span):
+            n = cells.get((c, r))
+            if n:
+                row[c] = 1 + int(254 * log(1 + n) / top)
+        line = b"".join(bytes((v,)) * scale for v in row)
+        rows.extend([line] * scale)
+    return _png_indexed(rows, _HEAT_PLTE, _HEAT_TRNS)
+
+# ─── Kullanıcı kimlikleri ─────────────────────────────────────────────────────
+# Her kullanıcının değişmeyen bir iç kimliği (uid) vardır ve tüm koleksiyonlar
+# uid ile tutulur. Hiç isim değiştirmemiş kullanıcının uid'i adının kendisidir,
+# bu yüzden eski veriler dönüştürülmeden geçerlidir. İsim değişikliği yalnızca
+# user_display_names'e bir giriş yazar; uçlar girişte ismi uid'e, çıkışta uid'i
+# güncel isme çevirir (_call_and_render / _StateActorRoute). Çeviri yan etkisizdir;
+# boşta kalmış bir isme yeni uid yalnızca @_claims_user_names uçlarında (oda
+# kurma/katılma, konum gönderme) ve isim değişikliğinde kaydedilir. Küme
+# modunda her eşleme değişikliği diğer node'lara da gönderilir (/cluster/names).
+user_display_names: dict = {}   # uid → güncel isim (yalnızca isim ≠ uid ise)
+_uid_by_name:       dict = {}   # güncel isim → uid — user_display_names'ten türetilir
+_user_names_lock = threading.Lock()
+
+def _reindex_user_names(key=None):
+    _uid_by_name.clear()
+    _uid_by_name.update({name: uid for uid, name in user_display_names.items()})
+
+def _name_holder(name: str) -> Optional[str]:
+    """Şu an bu ismi taşıyan uid. İsim, adını değiştirmiş birinin uid'i olarak
+    boşta kaldıysa None."""
+    uid = _uid_by_name.get(name)
+    if uid is not None:
+        return uid
+    return None if name in user_display_names else name
+
+def _numbered_name(name: str) -> str:
+    n = 1
+    while any(f"{name}~{n}" in d for d in (user_display_names, _uid_by_name, locations)):
+        n += 1
+    return f"{name}~{n}"
+
+def _set_display_name(uid: str, name: str, replicate: bool = True):
+    global _critical_save_pending
+    prev = user_display_names.get(uid, uid)
+    if _uid_by_name.get(prev) == uid:
+        del _uid_by_name[prev]
+    if name == uid:
+        user_display_names.pop(uid, None)
+    else:
+        user_display_names[uid] = name
+        _uid_by_name[name] = uid
+    _share("user_names", uid)
+    _critical_save_pending = True
+    if replicate:
+        _cluster_sync_name(uid, name)
+
+def user_id_of(name: str) -> str:
+    """İsim → uid, yan etkisiz. Boşta kalmış eski bir isim eski sahibinin
+    verisine düşmesin diye ona ayrılacak numaralı uid'e çözülür; bu uid henüz
+    kayıtlı değilse hiçbir veriyle eşleşmez."""
+    uid = _name_holder(name)
+    return uid if uid is not None else _numbered_name(name)
+
+def claim_user_id(name: str) -> str:
+    """Katılma/kurma: boşta kalmış isme yeni uid ayır ve kaydet."""
+    uid = _name_holder(name)
+    if uid is None:
+        with _user_names_lock:
+            uid = _name_holder(name)
+            if uid is None:
+                uid = _numbered_name(name)
+                _set_display_name(uid, name)
+    return uid
+
+def _claims_user_names(endpoint):
+    """Endpoint kullanıcıyı sisteme sokar — gövdedeki boşta kalmış isimlere uid ayrılır."""
+    endpoint._claims_user_names = True
+    return endpoint
+
+def display_name(uid: str) -> str:
+    return user_display_names.get(uid, uid)
+
+def _rename_user(uid: str, new: str):
+    """Kullanıcıya yeni isim ver. İsmi taşıyan başka bir kullanıcı varsa o, ismin
+    numaralı bir türevine (isim~1) geçer. Hiç görülmemiş bir isim (uid'i adı
+    olan, kaydı olmayan) için eşleme üretilmez."""
+    with _user_names_lock:
+        holder = _name_holder(new)
+        if holder is not None and holder != uid and (
+                holder != new or holder in locations or holder in location_history):
+            _set_display_name(holder, _numbered_name(new))
+        _set_display_name(uid, new)
+
+# Kullanıcı adı taşıyan uç parametreleri ve gövde / yanıt alanları. Yalnızca
+# her yerde kullanıcı anlamına gelen adlar burada; "from", "to", "creator",
+# "peer", "admin" gibi genel adlar onları kullanıcı olarak taşıyan uçlarda
+# @_user_fields ile bildirilir (rota "to"su, iz "from"u çevrilmesin).
+_USER_PARAMS      = frozenset({"user_id", "admin_id", "target_user", "other_user", "user1", "user2",
+                               "viewer_id", "requester", "requester_id", "around_user"})
+_USER_FIELDS      = frozenset({"userId", "adminId", "targetUser", "fromUser", "toUser",
+                               "createdBy", "broadcasterId", "requesterUserId",
+                               "adminUserId", "sharedBy", "addedBy", "collectorId", "kickedBy",
+                               "bannedBy", "mutedBy", "roomAdmin"})
+_USER_LIST_FIELDS = frozenset({"allowed", "voiceAllowed", "collectors", "participants", "likes",
+                               "friends", "mutedUsers", "passed"})
+
+def _user_fields(*fields: str):
+    """Endpoint'in gövde/yanıtında kullanıcı adı taşıyan ek (genel adlı) alanlar."""
+    def mark(endpoint):
+        endpoint._user_fields = frozenset(fields)
+        return endpoint
+    return mark
+
+def _endpoint_user_fields(endpoint) -> frozenset:
+    extra = getattr(endpoint, "_user_fields", None)
+    return _USER_FIELDS | extra if extra else _USER_FIELDS
+
+def _resolve_fields(obj: dict, setter, fields: frozenset, resolve):
+    for field, value in obj.items():
+        if field in fields and isinstance(value, str) and value:
+            setter(field, resolve(value))
+        elif field in _USER_LIST_FIELDS and isinstance(value, list):
+            setter(field, [resolve(v) if isinstance(v, str) else v for v in value])
+
+def _resolve_user_args(kw: dict, fields: frozenset = _USER_FIELDS, claim: bool = False):
+    """Uç argümanlarındaki kullanıcı adlarını uid'e çevir (yerinde)."""
+    resolve = claim_user_id if claim else user_id_of
+    for key, value in list(kw.items()):
+        if key in _USER_PARAMS and isinstance(value, str) and value:
+            kw[key] = resolve(value)
+        elif isinstance(value, BaseModel):
+            _resolve_fields(dict(vars(value)), functools.partial(setattr, value), fields, resolve)
+        elif isinstance(value, dict):
+            _resolve_fields(dict(value), value.__setitem__, fields, resolve)
+
+def _render_user_ids(value, fields: frozenset = _USER_FIELDS):
+    """Yanıttaki uid'leri güncel isimlere çevir. Durumdaki nesneler
+    değiştirilmez (kopya döner); kimse isim değiştirmediyse dokunulmaz."""
+    if not user_display_names:
+        return value
+    if isinstance(value, dict):
+        out = {}
+        for k, v in value.items():
+            if k in fields and isinstance(v, str):
+                out[k] = user_display_names.get(v, v)
+            elif k in _USER_LIST_FIELDS and isinstance(v, list):
+                out[k] = [user_display_names.get(x, x) if isinstance(x, str) else x for x in v]
+            else:
+                out[k] = _render_user_ids(v, fields)
+        return out
+    if isinstance(value, (list, tuple)):
+        return [_render_user_ids(v, fields) for v in value]
+    return value
+
+# ─── 1-1 konuşma indeksleri ───────────────────────────────────────────────────
+# messages'tan türetilir (diske yazılmaz). Gönderimde artar, okundu işaretinde
+# sıfırlanır; get_unread_count tüm konuşmaları taramak yerine buradan okur.
+unread_counts: dict = {}   # alıcı → {gönderen: adet}
+_read_cursors:  dict = {}   # conv_key → {alıcı: ilk okunmamış mesajın indeksi}
+_user_convs:    dict = {}   # kullanıcı → {karşı taraf: conv_key}
+
+def _reindex_conversation(key):
+    """Tek konuşmanın sayaç, imleç ve kullanıcı indeksini mesajlardan yeniden
+    kur; seq numarası eksik mesajlara numara ver."""
+    conv = messages.get(key, [])
+    a, b = conv_users(key)
+    for u, other in ((a, b), (b, a)):
+        for index in (unread_counts, _user_convs):
+            entry = index.get(u)
+            if entry is not None:
+                entry.pop(other, None)
+                if not entry:
+                    index.pop(u, None)
+    if not conv:
+        _read_cursors.pop(key, None)
+        return
+    _user_convs.setdefault(a, {})[b] = key
+    _user_convs.setdefault(b, {})[a] = key
+    cursors = {}
+    seq = 0
+    for i, msg in enumerate(conv):
+        if "seq" not in msg:
+            msg["seq"] = seq + 1
+        seq = msg["seq"]
+        if msg["read"]:
+            continue
+        to = msg["to"]
+        cursors.setdefault(to, i)
+        counts = unread_counts.setdefault(to, {})
+        counts[msg["from"]] = counts.get(msg["from"], 0) + 1
+    cursors.setdefault(a, len(conv)); cursors.setdefault(b, len(conv))
+    _read_cursors[key] = cursors
+
+def _reindex_messages(key=None):
+    """Ortak durum kancası da olarak kullanılır: key=None → tüm konuşmalar."""
+    if key is not None:
+        _reindex_conversation(key)
+        return
+    unread_counts.clear(); _read_cursors.clear(); _user_convs.clear()
+    for k in list(messages):
+        _reindex_conversation(k)
+
+def _append_direct_message(key, msg):
+    """1-1 konuşmaya seq numarasıyla mesaj ekle ve alıcının sayacını artır."""
+    conv = messages.setdefault(key, [])
+    msg["seq"] = conv[-1]["seq"] + 1 if conv else 1
+    conv.append(msg)
+    _user_convs.setdefault(msg["from"], {})[msg["to"]] = key
+    _user_convs.setdefault(msg["to"], {})[msg["from"]] = key
+    counts = unread_counts.setdefault(msg["to"], {})
+    counts[msg["from"]] = counts.get(msg["from"], 0) + 1
+    _read_cursors.setdefault(key, {}).setdefault(msg["to"], len(messages[key]) - 1)
+    _share_append("messages", key, msg)
+
+# ─── Oda durumu (oda başına bölümlenmiş) ─────────────────────────────────────
+# Odalar birbiriyle neredeyse hiç etkileşmez. Bir odanın pin, skor, grup mesajı,
+# walkie, SOS, müzik, geofence, paylaşılan rota ve transport verisi tek bir
+# RoomState nesnesinde durur ve o nesnenin kilidiyle korunur:
+#   • oda uçları (_room_scoped) global aktörü beklemeden yalnızca kendi odasının
+#     kilidini alır — yoğun iki oda birbirini bekletmez
+#   • aktörde çalışan kod bir odanın verisine dokunurken o odanın kilidini alır
+#   • oda silmek / kapatmak tek nesneyi düşürmektir
+# Oda uçları aktör dışında koştuğundan global duruma yalnızca şöyle dokunur:
+#   • okuma: rooms, locations, muted_users üzerinde tek anahtarlık get / in
+#     (GIL altında atomik; konum kaydı bütün olarak değiştirilir, yerinde
+#     yalnızca tek alan atanır). Bu dict'ler üzerinde gezinilmez.
+#   • is_super_admin: oturum tabloları _admin_sessions_lock altında
+#   • _share / _share_append: yalnızca odanın kendi verisi (oda kilidi alınmış),
+#     Redis istemcisi kendi kilidine sahip
+#   • kayıt bayrakları (_critical_save_pending, _critical_dirty) aktörde
+#     değişir. Oda verisi için tek yol "room_states" bölümünü kirli işaretlemek:
+#     oda ucu değiştirdiği alanları _room_scoped(writes=...) ile bildirir,
+#     _call_in_room kalıcı alan varsa işareti _from_room ile aktöre sıraya koyar.
+#     Aktör bayrakları serileştirdikten sonra indirdiği için araya giren bir
+#     thread yazımı kaybolabilirdi.
+# Rota kütüphanesi ve POI noktaları odadan bağımsız yaşar (oda kapansa da kalır),
+# bu yüzden burada değil.
+
+class MessageRing:
+    """Grup mesajları için sabit kapasiteli halka tampon. Her mesaj artan bir
+    seq alır; tampondaki seq'ler ardışık olduğundan seq → konum hesapla,
+    id → seq sözlükle bulunur. Dolunca en eski mesaj düşer."""
+
+    def __init__(self, capacity: int):
+        self._buf = deque(maxlen=capacity)
+        self._ids: dict = {}   # mesaj id → seq
+        self.head = 0          # son mesajın seq'i (0 = hiç mesaj yok)
+
+    @property
+    def first_seq(self) -> int:
+        """Tampondaki en eski mesajın seq'i (boşsa head + 1)."""
+        return self.head - len(self._buf) + 1
+
+    def append(self, msg: dict):
+        if len(self._buf) == self._buf.maxlen:
+            self._ids.pop(self._buf[0]["id"], None)
+        self.head += 1
+        msg["seq"] = self.head
+        self._buf.append(msg)
+        self._ids[msg["id"]] = self.head
+
+    def append_replicated(self, msg: dict):
+        """Başka worker'da numaralanmış mesajı kendi seq'iyle ekle; sayaç ona
+        ilerler. Arada kaçırılmış mesaj varsa (seq > head + 1) tampon o seq'ten
+        yeniden başlar — seq'ler ardışık kalmalı. Çakışan ya da geride kalan seq
+        (iki worker aynı anda yazdı) yerel numarayla eklenir, mesaj kaybolmaz."""
+        if msg["id"] in self._ids:
+            return
+        seq = msg.get("seq") or 0
+        if seq > self.head:
+            if seq > self.head + 1:
+                self._buf.clear(); self._ids.clear()
+            self.head = seq - 1
+        self.append(msg)
+
+    def replace(self, msgs):
+        """İçeriği değiştir. Mesajlarda seq varsa ilkinden devam edilir, yoksa
+        numaralama mevcut head'den sürer — temizlenen oda seq'i geri sarmaz."""
+        msgs = list(msgs)[-self._buf.maxlen:]
+        self._buf.clear(); self._ids.clear()
+        if msgs and msgs[0].get("seq"):
+            self.head = msgs[0]["seq"] - 1
+        for msg in msgs:
+            self.append(msg)
+
+    def seq_of(self, msg_id: str) -> Optional[int]:
+        return self._ids.get(msg_id)
+
+    def since(self, seq: int) -> list:
+        """seq'ten sonraki mesajlar."""
+        start = max(0, seq - self.first_seq + 1)
+        return list(itertools.islice(self._buf, start, None)) if start < len(self._buf) else []
+
+    def __len__(self):
+        return len(self._buf)
+
+    def __iter__(self):
+        return iter(self._buf)
+
+    def __getitem__(self, index):
+        return list(self._buf)[index] if isinstance(index, slice) else self._buf[index]
+
+class FenceOccupancy:
+    """Geofence doluluk indeksi: geofence → {user_id: giriş kaydı} ve
+    user_id → {geofence}. Çıkışta kalış süresi gün bazında biriktirilir;
+    böylece bir bölgeyi çizmek yalnızca içindekiler kadar iş yapar."""
+
+    def __init__(self):
+        self.by_fence: dict = {}   # geofence_id → {user_id: giriş kaydı}
+        self.by_user: dict = {}    # user_id → {geofence_id}
+        self._entered: dict = {}   # (user_id, geofence_id) → giriş anı (epoch)
+        self._dwell: dict = {}     # (user_id, geofence_id) → [gün, tamamlanan saniye]
+
+    def __bool__(self):
+        return bool(self.by_fence)
+
+    def enter(self, uid: str, gid: str, entry: dict, at: Optional[float] = None) -> bool:
+        """İçeri girişi kaydet; zaten içerideyse ilk giriş korunur (False)."""
+        occupants = self.by_fence.setdefault(gid, {})
+        if uid in occupants:
+            return False
+        occupants[uid] = entry
+        self.by_user.setdefault(uid, set()).add(gid)
+        self._entered[(uid, gid)] = time.time() if at is None else at
+        return True
+
+    def leave(self, uid: str, gid: str) -> Optional[dict]:
+        occupants = self.by_fence.get(gid)
+        entry = occupants.pop(uid, None) if occupants else None
+        if entry is None:
+            return None
+        if not occupants:
+            del self.by_fence[gid]
+        gids = self.by_user.get(uid)
+        if gids is not None:
+            gids.discard(gid)
+            if not gids:
+                del self.by_user[uid]
+        entered = self._entered.pop((uid, gid), None)
+        if entered is not None:
+            now = time.time()
+            day = self._day(now)
+            slot = self._dwell.get((uid, gid))
+            if slot is None or slot[0] != day:
+                slot = self._dwell[(uid, gid)] = [day, 0.0]
+            slot[1] += now - max(entered, self._day_start(now))
+        return entry
+
+    def occupants(self, gid: str) -> list:
+        return list(self.by_fence.get(gid, {}).values())
+
+    def is_inside(self, uid: str, gid: str) -> bool:
+        return gid in self.by_user.get(uid, ())
+
+    def dwell_seconds(self, uid: str, gid: str) -> float:
+        """Bugün bu bölgede geçen süre (açık ziyaret dahil)."""
+        now = time.time()
+        slot = self._dwell.get((uid, gid))
+        total = slot[1] if slot and slot[0] == self._day(now) else 0.0
+        entered = self._entered.get((uid, gid))
+        if entered is not None:
+            total += now - max(entered, self._day_start(now))
+        return total
+
+    def drop_fence(self, gid: str):
+        for uid in list(self.by_fence.get(gid, ())):
+            self.forget(uid, gid)
+
+    def forget(self, uid: str, gid: str):
+        """Ziyareti ve birikmiş süreyi tamamen unut (bölge silindi)."""
+        self.leave(uid, gid)
+        self._dwell.pop((uid, gid), None)
+
+    def entries(self) -> dict:
+        """Eski biçim: f"{user_id}_{geofence_id}" → giriş kaydı (kalıcı kopya için)."""
+        return {f"{uid}_{gid}": entry
+                for gid, occupants in self.by_fence.items() for uid, entry in occupants.items()}
+
+    def load(self, entries: dict):
+        for entry in entries.values():
+            uid, gid = entry.get("userId"), entry.get("geofenceId")
+            if not uid or not gid:
+                continue
+            try:
+                at = DEFAULT_TIMEZONE.localize(
+                    datetime.strptime(entry.get("entryTime", ""), "%Y-%m-%d %H:%M:%S")).timestamp()
+            except ValueError:
+                at = None
+            self.enter(uid, gid, entry, at)
+
+    @staticmethod
+    def _day(ts: float) -> str:
+        return datetime.fromtimestamp(ts, DEFAULT_TIMEZONE).strftime("%Y-%m-%d")
+
+    @staticmethod
+    def _day_start(ts: float) -> float:
+        d = datetime.fromtimestamp(ts, DEFAULT_TIMEZONE)
+        return ts - (d.hour * 3600 + d.minute * 60 + d.second + d.microsecond / 1e6)
+
+class StopIndex:
+    """transport_stops üzerinde ızgara: her durak yarıçapının kapsadığı
+    NEARBY_CELL_DEG hücrelerine yazılır; bir konum için yalnızca kendi
+    hücresindeki duraklara mesafe hesaplanır. Yarıçapı TRANSPORT_STOP_MAX_RADIUS_M'yi
+    aşan (sınırdan önce kaydedilmiş) duraklar hücre açmaz, her sorguda taranır."""
+
+    def __init__(self):
+        self.cells: dict = {}      # (i, j) → {stop_id}
+        self.cells_of: dict = {}   # stop_id → [(i, j)]
+        self.wide: set = set()     # ızgaraya yazılmayan büyük duraklar
+
+    def add(self, stop: dict):
+        self.remove(stop["id"])
+        if stop["radius"] > TRANSPORT_STOP_MAX_RADIUS_M:
+            self.wide.add(stop["id"])
+            return
+        dlat = stop["radius"] / 111320
+        dlng = stop["radius"] / (111320 * max(cos(radians(stop["lat"])), 0.01))
+        i0, j0 = _cell_of(stop["lat"] - dlat, stop["lng"] - dlng)
+        i1, j1 = _cell_of(stop["lat"] + dlat, stop["lng"] + dlng)
+        cells = [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(stop["id"])
+        self.cells_of[stop["id"]] = cells
+
+    def remove(self, stop_id: str):
+        self.wide.discard(stop_id)
+        for cell in self.cells_of.pop(stop_id, ()):
+            members = self.cells[cell]
+            members.discard(stop_id)
+            if not members:
+                del self.cells[cell]
+
+    def rebuild(self, stops: dict):
+        self.cells.clear()
+        self.cells_of.clear()
+        self.wide.clear()
+        for stop in stops.values():
+            self.add(stop)
+
+    def nearest(self, lat: float, lng: float, stops: dict) -> Optional[dict]:
+        """Yarıçapı içinde olunan en yakın durak (yoksa None)."""
+        best, best_d = None, None
+        for stop_id in [*self.cells.get(_cell_of(lat, lng), ()), *self.wide]:
+            stop = stops.get(stop_id)
+            if stop is None:
+                continue
+            d = haversine(lat, lng, stop["lat"], stop["lng"])
+            if d <= stop["radius"] and (best_d is None or d < best_d):
+                best, best_d = stop, d
+        return best
+
+class RoomState:
+    # Diske yazılan alanlar; geri kalanlar RAM'de geçici (ses, yayın, anlık durum)
+    PERSISTENT_FIELDS = ("pins", "scores", "collection_history", "messages",
+                         "geofences", "transport_stops", "transport_segments",
+                         "transport_dwell")
+    VOLATILE_FIELDS   = ("message_reads", "walkie_queue", "sos", "music",
+                         "geofence_entries", "shared_route", "transport_roles",
+                         "transport_broadcast", "transport_arrivals", "transport_visits",
+                         "rank_events")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.RLock()
+        self.dropped = False                # oda silindi — elinde tutan yeniden alsın
+        self.pins: dict = {}                # pin_id → pin
+        self.scores: dict = {}              # user_id → puan
+        self._ranking: list = []            # (-puan, user_id) sıralı — scores'tan türetilir
+        self.rank_events: list = []         # [{seq,userId,oldRank,newRank,score,passed,timestamp}]
+        self.collection_history: dict = {}  # user_id → [toplanan pin]
+        self._messages = MessageRing(MAX_ROOM_MESSAGES)   # grup mesajları
+        self.message_reads: dict = {}       # user_id → son okunan mesajın seq'i
+        self.walkie_queue: list = []
+        self.sos: Optional[dict] = None
+        self.music: Optional[dict] = None   # {broadcasterId, title, startedAt, chunks, chunkIndex}
+        self.geofences: list = []
+        self.fence_occupancy = FenceOccupancy()   # geofence ↔ içerideki kullanıcılar
+        self.shared_route: Optional[dict] = None
+        self.transport_roles: dict = {}     # user_id → {role, vehicleName, joinedAt}
+        self.transport_broadcast: dict = {} # {id, fromUser, vehicleName, message, timestamp}
+        self.transport_stops: dict = {}     # stop_id → {id,name,lat,lng,radius,addedBy,addedByRole,createdAt}
+        self.transport_arrivals: list = []  # [{id,stopId,stopName,userId,character,arrivalTime}]
+        self.stop_index = StopIndex()       # transport_stops'tan türetilir
+        self.transport_visits: dict = {}    # user_id → {stopId, since, lastStopId, departedAt}
+        self.transport_segments: dict = {}  # durak → {sonraki durak: {avg, n}} (sürücüden öğrenilen)
+        self.transport_dwell: dict = {}     # durak → {avg, n} — sürücünün durakta bekleme süresi
+        self.transport_etas: dict = {}      # sürücü → [(stop_id, epoch)] — son gönderilen ETA
+
+    @property
+    def messages(self) -> MessageRing:
+        return self._messages
+
+    @messages.setter
+    def messages(self, msgs):
+        # Liste atamaları (yükleme, birleştirme, temizleme) halkayı yeniden doldurur
+        self._messages.replace(msgs)
+
+    @property
+    def geofence_entries(self) -> dict:
+        """f"{user_id}_{geofence_id}" → giriş kaydı — devir/yedek için düz görünüm."""
+        return self.fence_occupancy.entries()
+
+    @geofence_entries.setter
+    def geofence_entries(self, entries: dict):
+        self.fence_occupancy = FenceOccupancy()
+        self.fence_occupancy.load(entries or {})
+
+    # ─── Skor tablosu ───
+    def rebuild_ranking(self):
+        """scores toplu değiştiyse (yükleme, birleştirme, temizleme) sıralamayı kur."""
+        self._ranking = sorted((-score, uid) for uid, score in self.scores.items())
+
+    def rank_of(self, uid: str) -> Optional[int]:
+        """Yarışma sıralaması: eşit puanlılar aynı sırayı paylaşır (1, 1, 3 …)."""
+        if uid not in self.scores:
+            return None
+        return bisect.bisect_left(self._ranking, (-self.scores[uid],)) + 1
+
+    def add_score(self, uid: str, delta: int):
+        """Puanı artır, sıralamayı yerinde güncelle; sıra değiştiyse olay üret."""
+        old_rank = self.rank_of(uid)
+        old = self.scores.get(uid)
+        if old is not None:
+            del self._ranking[bisect.bisect_left(self._ranking, (-old, uid))]
+        score = (old or 0) + delta
+        self.scores[uid] = score
+        bisect.insort(self._ranking, (-score, uid))
+        new_rank = self.rank_of(uid)
+        if old_rank == new_rank:
+            return
+        # Geride bırakılanlar: puanı eski puan ≤ p < yeni puan olanlar
+        passed = []
+        if old is not None:
+            lo = bisect.bisect_left(self._ranking, (-score + 1,))
+            hi = bisect.bisect_left(self._ranking, (-old + 1,))
+            passed = [u for _, u in self._ranking[lo:hi] if u != uid]
+        seq = self.rank_events[-1]["seq"] + 1 if self.rank_events else 1
+        self.rank_events.append({
+            "seq": seq, "userId": uid, "oldRank": old_rank, "newRank": new_rank,
+            "score": score, "passed": passed, "timestamp": get_local_time(),
+        })
+        if len(self.rank_events) > MAX_RANK_EVENTS:
+            del self.rank_events[:-MAX_RANK_EVENTS]
+
+    def leaderboard(self, start: int, stop: int) -> list:
+        result = []
+        for _, uid in self._ranking[start:stop]:
+            result.append({"userId": uid, "score": self.scores[uid], "rank": self.rank_of(uid)})
+        return result
+
+    def is_empty(self) -> bool:
+        return not any(getattr(self, f) for f in self.PERSISTENT_FIELDS + self.VOLATILE_FIELDS)
+
+    def to_json(self, volatile: bool = False) -> dict:
+        """Kilit altında derin kopya — dönen değer odadan bağımsızdır."""
+        fields = self.PERSISTENT_FIELDS + (self.VOLATILE_FIELDS if volatile else ())
+        with self.lock:
+            data = {f: getattr(self, f) for f in fields if getattr(self, f) is not None}
+            data["messages"] = list(self._messages)
+            return copy.deepcopy(data)
+
+    @classmethod
+    def from_json(cls, name: str, data: dict) -> "RoomState":
+        st = cls(name)
+        st.merge(data)
+        return st
+
+    def merge(self, data: dict):
+        """Devralınan / yüklenen oda verisini birleştir."""
+        with self.lock:
+            if data.get("messages"):
+                incoming = {m["id"] for m in data["messages"]}
+                msgs = data["messages"] + [m for m in self.messages if m["id"] not in incoming]
+                self.messages = sorted(msgs, key=lambda m: m.get("timestamp", ""))[-MAX_ROOM_MESSAGES:]
+            for uid, score in data.get("scores", {}).items():
+                self.scores[uid] = max(self.scores.get(uid, 0), score)
+            self.rebuild_ranking()
+            for f in ("pins", "collection_history", "message_reads", "transport_roles",
+                      "transport_stops", "transport_segments", "transport_dwell",
+                      "transport_visits"):
+                getattr(self, f).update(data.get(f) or {})
+            self.stop_index.rebuild(self.transport_stops)
+            self.fence_occupancy.load(data.get("geofence_entries") or {})
+            for f in ("walkie_queue", "sos", "music", "geofences", "shared_route",
+                      "transport_broadcast", "transport_arrivals", "rank_events"):
+                if data.get(f) is not None:
+                    setattr(self, f, data[f])
+
+_room_states: dict = {}   # room_name → RoomState
+_room_states_lock = threading.Lock()
+
+def room_state(room_name: str) -> RoomState:
+    """Odanın durumunu döndür, yoksa oluştur."""
+    st = _room_states.get(room_name)
+    if st is None:
+        with _room_states_lock:
+            st = _room_states.get(room_name)
+            if st is None:
+                st = _room_states[room_name] = RoomState(room_name)
+    return st
+
+def _peek_room(room_name: str) -> Optional[RoomState]:
+    """Okuma için — olmayan oda için durum oluşturmaz."""
+    return _room_states.get(room_name)
+
+def _drop_room(room_name: str):
+    """Odanın tüm verisini tek hamlede düşür."""
+    st = _room_states.get(room_name)
+    if st is None:
+        return
+    with st.lock:
+        st.dropped = True
+        with _room_states_lock:
+            if _room_states.get(room_name) is st:
+                del _room_states[room_name]
+
+class _RoomFieldView(MutableMapping):
+    """oda adı → RoomState.<alan> görünümü; boş alan "yok" sayılır.
+    Worker'lar arası çoğaltma gibi koleksiyon bekleyen kod içindir."""
+
+    def __init__(self, field: str, empty):
+        self.field, self.empty = field, empty
+
+    def lock_for(self, room_name: str):
+        st = _peek_room(room_name)
+        return st.lock if st else contextlib.nullcontext()
+
+    def __getitem__(self, room_name):
+        st = _peek_room(room_name)
+        value = getattr(st, self.field) if st else None
+        if not value:
+            raise KeyError(room_name)
+        return value
+
+    def __setitem__(self, room_name, value):
+        st = room_state(room_name)
+        with st.lock:
+            setattr(st, self.field, value)
+
+    def setdefault(self, room_name, default=None):
+        # Alan atamada dönüştürülebilir (ör. liste → MessageRing); atanan değeri değil
+        # odadaki nesneyi döndür ki üzerine eklenenler kaybolmasın
+        st = room_state(room_name)
+        with st.lock:
+            if not getattr(st, self.field):
+                setattr(st, self.field, default)
+            return getattr(st, self.field)
+
+    def __delitem__(self, room_name):
+        st = _peek_room(room_name)
+        if not st or not getattr(st, self.field):
+            raise KeyError(room_name)
+        with st.lock:
+            setattr(st, self.field, self.empty())
+
+    def __iter__(self):
+        return iter([name for name, st in list(_room_states.items()) if getattr(st, self.field)])
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+room_messages = _RoomFieldView("messages", list)
+
 # ─── Walkie-talkie (RAM kuyruk) ───────────────────────────────────────────────
 walkie_queue = {}
-room_walkie_queue = {}
 
 # ─── Gerçek zamanlı sesli arama (WebSocket bağlantıları) ──────────────────────
 from collections import defaultdict
@@ -304,22 +1973,27 @@ voice_messages = {}
 room_voice_messages = {}
 
 # ─── Yetki istekleri ──────────────────────────────────────────────────────────
-permission_requests = {}
+permission_requests = {}  # req_id → {roomName, requesterUserId, permissionType, status, timestamp[, resolvedAt]}
+# İndeksler — permission_requests'ten türetilir (_reindex_permission_requests)
+_perm_pending_by_room: dict = {}   # room_name → {req_id}  (yalnızca bekleyenler)
+_perm_by_requester:    dict = {}   # user_id → {req_id}
+_perm_resolved:        dict = {}   # room_name → deque(req_id) — yanıtlanma sırasıyla
+PERMISSION_HISTORY_PER_ROOM = 50   # oda başına saklanan yanıtlanmış istek
+_perm_request_ws: dict = defaultdict(set)   # admin user_id → {WebSocket} (bu süreçteki)
+_transport_ws:    dict = defaultdict(set)   # room_name → {WebSocket} (bu süreçteki)
 
 # ─── Arkadaşlık istekleri ─────────────────────────────────────────────────────
-friend_requests = {}  # req_id → {from, to, status, timestamp}
-friends_map     = {}  # user_id → [friend_ids]
-
-# ─── SOS uyarıları ────────────────────────────────────────────────────────────
-sos_alerts = {}
-
-# ─── Müzik yayını ─────────────────────────────────────────────────────────────
-music_broadcasts = {}
-
-# ─── Geofence bölgeleri ───────────────────────────────────────────────────────
-room_geofences = {}
+friend_requests = {}  # req_id → {from, to, status, timestamp[, resolvedAt]}
+friends_map     = {}  # user_id → {friend_ids}  (diskte sıralı liste)
+# İndeksler — friend_requests'ten türetilir (_reindex_friend_requests)
+_friend_pending_to:   dict = {}   # to_user → {req_id}  (yalnızca bekleyenler)
+_friend_pending_pair: dict = {}   # (from_user, to_user) → req_id
+_friend_resolved      = deque()   # (resolvedAt, req_id) — çözülme sırasıyla
+FRIEND_REQUEST_RETENTION_DAYS = 7  # kabul/red edilen istekler bu kadar tutulur
+
+# ─── Kişisel geofence bölgeleri ───────────────────────────────────────────────
 user_geofences: dict = {}
-geofence_entries = {}
+_personal_fence_occupancy = FenceOccupancy()   # RAM'de — kota için günlük kalış süresi
 
 # ─── Kullanıcı yönetimi ───────────────────────────────────────────────────────
 kicked_users  = {}
@@ -327,15 +2001,6 @@ banned_users  = {}
 banned_devices = {}
 muted_users   = {}
 
-# ─── Paylaşılan rotalar ───────────────────────────────────────────────────────
-shared_routes = {}
-
-# ─── Transport modu rolleri ───────────────────────────────────────────────────
-transport_roles: dict = {}    # roomName → {userId → {role, vehicleName, joinedAt}}
-transport_broadcasts: dict = {}  # roomName → {id, fromUser, vehicleName, message, timestamp}
-transport_stops: dict = {}     # roomName → {stopId → {id,name,lat,lng,radius,addedBy,addedByRole,createdAt}}
-transport_arrivals: dict = {}  # roomName → [{id,stopId,stopName,userId,character,arrivalTime}]
-
 # ─── Rota kütüphanesi (kullanıcılar arası paylaşım) ──────────────────────────
 route_library: dict = {}  # roomName → [{id, name, creator, waypoints, distKm, durMin, createdAt}]
 
@@ -352,22 +2017,834 @@ SUPER_ADMIN_CREDENTIALS: dict = {
     os.getenv("ADMIN_ID", "admin"): os.getenv("ADMIN_PASSWORD", "1234"),
 }
 
-_super_admin_sessions: dict = {}
+_super_admin_sessions: dict = {}   # token → {userId, expiresAt, deviceId}
+# İndeksler — _super_admin_sessions'tan türetilir (_reindex_admin_sessions)
+_admin_tokens_by_user: dict = {}   # user_id → {token}
+_admin_session_expiry: list = []   # (expiresAt, token) min-heap — süre dolunca temizlik
+_admin_sessions_lock = threading.RLock()   # oda uçları da yetki sorgular (aktör dışı)
+
+def _index_admin_session(token: str, sess: dict):
+    _admin_tokens_by_user.setdefault(sess["userId"], set()).add(token)
+    heapq.heappush(_admin_session_expiry, (sess["expiresAt"], token))
+
+def _reindex_admin_sessions(key=None):
+    with _admin_sessions_lock:
+        _admin_tokens_by_user.clear(); _admin_session_expiry.clear()
+        for token, sess in list(_super_admin_sessions.items()):
+            _index_admin_session(token, sess)
+
+def _add_admin_session(token: str, sess: dict):
+    with _admin_sessions_lock:
+        _super_admin_sessions[token] = sess
+        _index_admin_session(token, sess)
+    _share("super_admin_sessions", token)
+
+def _drop_admin_session(token: str):
+    with _admin_sessions_lock:
+        sess = _super_admin_sessions.pop(token, None)
+        if sess is None:
+            return
+        tokens = _admin_tokens_by_user.get(sess["userId"])
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del _admin_tokens_by_user[sess["userId"]]
+    _share("super_admin_sessions", token)
+
+def _expire_admin_sessions():
+    """Süresi dolan oturumları düşür. Yığın en erken biteni başta tutar; silinmiş
+    ya da yenilenmiş token'ların eski girdileri burada atlanır."""
+    now = datetime.now(DEFAULT_TIMEZONE)
+    if not _admin_session_expiry or _admin_session_expiry[0][0] > now:
+        return
+    with _admin_sessions_lock:
+        while _admin_session_expiry and _admin_session_expiry[0][0] <= now:
+            _, token = heapq.heappop(_admin_session_expiry)
+            sess = _super_admin_sessions.get(token)
+            if sess is not None and sess["expiresAt"] <= now:
+                _drop_admin_session(token)
+
+def has_admin_session(user_id: str) -> bool:
+    """Kullanıcının aktif bir süper admin oturumu var mı (bilgi amaçlı bayrak)."""
+    _expire_admin_sessions()
+    return user_id in _admin_tokens_by_user
 
 def is_super_admin(user_id: str, device_id: str = "", token: str = "") -> bool:
+    """Yetki yalnızca geçerli bir oturum token'ı veya tanımlı bir cihazla verilir —
+    kullanıcı adı tek başına yetmez."""
     if token and token in _super_admin_sessions:
-        sess = _super_admin_sessions[token]
-        if datetime.now(DEFAULT_TIMEZONE) < sess["expiresAt"]:
+        _expire_admin_sessions()
+        if token in _super_admin_sessions:
             return True
-        else:
-            _super_admin_sessions.pop(token, None)
     if device_id and device_id in SUPER_ADMIN_DEVICE_IDS:
         return True
-    loc = locations.get(user_id, {})
-    if loc.get("deviceId", "") in SUPER_ADMIN_DEVICE_IDS:
+    return False
+
+def _session_to_json(sess: dict) -> dict:
+    exp = sess["expiresAt"]
+    return {
+        "userId":    sess["userId"],
+        "expiresAt": exp.strftime("%Y-%m-%d %H:%M:%S") if hasattr(exp, "strftime") else str(exp),
+        "deviceId":  sess.get("deviceId", ""),
+    }
+
+def _session_from_json(sess: dict) -> dict:
+    return {
+        "userId":    sess["userId"],
+        "expiresAt": DEFAULT_TIMEZONE.localize(
+            datetime.strptime(sess["expiresAt"], "%Y-%m-%d %H:%M:%S")),
+        "deviceId":  sess.get("deviceId", ""),
+    }
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# 🔗 ORTAK DURUM — çoklu worker / çoklu makine
+# ═══════════════════════════════════════════════════════════════════════════════
+# STATE_BACKEND=redis ile her worker aşağıda kayıtlı koleksiyonların yerel bir
+# kopyasını tutar. Değişiklikler Redis hash'ine (konum:state:<ad>) yazılır ve
+# konum:state kanalına yayınlanır; diğer worker'lar yayını kendi kopyalarına
+# uygular. Redis protokolünü konuşan her sunucu (Redis, KeyDB, Dragonfly veya
+# yerel bir test stand-in'i) yeterlidir — istemci stdlib ile yazıldı.
+# `uvicorn --workers N` (veya WEB_CONCURRENCY=N) ile çalıştırılabilir; diske
+# yazma ve oda otomatik kapatma yalnızca lider worker'da çalışır — diğer
+# worker'ların değişiklikleri lidere yayınla ulaştığı için kayda girer.
+# Kayıtlı olmayan, worker'a yerel kalanlar: oda müzik yayını, kişisel geofence
+# kalış süreleri (_personal_fence_occupancy) ve GPS süzgeci.
+STATE_BACKEND  = os.getenv("STATE_BACKEND", "memory")   # memory | redis
+REDIS_URL      = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+_WORKER_ID     = uuid.uuid4().hex[:12]
+_STATE_CHANNEL = "konum:state"
+LEADER_TTL_SECS = 90
+
+def _resp_encode(args) -> bytes:
+    out = [b"*%d\r\n" % len(args)]
+    for a in args:
+        if isinstance(a, bytes):
+            b = a
+        else:
+            b = str(a).encode("utf-8")
+        out.append(b"$%d\r\n%s\r\n" % (len(b), b))
+    return b"".join(out)
+
+def _resp_parse_line(line: bytes):
+    """(tip, değer) — bulk/array için değer uzunluktur."""
+    if not line:
+        raise ConnectionError("Redis bağlantısı kapandı")
+    t, rest = line[:1], line[1:].rstrip(b"\r\n")
+    if t == b"-":
+        raise RuntimeError(rest.decode("utf-8", "replace"))
+    if t == b"+":
+        return t, rest.decode("utf-8")
+    return t, int(rest)
+
+def _parse_redis_url(url: str) -> tuple:
+    u = urlparse(url)
+    db = int(u.path.lstrip("/") or 0)
+    return u.hostname or "127.0.0.1", u.port or 6379, u.password, db
+
+class _RespClient:
+    """Thread'ler arası paylaşılan, kilitli, senkron RESP2 istemcisi."""
+
+    def __init__(self, url: str):
+        self.host, self.port, self.password, self.db = _parse_redis_url(url)
+        self._lock = threading.Lock()
+        self._sock = None
+        self._file = None
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=5)
+        self._file = self._sock.makefile("rb")
+        if self.password:
+            self._roundtrip(("AUTH", self.password))
+        if self.db:
+            self._roundtrip(("SELECT", self.db))
+
+    def _read(self):
+        t, v = _resp_parse_line(self._file.readline())
+        if t == b"$":
+            if v < 0:
+                return None
+            data = self._file.read(v + 2)
+            return data[:-2]
+        if t == b"*":
+            return None if v < 0 else [self._read() for _ in range(v)]
+        return v
+
+    def _roundtrip(self, args):
+        self._sock.sendall(_resp_encode(args))
+        return self._read()
+
+    def execute(self, *args):
+        with self._lock:
+            for attempt in (0, 1):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._roundtrip(args)
+                except (OSError, ConnectionError):
+                    self.close()
+                    if attempt:
+                        raise
+
+    def close(self):
+        try:
+            if self._sock:
+                self._sock.close()
+        except OSError:
+            pass
+        self._sock = None
+        self._file = None
+
+class _AsyncRespConnection:
+    """Event loop içinde kullanılan tek bağlantı (abonelik veya yayın için)."""
+
+    def __init__(self, url: str):
+        self.host, self.port, self.password, self.db = _parse_redis_url(url)
+        self.reader = None
+        self.writer = None
+        self._lock = asyncio.Lock()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self.execute("AUTH", self.password)
+        if self.db:
+            await self.execute("SELECT", self.db)
+        return self
+
+    async def read(self):
+        t, v = _resp_parse_line(await self.reader.readline())
+        if t == b"$":
+            if v < 0:
+                return None
+            return (await self.reader.readexactly(v + 2))[:-2]
+        if t == b"*":
+            return None if v < 0 else [await self.read() for _ in range(v)]
+        return v
+
+    async def send(self, *args):
+        self.writer.write(_resp_encode(args))
+        await self.writer.drain()
+
+    async def execute(self, *args):
+        async with self._lock:
+            await self.send(*args)
+            return await self.read()
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+_state_store: Optional[_RespClient] = None
+_state_listener_task: Optional[asyncio.Task] = None
+
+# ad → (koleksiyon, encode, decode, redis'te saklanır mı)
+# "saklanmayan" koleksiyonlar yalnızca yayınla çoğaltılır (ör. konum geçmişi —
+# kalıcı kopyası lider worker'ın snapshot'ında).
+_SHARED_COLLECTIONS: dict = {}
+
+_SHARED_HOOKS: dict = {}
+
+def _register_shared(name: str, coll: dict, encode=None, decode=None, stored: bool = True,
+                     on_change=None):
+    """on_change(key) — uzaktan gelen güncellemeden sonra türetilmiş indeksleri
+    tazelemek için; key=None koleksiyonun tamamı yenilendi demektir."""
+    _SHARED_COLLECTIONS[name] = (coll, encode or (lambda v: v), decode or (lambda v: v), stored)
+    if on_change:
+        _SHARED_HOOKS[name] = on_change
+
+def _state_key(name: str) -> str:
+    return f"konum:state:{name}"
+
+def _publish_state(msg: dict):
+    _state_store.execute("PUBLISH", _STATE_CHANNEL, json.dumps(msg, ensure_ascii=False))
+
+def _share(name: str, key: str):
+    """coll[key] değiştiyse (veya silindiyse) diğer worker'lara bildir."""
+    if _state_store is None:
+        return
+    coll, encode, _, stored = _SHARED_COLLECTIONS[name]
+    msg = {"w": _WORKER_ID, "c": name, "k": key}
+    try:
+        if key in coll:
+            msg["v"] = encode(coll[key])
+            if stored:
+                _state_store.execute("HSET", _state_key(name), key,
+                                     json.dumps(msg["v"], ensure_ascii=False))
+        else:
+            msg["d"] = True
+            if stored:
+                _state_store.execute("HDEL", _state_key(name), key)
+        _publish_state(msg)
+    except Exception as e:
+        print(f"❌ Ortak durum yazma hatası ({name}/{key}): {e}")
+
+def _share_append(name: str, key: str, item, maxlen: int = 0):
+    """Liste değerine tek eleman eklendi — tüm listeyi değil yalnızca elemanı yayınla."""
+    if _state_store is None:
+        return
+    coll, encode, _, stored = _SHARED_COLLECTIONS[name]
+    try:
+        if stored:
+            _state_store.execute("HSET", _state_key(name), key,
+                                 json.dumps(encode(coll.get(key, [])), ensure_ascii=False))
+        _publish_state({"w": _WORKER_ID, "c": name, "k": key, "a": item, "m": maxlen})
+    except Exception as e:
+        print(f"❌ Ortak durum yazma hatası ({name}/{key}): {e}")
+
+def _share_collection(name: str):
+    """Toplu değişiklik (ör. kullanıcı adı değişimi) — koleksiyonu baştan yaz."""
+    if _state_store is None:
+        return
+    coll, encode, _, stored = _SHARED_COLLECTIONS[name]
+    try:
+        if stored:
+            _write_shared_hash(name, coll, encode)
+            _publish_state({"w": _WORKER_ID, "c": name, "r": True})
+        else:
+            _publish_state({"w": _WORKER_ID, "c": name,
+                            "all": {k: encode(v) for k, v in coll.items()}})
+    except Exception as e:
+        print(f"❌ Ortak durum yazma hatası ({name}): {e}")
+
+def _write_shared_hash(name: str, coll: dict, encode):
+    _state_store.execute("DEL", _state_key(name))
+    items = list(coll.items())
+    for i in range(0, len(items), 500):
+        args = []
+        for k, v in items[i:i + 500]:
+            args += [k, json.dumps(encode(v), ensure_ascii=False)]
+        _state_store.execute("HSET", _state_key(name), *args)
+
+def _reload_shared(name: str):
+    coll, _, decode, stored = _SHARED_COLLECTIONS[name]
+    if not stored:
+        return
+    raw = _state_store.execute("HGETALL", _state_key(name)) or []
+    fresh = {}
+    for i in range(0, len(raw), 2):
+        try:
+            fresh[raw[i].decode("utf-8")] = decode(json.loads(raw[i + 1]))
+        except Exception:
+            pass
+    coll.clear()
+    coll.update(fresh)
+    if name in _SHARED_HOOKS:
+        _SHARED_HOOKS[name](None)
+
+def _apply_shared_update(msg: dict):
+    global _save_pending, _critical_save_pending
+    if msg.get("w") == _WORKER_ID or msg.get("c") not in _SHARED_COLLECTIONS:
+        return
+    name = msg["c"]
+    coll, _, decode, stored = _SHARED_COLLECTIONS[name]
+    if msg.get("r"):
+        _reload_shared(name)
+    elif "all" in msg:
+        coll.clear()
+        coll.update({k: decode(v) for k, v in msg["all"].items()})
+    else:
+        # Oda görünümlerinde tek anahtar değişikliği o odanın kilidi altında
+        lock = coll.lock_for(msg["k"]) if isinstance(coll, _RoomFieldView) else contextlib.nullcontext()
+        with lock:
+            if msg.get("d"):
+                coll.pop(msg["k"], None)
+            elif "a" in msg:
+                lst = coll.setdefault(msg["k"], [])
+                if isinstance(lst, MessageRing):
+                    lst.append_replicated(msg["a"])   # kaynaktaki seq korunur
+                else:
+                    lst.append(msg["a"])
+                    if msg.get("m") and len(lst) > msg["m"]:
+                        del lst[:-msg["m"]]
+            else:
+                coll[msg["k"]] = decode(msg["v"])
+    hook = _SHARED_HOOKS.get(name)
+    if hook and not msg.get("r"):   # "r" → _reload_shared kancayı zaten çağırdı
+        hook(None if "all" in msg else msg["k"])
+    # Lider worker diske yazabilsin diye kirli işaretle
+    if name == "location_history":
+        _save_pending = True
+    else:
+        _critical_save_pending = True
+
+def _is_persistence_leader() -> bool:
+    """Disk kaydı ve oda kapatma gibi tekil işleri yalnızca bir worker yapar."""
+    if _state_store is None:
         return True
+    try:
+        if _state_store.execute("SET", "konum:leader", _WORKER_ID, "NX", "EX", LEADER_TTL_SECS):
+            return True
+        holder = _state_store.execute("GET", "konum:leader")
+        if holder and holder.decode("utf-8") == _WORKER_ID:
+            _state_store.execute("EXPIRE", "konum:leader", LEADER_TTL_SECS)
+            return True
+    except Exception as e:
+        print(f"❌ Lider kontrol hatası: {e}")
     return False
 
+def _init_shared_state():
+    """Redis boşsa diskteki veriyle tohumla, doluysa yerel kopyayı Redis'ten yükle."""
+    global _state_store
+    if STATE_BACKEND != "redis":
+        return
+    _state_store = _RespClient(REDIS_URL)
+    if _state_store.execute("SET", "konum:seed-lock", _WORKER_ID, "NX", "EX", 30):
+        if not _state_store.execute("GET", "konum:seeded"):
+            for name, (coll, encode, _, stored) in _SHARED_COLLECTIONS.items():
+                if stored:
+                    _write_shared_hash(name, coll, encode)
+            _state_store.execute("SET", "konum:seeded", _WORKER_ID)
+            print(f"🔗 Ortak durum diskten tohumlandı (worker {_WORKER_ID})")
+    else:
+        # Başka bir worker tohumluyor — bitmesini bekle
+        for _ in range(100):
+            if _state_store.execute("GET", "konum:seeded"):
+                break
+            time.sleep(0.1)
+    for name in _SHARED_COLLECTIONS:
+        _reload_shared(name)
+    print(f"🔗 Ortak durum modu: redis ({REDIS_URL}), worker {_WORKER_ID}")
+
+async def _shared_state_listener():
+    """konum:state kanalına abone ol; koparsa yeniden bağlan ve tazele."""
+    first = True
+    while True:
+        sub = None
+        try:
+            sub = await _AsyncRespConnection(REDIS_URL).connect()
+            await sub.send("SUBSCRIBE", _STATE_CHANNEL)
+            if not first:
+                for name in _SHARED_COLLECTIONS:
+                    await _in_state_actor(_reload_shared, name)
+            first = False
+            while True:
+                frame = await sub.read()
+                if not isinstance(frame, list) or not frame:
+                    continue
+                if frame[0] == b"message":
+                    await _in_state_actor(_apply_shared_update, json.loads(frame[2]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Ortak durum aboneliği koptu: {e} — 2 sn sonra yeniden")
+            await asyncio.sleep(2)
+        finally:
+            if sub:
+                sub.close()
+
+_register_shared("rooms", rooms)
+_register_shared("locations", locations, on_change=_reindex_locations)
+_register_shared("messages", messages, on_change=_reindex_messages)
+_register_shared("room_messages", room_messages, encode=list)
+_register_shared("voice_messages", voice_messages)
+_register_shared("room_voice_messages", room_voice_messages)
+_register_shared("banned_users", banned_users)
+_register_shared("banned_devices", banned_devices)
+_register_shared("muted_users", muted_users)
+_register_shared("kicked_users", kicked_users)
+_register_shared("super_admin_sessions", _super_admin_sessions,
+                 encode=_session_to_json, decode=_session_from_json,
+                 on_change=_reindex_admin_sessions)
+_register_shared("location_history", location_history, stored=False,
+                 on_change=_fold_new_history)
+_register_shared("user_names", user_display_names, on_change=_reindex_user_names)
+_register_shared("visibility_settings", visibility_settings)
+_register_shared("fcm_tokens", fcm_tokens)
+_register_shared("user_geofences", user_geofences)
+_register_shared("walkie_queue", walkie_queue, stored=False)
+_register_shared("friend_requests", friend_requests,
+                 on_change=lambda key: _reindex_friend_requests())
+_register_shared("friends_map", friends_map, encode=sorted, decode=set)
+_register_shared("permission_requests", permission_requests,
+                 on_change=lambda key: _reindex_permission_requests())
+
+# ─── Oda durumu — alan başına bir görünüm ("room_<alan>") ───
+# Müzik yayını parça parça büyüdüğünden çoğaltılmaz; yayın başladığı worker'da
+# kalır. Mesajlar ve oda walkie kuyruğu eleman eklenerek yayınlanır (_share_append).
+_ROOM_SHARED_FIELDS = frozenset(RoomState.PERSISTENT_FIELDS + RoomState.VOLATILE_FIELDS) - {"music"}
+_ROOM_APPENDED_FIELDS = frozenset({"messages", "walkie_queue"})
+
+def _reindex_room_field(field: str):
+    """Uzaktan atanan alandan türetilen veriyi (sıralama, durak indeksi) kur."""
+    def on_change(room_name=None):
+        states = [_peek_room(room_name)] if room_name is not None else list(_room_states.values())
+        for st in filter(None, states):
+            with st.lock:
+                if field == "scores":
+                    st.rebuild_ranking()
+                else:
+                    st.stop_index.rebuild(st.transport_stops)
+    return on_change
+
+for _field in sorted(_ROOM_SHARED_FIELDS - {"messages"}):
+    _register_shared(f"room_{_field}",
+                     _RoomFieldView(_field, lambda f=_field: getattr(RoomState(""), f)),
+                     stored=_field != "walkie_queue",   # ses kaydı — yalnızca yayın
+                     on_change=(_reindex_room_field(_field)
+                                if _field in ("scores", "transport_stops") else None))
+
+def _share_room(room_name: str, fields):
+    """(Oda kilidi altında) değişen oda alanlarını diğer worker'lara bildir."""
+    for field in sorted(_ROOM_SHARED_FIELDS.intersection(fields)):
+        _share(f"room_{field}", room_name)
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# 🧭 KÜME MODU — oda bazlı sharding (consistent hashing)
+# ═══════════════════════════════════════════════════════════════════════════════
+# CLUSTER_NODES="http://n1:8000,http://n2:8000" ve CLUSTER_SELF="http://n1:8000"
+# verildiğinde her oda adı bir halka üzerinde tek bir sahip node'a düşer. Oda
+# kapsamlı HTTP çağrıları sahibe iletilir (proxy); oda sesli WebSocket'i ise
+# 4307 koduyla kapatılır ve sebep alanında sahibin adresi döner.
+# Node eklenip çıkarıldığında POST /cluster/nodes yeni listeyi yayar; her node
+# artık sahibi olmadığı odaları POST /cluster/handoff ile yeni sahibine devreder.
+# Devredilen yalnızca odaya ait veridir (oda kaydı ve RoomState); üyelerin
+# canlı konumu yeni sahibe kopyalanır ama kullanıcıya ait veri (konum geçmişi,
+# arşiv, trip_stats) kaydedildiği node'da kalır ve silinmez.
+CLUSTER_NODES  = [n.strip().rstrip("/") for n in os.getenv("CLUSTER_NODES", "").split(",") if n.strip()]
+CLUSTER_SELF   = os.getenv("CLUSTER_SELF", "").rstrip("/")
+CLUSTER_SECRET = os.getenv("CLUSTER_SECRET", "")
+CLUSTER_VNODES = 64
+CLUSTER_TIMEOUT_SECS = 10
+_FORWARDED_HEADER = "x-konum-forwarded"   # yalnızca geçerli X-Cluster-Secret ile birlikte güvenilir
+
+def _ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+class _HashRing:
+    """Sanal node'lu consistent hash halkası — node değişince yalnızca ~1/N oda taşınır."""
+
+    def __init__(self, nodes: list, vnodes: int = CLUSTER_VNODES):
+        self.nodes = sorted(set(nodes))
+        points = sorted((_ring_hash(f"{node}#{i}"), node)
+                        for node in self.nodes for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [n for _, n in points]
+
+    def owner(self, key: str) -> str:
+        i = bisect.bisect(self._hashes, _ring_hash(key)) % len(self._hashes)
+        return self._owners[i]
+
+if CLUSTER_NODES and CLUSTER_SELF and not CLUSTER_SECRET:
+    # Küme uçları oda/konum verisini üzerine yazar — sırsız açılamaz
+    raise RuntimeError("Küme modu için CLUSTER_SECRET gerekli")
+_ring: Optional[_HashRing] = _HashRing(CLUSTER_NODES) if CLUSTER_NODES and CLUSTER_SELF else None
+
+def _room_owner(room_name: str) -> Optional[str]:
+    """Oda başka bir node'a aitse o node'un adresi, değilse None."""
+    if _ring is None or not room_name:
+        return None
+    owner = _ring.owner(room_name)
+    return None if owner == CLUSTER_SELF else owner
+
+# Yol parametresinden oda adı alınan çağrılar
+_CLUSTER_PATH_ROUTE = re.compile(
+    r"^/(?:get_locations|nearby|heatmap|delete_room|resign_admin|get_room_password|change_room_password"
+    r"|get_room_permissions|set_collector_permission|set_voice_permission|kick_user"
+    r"|get_pins|get_scores|get_rank_events|get_collection_history|get_room_messages|get_room_messages_since"
+    r"|get_room_unread|mark_room_read|room_walkie_listen|get_sos|cancel_sos|music_status"
+    r"|music_listen|music_chunk_data|geofence/get|geofence/delete|get_shared_route"
+    r"|clear_shared_route|get_transport_status|get_transport_broadcast|transport_stops"
+    r"|transport_stop|transport_arrivals)/(?P<room>[^/]+)")
+# Gövdedeki roomName alanından oda adı alınan çağrılar
+_CLUSTER_BODY_ROUTES = {
+    "/update_location", "/join_room", "/rejoin_room", "/create_room", "/request_permission",
+    "/create_pin", "/send_room_message", "/send_room_voice_message", "/room_walkie_send",
+    "/sos_alert", "/music_start", "/music_chunk", "/music_stop", "/share_route",
+    "/geofence/save", "/geofence/entry", "/geofence/rename", "/set_transport_role",
+    "/transport_broadcast", "/transport_stop", "/transport_arrival",
+}
+_CLUSTER_WS_ROUTE = re.compile(r"^/ws/(?:voice/room|locations|transport)/(?P<room>[^/]+)")
+
+def _cluster_http(method: str, url: str, body: bytes = None, headers: dict = None) -> tuple:
+    """Bloklayan HTTP çağrısı — (status, başlıklar, gövde)."""
+    req = urllib.request.Request(url, data=body, method=method, headers=headers or {})
+    try:
+        with urllib.request.urlopen(req, timeout=CLUSTER_TIMEOUT_SECS) as resp:
+            return resp.status, resp.getheaders(), resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers.items(), e.read()
+
+def _cluster_post_json(node: str, path: str, payload: dict) -> tuple:
+    return _cluster_http("POST", node + path,
+                         json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+                         {"Content-Type": "application/json",
+                          "X-Cluster-Secret": CLUSTER_SECRET,
+                          _FORWARDED_HEADER: CLUSTER_SELF})
+
+def _cluster_secret_ok(given: str) -> bool:
+    return bool(CLUSTER_SECRET) and hmac.compare_digest(given.encode("utf-8"),
+                                                        CLUSTER_SECRET.encode("utf-8"))
+
+# ─── İsim eşlemesi yayını ───
+# user_display_names her node'da ayrı tutulur; bir node'daki her değişiklik
+# sırasıyla biriktirilip diğer node'lara tek parti halinde gönderilir. Aynı
+# anda tek gönderim yapılır, böylece "eski sahibi isim~1'e geç, yeni sahibe
+# ismi ver" sırası karşı tarafta da korunur.
+_name_sync_pending: dict = {}   # uid → isim (ekleme sırasıyla)
+_name_sync_lock = threading.Lock()
+_name_sync_send: Optional[asyncio.Lock] = None
+
+def _cluster_sync_name(uid: str, name: str):
+    if _ring is None or _event_loop is None:
+        return
+    with _name_sync_lock:
+        _name_sync_pending.pop(uid, None)
+        _name_sync_pending[uid] = name
+    _event_loop.call_soon_threadsafe(lambda: asyncio.ensure_future(_flush_name_sync()))
+
+async def _flush_name_sync(nodes: Optional[list] = None, names: Optional[dict] = None):
+    global _name_sync_send
+    if _name_sync_send is None:
+        _name_sync_send = asyncio.Lock()
+    async with _name_sync_send:
+        if names is None:
+            with _name_sync_lock:
+                names = dict(_name_sync_pending)
+                _name_sync_pending.clear()
+        if not names or _ring is None:
+            return
+        for node in nodes or _ring.nodes:
+            if node == CLUSTER_SELF:
+                continue
+            try:
+                status, _, _ = await asyncio.to_thread(_cluster_post_json, node, "/cluster/names",
+                                                       {"names": names})
+                if status != 200:
+                    print(f"❌ İsim eşlemesi reddedildi ({node}): {status}")
+            except Exception as e:
+                print(f"❌ İsim eşlemesi gönderilemedi ({node}): {e}")
+
+class _ClusterRouter:
+    """Oda kapsamlı istekleri sahibine ileten ASGI ara katmanı."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        forwarded = _FORWARDED_HEADER in headers
+        if forwarded and not _cluster_secret_ok(headers.get("x-cluster-secret", "")):
+            # İstemcinin eklediği iletim başlığı — atılır, istek normal yönlendirilir
+            forwarded = False
+            del headers[_FORWARDED_HEADER]
+            scope = {**scope, "headers": [(k, v) for k, v in scope["headers"]
+                                          if k.decode("latin-1").lower() != _FORWARDED_HEADER]}
+        # Zaten iletilmiş istek → döngüye girmemek için yerelde işle
+        if _ring is None or forwarded:
+            return await self.app(scope, receive, send)
+        path = scope["path"]
+        if scope["type"] == "websocket":
+            m = _CLUSTER_WS_ROUTE.match(path)
+            owner = _room_owner(m.group("room")) if m else None
+            if owner is None:
+                return await self.app(scope, receive, send)
+            await receive()   # websocket.connect
+            await send({"type": "websocket.accept"})
+            ws_url = owner.replace("http", "ws", 1) + path
+            await send({"type": "websocket.close", "code": 4307, "reason": ws_url[:120]})
+            return
+        body, more = b"", True
+        while more:
+            msg = await receive()
+            body += msg.get("body", b"")
+            more = msg.get("more_body", False)
+        room = None
+        m = _CLUSTER_PATH_ROUTE.match(path)
+        if m:
+            room = m.group("room")
+        elif path in _CLUSTER_BODY_ROUTES and body:
+            try:
+                room = json.loads(body).get("roomName", "Genel")
+            except Exception:
+                room = None
+        elif path in _CLUSTER_BODY_ROUTES:
+            room = "Genel"
+        owner = _room_owner(room) if room else None
+        if owner is None:
+            replayed = False
+            async def replay():
+                nonlocal replayed
+                if not replayed:
+                    replayed = True
+                    return {"type": "http.request", "body": body, "more_body": False}
+                return await receive()
+            return await self.app(scope, replay, send)
+        raw_path = scope.get("raw_path") or quote(path).encode("ascii")
+        url = owner + raw_path.decode("ascii")
+        if scope.get("query_string"):
+            url += "?" + scope["query_string"].decode("latin-1")
+        fwd_headers = {k: v for k, v in headers.items()
+                       if k not in ("host", "content-length", "connection")}
+        fwd_headers[_FORWARDED_HEADER] = CLUSTER_SELF
+        fwd_headers["x-cluster-secret"] = CLUSTER_SECRET
+        try:
+            status, resp_headers, resp_body = await asyncio.to_thread(
+                _cluster_http, scope["method"], url, body or None, fwd_headers)
+        except Exception as e:
+            print(f"❌ Küme iletme hatası ({owner}): {e}")
+            status, resp_headers = 503, [("content-type", "application/json; charset=utf-8")]
+            resp_body = json.dumps({"detail": "Oda sunucusuna ulaşılamadı"},
+                                   ensure_ascii=False).encode("utf-8")
+        skip = {"content-length", "transfer-encoding", "connection", "server", "date"}
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(k.lower().encode("latin-1"), v.encode("latin-1"))
+                                for k, v in resp_headers if k.lower() not in skip]
+                               + [(b"content-length", str(len(resp_body)).encode())]})
+        await send({"type": "http.response.body", "body": resp_body})
+
+app.add_middleware(_ClusterRouter)
+
+def _local_room_names() -> set:
+    return set(rooms) | set(_room_states)
+
+def _export_room_state(room_name: str) -> dict:
+    """Bir odanın bu node'daki verisini devir için topla (üyelerin canlı konumu
+    kopya olarak eklenir; geçmişleri burada kalır)."""
+    members = [uid for uid, u in locations.items() if u.get("roomName") == room_name]
+    st = _peek_room(room_name)
+    return {
+        "room":                 rooms.get(room_name),
+        "locations":            {uid: locations[uid] for uid in members},
+        "state":                st.to_json(volatile=True) if st else {},
+    }
+
+def _import_room_state(room_name: str, state: dict):
+    """Devralınan oda verisini yerel koleksiyonlara birleştir."""
+    global _critical_save_pending
+    if state.get("room") is not None:
+        rooms[room_name] = state["room"]
+        _share("rooms", room_name)
+    for uid, loc in state.get("locations", {}).items():
+        # Kullanıcı bu arada buraya yeni konum gönderdiyse onu koru
+        if uid not in locations or locations[uid].get("lastSeen", "") < loc.get("lastSeen", ""):
+            locations[uid] = loc
+            _share("locations", uid)
+            _place_location(uid)
+    if state.get("state"):
+        st = room_state(room_name)
+        with st.lock:
+            st.merge(state["state"])
+            _share_room(room_name, _ROOM_SHARED_FIELDS)
+    _critical_save_pending = True
+
+def _drop_room_state(room_name: str):
+    """Devredilen odanın bu node'daki oda verisini sil. Kullanıcı verisine
+    (konum, geçmiş, arşiv, trip_stats) dokunulmaz."""
+    rooms.pop(room_name, None)
+    _share("rooms", room_name)
+    _drop_room(room_name)
+    _heat_drop(room_name)
+    _share_room(room_name, _ROOM_SHARED_FIELDS)
+
+async def _rebalance_rooms() -> dict:
+    """Artık bu node'a ait olmayan odaları yeni sahiplerine devret.
+    Durum aktörde okunur/silinir, ağ isteği aktör dışında yapılır."""
+    moved, failed = [], []
+    for room_name in sorted(await _in_state_actor(_local_room_names)):
+        owner = _room_owner(room_name)
+        if owner is None:
+            continue
+        try:
+            state = await _in_state_actor(_export_room_state, room_name)
+            status, _, _ = await asyncio.to_thread(_cluster_post_json, owner, "/cluster/handoff",
+                                                   {"roomName": room_name, "state": state})
+            if status == 200:
+                await _in_state_actor(_drop_room_state, room_name)
+                moved.append(room_name)
+            else:
+                failed.append(room_name)
+        except Exception as e:
+            print(f"❌ Oda devri başarısız ({room_name} → {owner}): {e}")
+            failed.append(room_name)
+    if moved:
+        print(f"🔀 {len(moved)} oda devredildi")
+    return {"moved": moved, "failed": failed}
+
+def _check_cluster_secret(request: Request, require_ring: bool = True):
+    """Küme uçları yalnızca küme modunda (ya da /cluster/nodes için CLUSTER_SELF
+    verilmişken) ve CLUSTER_SECRET tanımlıyken vardır; tek node'da 404 döner."""
+    if not CLUSTER_SECRET or (_ring is None if require_ring else not CLUSTER_SELF):
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not _cluster_secret_ok(request.headers.get("X-Cluster-Secret", "")):
+        raise HTTPException(status_code=403, detail="Yetkisiz")
+
+@app.get("/cluster/status")
+@_raw_user_ids
+def cluster_status(request: Request):
+    _check_cluster_secret(request)
+    return {
+        "enabled": _ring is not None,
+        "self": CLUSTER_SELF,
+        "nodes": _ring.nodes if _ring else [],
+        "localRooms": sorted(_local_room_names()),
+    }
+
+@app.post("/cluster/nodes")
+@_raw_user_ids
+async def cluster_set_nodes(request: Request, data: dict):
+    """Küme üyeliğini değiştir: yeni listeyi diğer node'lara yay ve odaları devret."""
+    global _ring
+    _check_cluster_secret(request, require_ring=False)
+    nodes = [n.strip().rstrip("/") for n in data.get("nodes", []) if n.strip()]
+    if not CLUSTER_SELF or not nodes:
+        raise HTTPException(status_code=400, detail="CLUSTER_SELF ve nodes gerekli")
+    old_nodes = _ring.nodes if _ring else []
+    _ring = _HashRing(nodes)
+    if data.get("propagate", True):
+        for node in set(old_nodes) | set(nodes):
+            if node == CLUSTER_SELF:
+                continue
+            try:
+                await asyncio.to_thread(_cluster_post_json, node, "/cluster/nodes",
+                                        {"nodes": nodes, "propagate": False})
+            except Exception as e:
+                print(f"❌ Küme üyeliği yayılamadı ({node}): {e}")
+    # Yeni katılan node'lar isim eşlemesinin tamamını alsın
+    new_nodes = [n for n in nodes if n not in old_nodes]
+    if new_nodes:
+        await _flush_name_sync(new_nodes, await _in_state_actor(dict, user_display_names))
+    result = await _rebalance_rooms()
+    return {"nodes": _ring.nodes, **result}
+
+@app.post("/cluster/names")
+@_raw_user_ids
+def cluster_names(request: Request, data: dict):
+    """Başka node'daki isim ↔ uid değişikliklerini sırasıyla uygula (yeniden yaymadan)."""
+    _check_cluster_secret(request)
+    with _user_names_lock:
+        for uid, name in (data.get("names") or {}).items():
+            if isinstance(uid, str) and isinstance(name, str) and uid and name:
+                _set_display_name(uid, name, replicate=False)
+    return {"ok": True}
+
+@app.post("/cluster/handoff")
+@_raw_user_ids
+def cluster_handoff(request: Request, data: dict):
+    _check_cluster_secret(request)
+    room_name = data.get("roomName", "")
+    if not room_name:
+        raise HTTPException(status_code=400, detail="roomName gerekli")
+    _import_room_state(room_name, data.get("state", {}))
+    return {"ok": True}
+
+def _cluster_peer_rooms(user_id: str) -> list:
+    """Küme modunda diğer node'lardaki odaları da listeye kat."""
+    result = []
+    for node in (_ring.nodes if _ring else []):
+        if node == CLUSTER_SELF:
+            continue
+        try:
+            status, _, body = _cluster_http(
+                "GET", f"{node}/get_rooms?user_id={quote(user_id)}",
+                headers={_FORWARDED_HEADER: CLUSTER_SELF, "X-Cluster-Secret": CLUSTER_SECRET})
+            if status == 200:
+                result.extend(r for r in json.loads(body) if r.get("name") != "Genel")
+        except Exception as e:
+            print(f"❌ Oda listesi alınamadı ({node}): {e}")
+    return result
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # ⚙️ AYARLAR
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -376,6 +2853,7 @@ DEFAULT_TIMEZONE   = pytz.timezone('Europe/Istanbul')
 USER_TIMEOUT       = 180
 IDLE_THRESHOLD     = 15
 IDLE_TIME_MINUTES  = 15
+TRIP_GAP_SECS      = IDLE_TIME_MINUTES * 60   # bu kadar boşluk → yeni yolculuk
 SPEED_VEHICLE      = 30
 SPEED_RUN          = 15
 SPEED_WALK         = 3
@@ -383,13 +2861,24 @@ MIN_DIST_VEHICLE   = 50
 MIN_DIST_RUN       = 20
 MIN_DIST_WALK      = 10
 MIN_DIST_IDLE      = 5
+GPS_DEFAULT_ACCURACY = 15     # m — istemci accuracy göndermezse
+GPS_MIN_ACCURACY     = 3      # m — aşırı iyimser accuracy değerlerine karşı
+GPS_MIN_PROCESS_SPEED = 1.0   # m/s — süzgecin hareket varsayımı (duran cihaz için)
+GPS_SPEED_NOISE_FACTOR = 3    # hareket belirsizliği = bildirilen hız × bu katsayı
+GPS_MAX_SPEED        = 70     # m/s (~250 km/h) — üstündeki sıçrama aykırı sayılır
+GPS_MAX_REJECTS      = 3      # art arda bu kadar aykırıdan sonra yeni konum kabul edilir
 MAX_POINTS_PER_USER = 5000
 MAX_HISTORY_DAYS   = 90
+ROUTE_CLEANUP_INTERVAL_SECS = 60   # tüm geçmişte gün sınırı taraması en sık bu kadar
 PIN_COLLECT_START  = 20
 PIN_COLLECT_END    = 25
 MAX_ROOM_MESSAGES  = 200
 MAX_WALKIE_QUEUE   = 20
+MAX_RANK_EVENTS    = 50
+MAX_TRANSPORT_ARRIVALS = 50
 MAX_VOICE_MESSAGES = 500
+CONVERSATION_PAGE_SIZE = 100   # get_conversation sayfa boyu (before verilip limit verilmezse)
+MAX_CONVERSATION_PAGE  = 500
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # 🛠️ YARDIMCI FONKSİYONLAR
@@ -405,6 +2894,75 @@ def haversine(lat1, lng1, lat2, lng2):
     a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlng/2)**2
     return R * 2 * atan2(sqrt(a), sqrt(1-a))
 
+# ─── Toplu mesafe çekirdeği ───────────────────────────────────────────────────
+# Bir noktanın çok sayıda noktaya uzaklığı (pinler, geofence'ler, yakındakiler).
+# NumPy varsa tek vektör işlemiyle, yoksa aynı formülle saf Python döngüsünde.
+# Küçük partilerde dizi kurma maliyeti hesaplamadan büyük olduğundan NumPy ancak
+# DISTANCE_NUMPY_MIN_BATCH adayın üstünde devreye girer (bkz. _bench_distances).
+try:
+    import numpy as _np
+except ImportError:          # numpy yoksa skaler döngüyle devam
+    _np = None
+
+EARTH_RADIUS_M = 6371000
+DISTANCE_NUMPY_MIN_BATCH = 32
+
+def haversine_many(lat: float, lng: float, lats, lngs) -> list:
+    """(lat, lng) noktasının her (lats[i], lngs[i]) noktasına büyük çember uzaklığı (m)."""
+    if _np is not None and len(lats) >= DISTANCE_NUMPY_MIN_BATCH:
+        lat2 = _np.radians(_np.asarray(lats, dtype=_np.float64))
+        dlng = _np.radians(_np.asarray(lngs, dtype=_np.float64) - lng)
+        lat1 = radians(lat)
+        a = _np.sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * _np.cos(lat2) * _np.sin(dlng / 2) ** 2
+        return (2 * EARTH_RADIUS_M * _np.arcsin(_np.sqrt(_np.minimum(a, 1.0)))).tolist()
+    return [haversine(lat, lng, la, ln) for la, ln in zip(lats, lngs)]
+
+EQUIRECT_SLACK = 1.01   # equirect_many ile elemede pay (NEARBY_MAX_RADIUS_M'de hata ≪ %1)
+
+def equirect_many(lat: float, lng: float, lats, lngs) -> list:
+    """Eşdikdörtgen yaklaşımı (m) — birkaç km'ye kadar haversine ile ~%0.1 içinde,
+    trigonometri nokta başına yalnızca bir kosinüs. Aday elemek için: yarıçap ×
+    EQUIRECT_SLACK dışındakiler atılır, kalanlar haversine_many ile ölçülür."""
+    if _np is not None and len(lats) >= DISTANCE_NUMPY_MIN_BATCH:
+        lat2 = _np.asarray(lats, dtype=_np.float64)
+        x = _np.radians(_np.asarray(lngs, dtype=_np.float64) - lng) * _np.cos(_np.radians((lat2 + lat) / 2))
+        y = _np.radians(lat2 - lat)
+        return (EARTH_RADIUS_M * _np.hypot(x, y)).tolist()
+    result = []
+    for la, ln in zip(lats, lngs):
+        x = radians(ln - lng) * cos(radians((la + lat) / 2))
+        result.append(EARTH_RADIUS_M * sqrt(x * x + radians(la - lat) ** 2))
+    return result
+
+def _bench_distances(sizes=(10, 1_000, 100_000), rounds: int = 5):
+    """Mikro ölçüm: `python server.py bench-distances`. Her boyut için skaler döngü
+    ve NumPy yolunun saniyede işlediği aday sayısını yazar."""
+    import random
+    global DISTANCE_NUMPY_MIN_BATCH
+    saved = DISTANCE_NUMPY_MIN_BATCH
+    rnd = random.Random(42)
+    try:
+        for n in sizes:
+            lats = [41.0 + rnd.uniform(-0.5, 0.5) for _ in range(n)]
+            lngs = [29.0 + rnd.uniform(-0.5, 0.5) for _ in range(n)]
+            line = [f"{n:>7} aday"]
+            for label, threshold in (("skaler", float("inf")), ("numpy", 0)):
+                if label == "numpy" and _np is None:
+                    line.append("numpy: kurulu değil")
+                    continue
+                DISTANCE_NUMPY_MIN_BATCH = threshold
+                for fn in (haversine_many, equirect_many):
+                    best = min(_timed(fn, 41.0, 29.0, lats, lngs) for _ in range(rounds))
+                    line.append(f"{label}/{fn.__name__}: {n / best / 1e6:8.2f} M/sn")
+            print(" | ".join(line))
+    finally:
+        DISTANCE_NUMPY_MIN_BATCH = saved
+
+def _timed(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
 def is_user_online(last_seen_str):
     try:
         last_seen = datetime.strptime(last_seen_str, "%Y-%m-%d %H:%M:%S")
@@ -426,20 +2984,32 @@ def _ago_text(last_seen_str):
     except:
         return "?"
 
-def cleanup_old_routes():
-    cutoff = datetime.now(DEFAULT_TIMEZONE) - timedelta(days=MAX_HISTORY_DAYS)
-    for uid in list(location_history.keys()):
-        history = location_history[uid]
-        history[:] = [
-            p for p in history
-            if datetime.strptime(p["timestamp"], "%Y-%m-%d %H:%M:%S").replace(
-                tzinfo=DEFAULT_TIMEZONE) > cutoff
-        ]
+_last_route_cleanup = 0.0
+
+def cleanup_old_routes(user_id: Optional[str] = None):
+    """user_id'nin geçmişini MAX_POINTS_PER_USER'a kırp; en fazla
+    ROUTE_CLEANUP_INTERVAL_SECS'te bir tüm kullanıcılardan MAX_HISTORY_DAYS'ten
+    eski noktaları at. Geçmiş kronolojik olduğundan eskiler baştan kesilir."""
+    global _last_route_cleanup
+    if user_id is not None and len(location_history.get(user_id, ())) > MAX_POINTS_PER_USER:
+        del location_history[user_id][:-MAX_POINTS_PER_USER]
+    if time.monotonic() - _last_route_cleanup < ROUTE_CLEANUP_INTERVAL_SECS:
+        return
+    _last_route_cleanup = time.monotonic()
+    cutoff = (datetime.now(DEFAULT_TIMEZONE)
+              - timedelta(days=MAX_HISTORY_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    for history in location_history.values():
+        if history and history[0]["timestamp"] <= cutoff:
+            del history[:bisect.bisect_right(history, cutoff, key=lambda p: p["timestamp"])]
         if len(history) > MAX_POINTS_PER_USER:
-            location_history[uid] = history[-MAX_POINTS_PER_USER:]
+            del history[:-MAX_POINTS_PER_USER]
 
 def get_conv_key(user1, user2):
-    return "_".join(sorted([user1, user2]))
+    """Sıralı [a, b] çiftinin JSON hali — isimde "_" olsa da belirsiz değil."""
+    return json.dumps(sorted([user1, user2]), ensure_ascii=False, separators=(",", ":"))
+
+def conv_users(key):
+    return json.loads(key)
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # 📋 VERİ MODELLERİ
@@ -453,6 +3023,7 @@ class LocationModel(BaseModel):
     lng: float
     altitude: float = 0
     speed: float = 0
+    accuracy: float = 0      # m (0 = bilinmiyor → GPS_DEFAULT_ACCURACY)
     animationType: str = "pulse"
     roomName: str = "Genel"
     character: str = "🧍"
@@ -615,7 +3186,7 @@ def root():
         "time": get_local_time(),
         "online_users": online_count,
         "total_rooms": len(rooms),
-        "total_pins": len(pins),
+        "total_pins": sum(len(st.pins) for st in list(_room_states.values())),
         "history_users": len(location_history),
         "history_points": total_pts,
         "data_dir": _DATA_DIR,
@@ -630,6 +3201,7 @@ def health():
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/create_room")
+@_claims_user_names
 def create_room(data: RoomModel):
     if data.roomName in rooms:
         raise HTTPException(status_code=400, detail="Bu oda adı zaten mevcut!")
@@ -644,10 +3216,12 @@ def create_room(data: RoomModel):
         "collectors": [],
         "voiceAllowed": [],
     }
+    _share("rooms", data.roomName)
     _critical_save_pending = True
     return {"message": f"✅ {data.roomName} odası oluşturuldu"}
 
 @app.post("/join_room")
+@_claims_user_names
 def join_room(data: JoinRoomModel):
     if data.roomName == "Genel":
         return {"message": "Genel odaya katıldınız"}
@@ -660,7 +3234,14 @@ def join_room(data: JoinRoomModel):
     return {"message": f"✅ {data.roomName} odasına katıldınız"}
 
 @app.get("/get_rooms")
-def get_rooms(user_id: str = ""):
+async def get_rooms(request: Request, user_id: str = ""):
+    result = await _in_state_actor(_local_rooms, user_id)
+    # Diğer node'lara istek aktörü bekletmesin
+    if _ring is not None and _FORWARDED_HEADER not in request.headers:
+        result.extend(await asyncio.to_thread(_cluster_peer_rooms, user_id))
+    return result
+
+def _local_rooms(user_id: str) -> list:
     result = [{
         "name": "Genel",
         "hasPassword": False,
@@ -686,6 +3267,7 @@ def get_rooms(user_id: str = ""):
     return result
 
 @app.post("/rejoin_room")
+@_claims_user_names
 def rejoin_room(data: dict):
     """Daha önce katılınan gruba şifre girmeden tekrar gir (oda yaratıcısı veya kayıtlı üye)."""
     room_name = data.get("roomName", "")
@@ -712,19 +3294,16 @@ def delete_room(room_name: str, admin_id: str, token: str = "", device_id: str =
     if not is_creator and not is_super_admin(admin_id, device_id, token):
         raise HTTPException(status_code=403, detail="Sadece admin silebilir!")
     del rooms[room_name]
+    _share("rooms", room_name)
     for uid in locations:
         if locations[uid].get("roomName") == room_name:
             locations[uid]["roomName"] = "Genel"
-    for pin_id in list(pins.keys()):
-        if pins[pin_id].get("roomName") == room_name:
-            del pins[pin_id]
-    for key in list(scores.keys()):
-        if key.startswith(f"{room_name}_"):
-            del scores[key]
-    if room_name in room_messages:
-        del room_messages[room_name]
-    if room_name in room_walkie_queue:
-        del room_walkie_queue[room_name]
+            _share("locations", uid)
+            _place_location(uid)
+    _drop_room(room_name)
+    _drop_room_permission_requests(room_name)
+    _heat_drop(room_name)
+    _share_room(room_name, _ROOM_SHARED_FIELDS)
     _critical_save_pending = True
     return {"message": f"✅ {room_name} odası silindi"}
 
@@ -746,28 +3325,28 @@ def resign_admin(room_name: str, admin_id: str, new_name: str = ""):
         for _ in range(10):
             suffix = "".join(random.choices(chars, k=4))
             candidate = f"misafir_{suffix}"
-            if candidate not in locations:
+            if _name_holder(candidate) not in locations:
                 final_name = candidate
                 break
         else:
             final_name = f"misafir_{random.randint(1000,9999)}"
 
     # İsim çakışması kontrolü
-    if final_name != admin_id and final_name in locations:
-        existing = locations[final_name]
+    holder = _name_holder(final_name)
+    if holder is not None and holder != admin_id and holder in locations:
+        existing = locations[holder]
         if is_user_online(existing.get("lastSeen", "")):
             raise HTTPException(status_code=400, detail="Bu isim zaten kullanımda!")
-        locations.pop(final_name, None)
+        locations.pop(holder, None)
+        _share("locations", holder)
+        _place_location(holder)
 
-    # Kullanıcı adını güncelle (konum, mesaj, puan vb.)
-    if admin_id in locations:
-        locations[final_name] = locations.pop(admin_id)
-        locations[final_name]["userId"] = final_name
-    if admin_id in location_history:
-        location_history[final_name] = location_history.pop(admin_id)
+    # Kullanıcı adını güncelle — veriler uid ile tutulduğu için yalnızca eşleme
+    _rename_user(admin_id, final_name)
 
     # Admin yetkisini kaldır
     rooms[room_name]["createdBy"] = None
+    _share("rooms", room_name)
     _critical_save_pending = True
     return {"message": f"✅ Adminlik bırakıldı", "newName": final_name}
 
@@ -789,6 +3368,7 @@ def change_room_password(room_name: str, admin_id: str, new_password: str):
     if len(new_password) < 3:
         raise HTTPException(status_code=400, detail="Şifre en az 3 karakter!")
     rooms[room_name]["password"] = new_password
+    _share("rooms", room_name)
     _critical_save_pending = True
     return {"message": "✅ Şifre değiştirildi"}
 
@@ -797,6 +3377,7 @@ def change_room_password(room_name: str, admin_id: str, new_password: str):
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.get("/get_room_permissions/{room_name}")
+@_user_fields("admin")
 def get_room_permissions(room_name: str):
     if room_name == "Genel":
         return {"admin": None, "collectors": [], "voiceAllowed": []}
@@ -822,6 +3403,7 @@ def set_collector_permission(room_name: str, target_user: str, admin_id: str, en
     elif not enabled and target_user in collectors:
         collectors.remove(target_user)
     rooms[room_name]["collectors"] = collectors
+    _share("rooms", room_name)
     _critical_save_pending = True
     return {"message": "✅ Yetki güncellendi", "collectors": collectors}
 
@@ -838,15 +3420,82 @@ def set_voice_permission(room_name: str, target_user: str, admin_id: str, enable
     elif not enabled and target_user in voice_allowed:
         voice_allowed.remove(target_user)
     rooms[room_name]["voiceAllowed"] = voice_allowed
+    _share("rooms", room_name)
     _critical_save_pending = True
     return {"message": "✅ Ses yetkisi güncellendi", "voiceAllowed": voice_allowed}
 
+def _reindex_permission_requests():
+    _perm_pending_by_room.clear(); _perm_by_requester.clear(); _perm_resolved.clear()
+    resolved = []
+    for req_id, req in permission_requests.items():
+        _perm_by_requester.setdefault(req["requesterUserId"], set()).add(req_id)
+        if req["status"] == "pending":
+            _perm_pending_by_room.setdefault(req["roomName"], set()).add(req_id)
+        else:
+            # Eski kayıtlarda resolvedAt yok — istek zamanını kullan
+            resolved.append((req.get("resolvedAt") or req.get("timestamp", ""), req_id))
+    for _, req_id in sorted(resolved):
+        _record_resolved_permission(req_id)
+
+def _record_resolved_permission(req_id: str):
+    """Yanıtlanan isteği oda geçmişine ekle; sınırı aşan en eskiyi sil."""
+    history = _perm_resolved.setdefault(permission_requests[req_id]["roomName"], deque())
+    history.append(req_id)
+    while len(history) > PERMISSION_HISTORY_PER_ROOM:
+        _forget_permission_request(history.popleft())
+
+def _forget_permission_request(req_id: str):
+    req = permission_requests.pop(req_id, None)
+    if req is None:
+        return
+    _share("permission_requests", req_id)
+    for index, key in ((_perm_by_requester, req["requesterUserId"]),
+                       (_perm_pending_by_room, req["roomName"])):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(req_id)
+            if not ids:
+                del index[key]
+    _mark_critical_dirty("permission_requests")
+
+def _drop_room_permission_requests(room_name: str):
+    """Silinen odanın bekleyen ve geçmiş isteklerini bırak."""
+    for req_id in (list(_perm_pending_by_room.get(room_name, ()))
+                   + list(_perm_resolved.pop(room_name, ()))):
+        _forget_permission_request(req_id)
+
+def _pending_for_admin(user_id: str) -> list:
+    admin_rooms = [name for name, room in rooms.items() if room.get("createdBy") == user_id]
+    return [permission_requests[req_id]
+            for name in admin_rooms for req_id in _perm_pending_by_room.get(name, ())]
+
+def _can_watch_permissions(user_id: str, device_id: str, token: str) -> bool:
+    """İzin paneli aboneliği: kullanıcı adı tek başına yetmez."""
+    if has_admin_session(user_id) and is_super_admin(user_id, device_id, token):
+        return True
+    owns_room = any(room.get("createdBy") == user_id for room in rooms.values())
+    return owns_room and bool(device_id) and device_id == locations.get(user_id, {}).get("deviceId")
+
+def _publish_event(channel: str, event: dict):
+    """(Aktörden) veriyoluna JSON olay yayınla — abonenin hangi worker'a bağlı
+    olduğundan bağımsız."""
+    if _event_loop is None:
+        return
+    payload = json.dumps(_render_user_ids(event), ensure_ascii=False).encode("utf-8")
+    asyncio.run_coroutine_threadsafe(_voice_bus.publish(channel, "", payload), _event_loop)
+
+def _push_to_room_admin(room_name: str, event: dict):
+    """(Aktörden) oda adminine bağlı panellere olay gönder."""
+    admin = rooms.get(room_name, {}).get("createdBy")
+    if admin:
+        _publish_event(f"perm:{admin}", event)
+
 @app.post("/request_permission")
 def request_permission(data: PermissionRequestModel):
     if data.roomName not in rooms:
         raise HTTPException(status_code=404, detail="Oda bulunamadı!")
     req_id = str(uuid.uuid4())[:8]
-    permission_requests[req_id] = {
+    req = permission_requests[req_id] = {
         "requestId": req_id,
         "roomName": data.roomName,
         "requesterUserId": data.requesterUserId,
@@ -855,11 +3504,15 @@ def request_permission(data: PermissionRequestModel):
         "status": "pending",
         "timestamp": get_local_time(),
     }
+    _perm_pending_by_room.setdefault(data.roomName, set()).add(req_id)
+    _perm_by_requester.setdefault(data.requesterUserId, set()).add(req_id)
+    _share("permission_requests", req_id)
+    _mark_critical_dirty("permission_requests")
+    _push_to_room_admin(data.roomName, {"type": "new", "request": req})
     return {"requestId": req_id, "message": "✅ İstek gönderildi"}
 
 @app.post("/respond_permission")
 def respond_permission(data: PermissionRespondModel):
-    global _critical_save_pending
     if data.requestId not in permission_requests:
         raise HTTPException(status_code=404, detail="İstek bulunamadı!")
     req = permission_requests[data.requestId]
@@ -868,7 +3521,21 @@ def respond_permission(data: PermissionRespondModel):
         raise HTTPException(status_code=404, detail="Oda bulunamadı!")
     if rooms[room_name]["createdBy"] != data.adminUserId:
         raise HTTPException(status_code=403, detail="Sadece admin yanıtlayabilir!")
+    was_pending = req["status"] == "pending"
     req["status"] = "approved" if data.approved else "rejected"
+    _share("permission_requests", data.requestId)
+    _mark_critical_dirty("permission_requests")
+    if was_pending:
+        pending = _perm_pending_by_room.get(room_name, set())
+        pending.discard(data.requestId)
+        if not pending:
+            _perm_pending_by_room.pop(room_name, None)
+        req["resolvedAt"] = get_local_time()
+        _share("permission_requests", data.requestId)
+        _record_resolved_permission(data.requestId)
+        # Adminin diğer cihazlarındaki panel de isteği listeden düşsün
+        _push_to_room_admin(room_name, {"type": "resolved", "requestId": data.requestId,
+                                        "status": req["status"]})
     if data.approved:
         ptype = req["permissionType"]
         uid = req["requesterUserId"]
@@ -882,22 +3549,44 @@ def respond_permission(data: PermissionRespondModel):
             if uid not in voice_allowed:
                 voice_allowed.append(uid)
             rooms[room_name]["voiceAllowed"] = voice_allowed
-    _critical_save_pending = True
+        _share("rooms", room_name)
+        _mark_critical_dirty("rooms")
     return {"message": "✅ Yanıt kaydedildi", "approved": data.approved}
 
 @app.get("/get_pending_requests/{user_id}")
 def get_pending_requests(user_id: str):
-    result = []
-    for req in permission_requests.values():
-        room_name = req["roomName"]
-        is_admin = room_name in rooms and rooms[room_name]["createdBy"] == user_id
-        is_own = req["requesterUserId"] == user_id
-        if is_admin and req["status"] == "pending":
-            result.append(req)
-        elif is_own:
-            result.append(req)
+    """Yönettiği odalara gelen bekleyen istekler + kendi istekleri (yanıtlananlar
+    oda geçmişinde tutulduğu sürece)."""
+    result = _pending_for_admin(user_id)
+    seen = {req["requestId"] for req in result}
+    result += [permission_requests[req_id] for req_id in _perm_by_requester.get(user_id, ())
+               if req_id not in seen]
+    result.sort(key=lambda req: req["timestamp"])
     return result
 
+@app.websocket("/ws/permission_requests/{user_id}")
+async def ws_permission_requests(ws: WebSocket, user_id: str,
+                                 device_id: str = "", token: str = ""):
+    """Admin paneli — bağlanınca bekleyen istekler ({"type":"pending"}), sonra
+    yeni istek ({"type":"new"}) ve yanıt ({"type":"resolved"}) olayları anlık gelir.
+    Yalnızca oturumu açık süper admin (token) ya da oda yaratıcısının kayıtlı
+    cihazı (device_id) abone olabilir; diğerleri el sıkışmada reddedilir."""
+    uid = await _in_state_actor(user_id_of, user_id)
+    if not await _in_state_actor(_can_watch_permissions, uid, device_id, token):
+        await ws.close(code=4403)
+        return
+    await ws.accept()
+    _perm_request_ws[uid].add(ws)
+    try:
+        await ws.send_json(await _in_state_actor(
+            lambda: _render_user_ids({"type": "pending", "requests": _pending_for_admin(uid)})))
+        while True:
+            await ws.receive_text()   # istemciden mesaj beklenmez; kopmayı algılamak için
+    except WebSocketDisconnect:
+        pass
+    finally:
+        _perm_request_ws[uid].discard(ws)
+
 @app.get("/get_request_result/{request_id}/{user_id}")
 def get_request_result(request_id: str, user_id: str):
     if request_id not in permission_requests:
@@ -916,16 +3605,41 @@ def get_request_result(request_id: str, user_id: str):
 # 👥 ARKADAŞLIK SİSTEMİ
 # ═══════════════════════════════════════════════════════════════════════════════
 
+def _reindex_friend_requests():
+    _friend_pending_to.clear(); _friend_pending_pair.clear(); _friend_resolved.clear()
+    resolved = []
+    for req_id, req in friend_requests.items():
+        if req["status"] == "pending":
+            _friend_pending_to.setdefault(req["to"], set()).add(req_id)
+            _friend_pending_pair[(req["from"], req["to"])] = req_id
+        else:
+            # Eski kayıtlarda resolvedAt yok — istek zamanını kullan
+            resolved.append((req.get("resolvedAt") or req.get("timestamp", ""), req_id))
+    _friend_resolved.extend(sorted(resolved))
+    _expire_friend_requests()
+
+def _expire_friend_requests():
+    """Saklama süresini aşan kabul/red edilmiş istekleri sil."""
+    global _critical_save_pending
+    cutoff = (datetime.now(DEFAULT_TIMEZONE)
+              - timedelta(days=FRIEND_REQUEST_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    while _friend_resolved and _friend_resolved[0][0] < cutoff:
+        req_id = _friend_resolved.popleft()[1]
+        friend_requests.pop(req_id, None)
+        _share("friend_requests", req_id)
+        _critical_save_pending = True
+
 @app.post("/send_friend_request")
+@_user_fields("from", "to")
 def send_friend_request(data: FriendRequestModel):
     global _critical_save_pending
     # Zaten arkadaş mı?
-    if data.toUser in friends_map.get(data.fromUser, []):
+    if data.toUser in friends_map.get(data.fromUser, ()):
         raise HTTPException(status_code=400, detail="Zaten arkadaşsınız!")
     # Bekleyen istek var mı?
-    for req in friend_requests.values():
-        if req["from"] == data.fromUser and req["to"] == data.toUser and req["status"] == "pending":
-            raise HTTPException(status_code=400, detail="Zaten bekleyen bir isteğiniz var!")
+    if (data.fromUser, data.toUser) in _friend_pending_pair:
+        raise HTTPException(status_code=400, detail="Zaten bekleyen bir isteğiniz var!")
+    _expire_friend_requests()
     req_id = str(uuid.uuid4())[:8]
     friend_requests[req_id] = {
         "requestId": req_id,
@@ -934,17 +3648,22 @@ def send_friend_request(data: FriendRequestModel):
         "status":    "pending",
         "timestamp": get_local_time(),
     }
+    _friend_pending_to.setdefault(data.toUser, set()).add(req_id)
+    _friend_pending_pair[(data.fromUser, data.toUser)] = req_id
+    _share("friend_requests", req_id)
     _critical_save_pending = True
     return {"requestId": req_id, "message": "✅ Arkadaşlık isteği gönderildi"}
 
 @app.get("/get_friend_requests/{user_id}")
+@_user_fields("from", "to")
 def get_friend_requests(user_id: str):
     """user_id'ye gelen bekleyen istekler."""
-    result = [req for req in friend_requests.values()
-              if req["to"] == user_id and req["status"] == "pending"]
+    result = [friend_requests[req_id] for req_id in _friend_pending_to.get(user_id, ())]
+    result.sort(key=lambda req: req["timestamp"])
     return result
 
 @app.post("/respond_friend_request")
+@_user_fields("from", "to")
 def respond_friend_request(data: FriendRespondModel):
     global _critical_save_pending
     if data.requestId not in friend_requests:
@@ -952,20 +3671,51 @@ def respond_friend_request(data: FriendRespondModel):
     req = friend_requests[data.requestId]
     if req["to"] != data.toUser:
         raise HTTPException(status_code=403, detail="Bu istek size ait değil!")
+    if req["status"] == "pending":
+        pending = _friend_pending_to.get(req["to"], set())
+        pending.discard(data.requestId)
+        if not pending:
+            _friend_pending_to.pop(req["to"], None)
+        _friend_pending_pair.pop((req["from"], req["to"]), None)
+        req["resolvedAt"] = get_local_time()
+        _friend_resolved.append((req["resolvedAt"], data.requestId))
     req["status"] = "accepted" if data.accepted else "rejected"
+    _share("friend_requests", data.requestId)
     if data.accepted:
         a, b = req["from"], req["to"]
         # Her iki kullanıcının arkadaş listesine ekle
-        friends_map.setdefault(a, [])
-        friends_map.setdefault(b, [])
-        if b not in friends_map[a]: friends_map[a].append(b)
-        if a not in friends_map[b]: friends_map[b].append(a)
+        friends_map.setdefault(a, set()).add(b)
+        friends_map.setdefault(b, set()).add(a)
+        _share("friends_map", a); _share("friends_map", b)
+    _expire_friend_requests()
     _critical_save_pending = True
     return {"message": "✅ Yanıt kaydedildi", "accepted": data.accepted}
 
 @app.get("/get_friends/{user_id}")
 def get_friends(user_id: str):
-    return {"friends": friends_map.get(user_id, [])}
+    return {"friends": sorted(friends_map.get(user_id, ()))}
+
+@app.get("/get_friends_locations/{user_id}")
+def get_friends_locations(user_id: str, device_id: str = ""):
+    """Çevrimiçi tüm arkadaşların konumu tek çağrıda (get_locations ile aynı
+    görünürlük kuralları, bkz. _visible_to)."""
+    viewer_is_banned = _viewer_is_banned(user_id, device_id)
+    viewer_room = locations.get(user_id, {}).get("roomName", "Genel")
+    result = []
+    for uid in sorted(friends_map.get(user_id, ())):
+        data = locations.get(uid)
+        if not data or not _visible_to(viewer_room, viewer_is_banned, uid, data):
+            continue
+        result.append({
+            "userId": uid,
+            "lat": data["lat"], "lng": data["lng"],
+            "altitude": data.get("altitude", 0), "speed": data.get("speed", 0),
+            "roomName": data.get("roomName", "Genel"),
+            "character": data.get("character", "🧍"),
+            "idleStatus": data.get("idleStatus", "online"),
+            "lastSeen": data.get("lastSeen", ""),
+        })
+    return {"friends": result}
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # 👁️ GÖRÜNÜRLÜK
@@ -975,6 +3725,7 @@ def get_friends(user_id: str):
 def set_visibility(data: VisibilityModel):
     global _critical_save_pending
     visibility_settings[data.userId] = {"mode": data.mode, "allowed": data.allowed}
+    _share("visibility_settings", data.userId)
     _critical_save_pending = True
     return {"message": "✅ Görünürlük güncellendi"}
 
@@ -982,7 +3733,136 @@ def set_visibility(data: VisibilityModel):
 # 📍 KONUM
 # ═══════════════════════════════════════════════════════════════════════════════
 
+class GpsFilter:
+    """Kullanıcı başına GPS gürültü süzgeci. Önce hız makullüğü: son kabul
+    edilen noktadan GPS_MAX_SPEED ile bile ulaşılamayacak sıçrama atılır (art
+    arda GPS_MAX_REJECTS kez tekrarlanırsa gerçek yer değişimi sayılıp süzgeç
+    sıfırlanır). Sonra tek durumlu Kalman: belirsizlik geçen süre × hız² kadar
+    büyür, ölçüm accuracy² ağırlığıyla karıştırılır. Duran cihazın titreşimi
+    böylece birkaç metreye iner; hareket ettikçe süzgeç hızlanır."""
+
+    __slots__ = ("lat", "lng", "variance", "ts", "rejects")
+
+    def __init__(self):
+        self.lat = self.lng = None
+        self.variance = -1.0   # m² — negatif: henüz ölçüm yok
+        self.ts = 0.0
+        self.rejects = 0
+
+    def update(self, lat: float, lng: float, accuracy: float, speed: float,
+               ts: Optional[float] = None) -> Optional[tuple]:
+        """Süzülmüş (lat, lng) ya da aykırı nokta için None."""
+        ts = time.time() if ts is None else ts
+        accuracy = max(accuracy or GPS_DEFAULT_ACCURACY, GPS_MIN_ACCURACY)
+        if self.variance < 0 or self.rejects >= GPS_MAX_REJECTS:
+            self.lat, self.lng, self.variance, self.ts, self.rejects = lat, lng, accuracy ** 2, ts, 0
+            return lat, lng
+        dt = max(ts - self.ts, 0.0)
+        jump = haversine(self.lat, self.lng, lat, lng)
+        if jump > 2 * accuracy + sqrt(self.variance) + GPS_MAX_SPEED * dt:
+            self.rejects += 1
+            return None
+        self.rejects = 0
+        q = max((speed or 0) * GPS_SPEED_NOISE_FACTOR, GPS_MIN_PROCESS_SPEED)
+        self.variance += dt * q * q
+        gain = self.variance / (self.variance + accuracy ** 2)
+        self.lat += gain * (lat - self.lat)
+        self.lng += gain * (lng - self.lng)
+        self.variance *= 1 - gain
+        self.ts = ts
+        return self.lat, self.lng
+
+_gps_filters: dict = {}   # user_id → GpsFilter (RAM'de; yeniden başlatmada sıfırlanır)
+
+def _bench_gps(fixes: int = 360, dt: float = 5.0, noise: float = 8.0,
+               spike_rate: float = 0.02, spike: float = 400.0, seed: int = 7):
+    """Benzetimli iz: `python server.py bench-gps`. Duran / yürüyen / araçtaki
+    cihaz için dt aralıklı `fixes` ölçüm üretir (noise m Gauss gürültü,
+    spike_rate oranında spike m çok yollu sıçrama) ve ham ile süzülmüş konum
+    için geçmişe yazılan nokta / boşta sayacı sıfırlanması / medyan hatayı yazar."""
+    import random
+    rnd = random.Random(seed)
+    m_lat = 111320.0
+    m_lng = m_lat * cos(radians(41.0))
+    for kind, speed in (("duran", 0.0), ("yürüyen", 1.4), ("araç", 14.0)):
+        lat, lng, trace = 41.0, 29.0, []
+        for i in range(fixes):
+            if kind == "yürüyen":
+                lat += speed * dt / m_lat
+            elif kind == "araç":
+                lng += speed * dt / m_lng
+            mlat = lat + rnd.gauss(0, noise) / m_lat
+            mlng = lng + rnd.gauss(0, noise) / m_lng
+            if rnd.random() < spike_rate:
+                mlat += rnd.choice((-1, 1)) * spike / m_lat
+            reported = max(0.0, speed + rnd.gauss(0, 0.3)) if speed else 0.0
+            trace.append((mlat, mlng, reported, i * dt, lat, lng))
+        line = [f"{kind:>8}"]
+        for label, gps in (("ham", None), ("süzgeç", GpsFilter())):
+            stored, resets, errors, prev, last = 0, 0, [], None, None
+            for mlat, mlng, reported, ts, tlat, tlng in trace:
+                fix = gps.update(mlat, mlng, 0, reported, ts) if gps else (mlat, mlng)
+                if fix is None:
+                    continue
+                if prev is not None and haversine(*prev, *fix) >= IDLE_THRESHOLD:
+                    resets += 1
+                prev = fix
+                errors.append(haversine(fix[0], fix[1], tlat, tlng))
+                # update_location'daki geçmiş örnekleme eşikleri
+                if reported >= SPEED_VEHICLE:
+                    step = MIN_DIST_VEHICLE
+                elif reported >= SPEED_WALK:
+                    step = MIN_DIST_RUN
+                elif reported >= 0.5:
+                    step = MIN_DIST_WALK
+                else:
+                    step = MIN_DIST_IDLE
+                if last is None or haversine(*last, *fix) >= step:
+                    stored += 1
+                    last = fix
+            errors.sort()
+            line.append(f"{label}: {stored:>3} nokta / {resets:>3} sıfırlama / "
+                        f"medyan hata {errors[len(errors) // 2]:.1f} m")
+        print(" | ".join(line))
+
+def _collect_pins(st: RoomState, uid: str, lat: float, lng: float, now: str) -> bool:
+    """Pin toplama durumunu ilerlet (st.lock tutulurken çağrılır). Bir pin
+    değiştiyse True."""
+    candidates = [(pin_id, pin) for pin_id, pin in st.pins.items() if pin.get("creator") != uid]
+    if not candidates:
+        return False
+    changed = False
+    dists = haversine_many(lat, lng, [pin["lat"] for _, pin in candidates],
+                           [pin["lng"] for _, pin in candidates])
+    for (pin_id, pin), pin_dist in zip(candidates, dists):
+        if pin_dist <= PIN_COLLECT_START:
+            if pin.get("collectorId") is None:
+                pin["collectorId"] = uid
+                pin["collectionStart"] = now
+                pin["collectionTime"] = 0
+                changed = True
+            elif pin.get("collectorId") == uid:
+                try:
+                    start = datetime.strptime(pin["collectionStart"], "%Y-%m-%d %H:%M:%S")
+                    start = DEFAULT_TIMEZONE.localize(start)
+                    pin["collectionTime"] = int((datetime.now(DEFAULT_TIMEZONE) - start).total_seconds())
+                    changed = True
+                except:
+                    pass
+        elif pin_dist > PIN_COLLECT_END and pin.get("collectorId") == uid:
+            changed = True
+            st.add_score(uid, 1)
+            st.collection_history.setdefault(uid, []).append({
+                "timestamp": now,
+                "createdAt": pin.get("createdAt", ""),
+                "creator": pin.get("creator", ""),
+                "lat": pin["lat"], "lng": pin["lng"],
+            })
+            del st.pins[pin_id]
+    return changed
+
 @app.post("/update_location")
+@_claims_user_names
 def update_location(data: LocationModel):
     global _save_pending
     uid = data.userId
@@ -991,11 +3871,26 @@ def update_location(data: LocationModel):
     if uid in banned_users or (data.deviceId and data.deviceId in banned_devices):
         data.roomName = "Genel"
 
+    # Geçmiş ve boşta algılama ham konumu değil süzülmüşünü kullanır; aykırı
+    # nokta ikisine de ulaşmaz (canlı konum yine ham değerdir)
+    gps = _gps_filters.get(uid)
+    if gps is None:
+        gps = _gps_filters[uid] = GpsFilter()
+    prev_fix = (gps.lat, gps.lng)
+    fix = gps.update(data.lat, data.lng, data.accuracy, data.speed)
+
     idle_status = "online"
     idle_minutes = 0
-    if uid in locations:
+    if uid in locations and fix is None:
         old = locations[uid]
-        dist = haversine(old["lat"], old["lng"], data.lat, data.lng)
+        idle_start = old.get("idleStart")
+        idle_status = old.get("idleStatus", "online")
+        idle_minutes = old.get("idleMinutes", 0)
+    elif uid in locations:
+        old = locations[uid]
+        if prev_fix[0] is None:
+            prev_fix = (old["lat"], old["lng"])
+        dist = haversine(prev_fix[0], prev_fix[1], fix[0], fix[1])
         if dist < IDLE_THRESHOLD:
             idle_start = old.get("idleStart")
             if idle_start is None:
@@ -1017,16 +3912,16 @@ def update_location(data: LocationModel):
         idle_start = None
 
     should_add = False
-    if uid not in location_history:
+    if fix is not None and uid not in location_history:
         location_history[uid] = []
         should_add = True
-    else:
+    elif fix is not None:
         history = location_history[uid]
         if len(history) == 0:
             should_add = True
         else:
             last = history[-1]
-            dist = haversine(last["lat"], last["lng"], data.lat, data.lng)
+            dist = haversine(last["lat"], last["lng"], fix[0], fix[1])
             speed = data.speed
             if speed >= SPEED_VEHICLE:
                 should_add = dist >= MIN_DIST_VEHICLE
@@ -1038,11 +3933,15 @@ def update_location(data: LocationModel):
                 should_add = dist >= MIN_DIST_IDLE
 
     if should_add:
-        location_history[uid].append({
-            "lat": data.lat, "lng": data.lng,
+        point = {
+            "lat": fix[0], "lng": fix[1],
             "timestamp": now, "speed": data.speed,
-        })
-        cleanup_old_routes()
+        }
+        location_history[uid].append(point)
+        _share_append("location_history", uid, point, MAX_POINTS_PER_USER)
+        # locations[uid] henüz eski odayı gösteriyor — ısı hücresi yeni odaya
+        _fold_new_history(uid, room=data.roomName)
+        cleanup_old_routes(uid)
         _save_pending = True   # ← diske yaz işaretlendi
 
     if uid in locations:
@@ -1050,37 +3949,23 @@ def update_location(data: LocationModel):
         can_collect = False
         if room in rooms:
             can_collect = uid in rooms[room].get("collectors", [])
-        if can_collect:
-            for pin_id, pin in list(pins.items()):
-                if pin.get("roomName") != room or pin.get("creator") == uid:
-                    continue
-                pin_dist = haversine(data.lat, data.lng, pin["lat"], pin["lng"])
-                if pin_dist <= PIN_COLLECT_START:
-                    if pin.get("collectorId") is None:
-                        pins[pin_id]["collectorId"] = uid
-                        pins[pin_id]["collectionStart"] = now
-                        pins[pin_id]["collectionTime"] = 0
-                    elif pin.get("collectorId") == uid:
-                        try:
-                            start = datetime.strptime(pin["collectionStart"], "%Y-%m-%d %H:%M:%S")
-                            start = DEFAULT_TIMEZONE.localize(start)
-                            elapsed = int((datetime.now(DEFAULT_TIMEZONE) - start).total_seconds())
-                            pins[pin_id]["collectionTime"] = elapsed
-                        except:
-                            pass
-                elif pin_dist > PIN_COLLECT_END and pin.get("collectorId") == uid:
-                    score_key = f"{room}_{uid}"
-                    scores[score_key] = scores.get(score_key, 0) + 1
-                    hkey = f"{room}_{uid}"
-                    if hkey not in pin_collection_history:
-                        pin_collection_history[hkey] = []
-                    pin_collection_history[hkey].append({
-                        "timestamp": now,
-                        "createdAt": pin.get("createdAt", ""),
-                        "creator": pin.get("creator", ""),
-                        "lat": pin["lat"], "lng": pin["lng"],
-                    })
-                    del pins[pin_id]
+        st = _peek_room(room) if can_collect else None
+        if st is not None:
+            with st.lock:
+                if _collect_pins(st, uid, data.lat, data.lng, now):
+                    _share_room(room, ("pins", "scores", "collection_history", "rank_events"))
+                    _mark_critical_dirty("room_states")
+
+    # Transport: durak varış/ayrılışı ve ETA (süzülmüş konumla)
+    st = _peek_room(data.roomName) if fix is not None else None
+    if st is not None and uid in st.transport_roles:
+        with st.lock:
+            events = _track_transport(st, uid, fix[0], fix[1], data.character, now)
+            if any(event["type"] != "eta" for event in events):
+                _share_room(data.roomName, ("transport_visits", "transport_arrivals",
+                                            "transport_dwell", "transport_segments"))
+        for event in events:
+            _publish_event(f"transport:{data.roomName}", event)
 
     locations[uid] = {
         "userId": uid, "deviceId": data.deviceId, "deviceType": data.deviceType,
@@ -1091,62 +3976,219 @@ def update_location(data: LocationModel):
         "lastSeen": now, "idleStatus": idle_status,
         "idleMinutes": idle_minutes, "idleStart": idle_start,
     }
+    _share("locations", uid)
+    _place_location(uid)
     # Odada aktif üye var → lastActivity sıfırla
     if data.roomName != "Genel" and data.roomName in rooms:
         rooms[data.roomName]["lastActivity"] = now
+        _mark_critical_dirty("rooms")
     return {"status": "ok", "time": now}
 
+def _viewer_is_banned(viewer_id: str, device_id: str = "") -> bool:
+    return viewer_id in banned_users or bool(device_id and device_id in banned_devices)
+
+def _visible_to(viewer_room: str, viewer_is_banned: bool, uid: str, data: dict) -> bool:
+    """Konum listelerinin ortak görünürlük kuralları: çevrimdışı ve gizli kullanıcı
+    görünmez, "oda" modundaki kullanıcıyı yalnızca aynı odadakiler görür, banlı
+    kullanıcılar yalnızca birbirini görür."""
+    if not is_user_online(data.get("lastSeen", "")):
+        return False
+    if (uid in banned_users) != viewer_is_banned:
+        return False
+    mode = visibility_settings.get(uid, {"mode": "all"})["mode"]
+    if mode == "hidden":
+        return False
+    return mode != "room" or viewer_room == data.get("roomName")
+
+def _parse_bbox(bbox: str) -> list:
+    """"güney,batı,kuzey,doğu" → BBOX_MARGIN payıyla genişletilmiş kutular.
+    180. meridyeni kesen görünüm (batı > doğu) iki kutuya bölünür."""
+    try:
+        south, west, north, east = (float(v) for v in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox biçimi: güney,batı,kuzey,doğu")
+    if south > north:
+        raise HTTPException(status_code=400, detail="bbox: güney kuzeyden büyük olamaz")
+    width = (east - west) % 360 or 360
+    pad_lat = (north - south) * BBOX_MARGIN
+    pad_lng = min(width * BBOX_MARGIN, (360 - width) / 2)
+    south, north = max(south - pad_lat, -90.0), min(north + pad_lat, 90.0)
+    west, east = west - pad_lng, east + pad_lng
+    if width >= 360 or east - west >= 360:
+        return [(south, -180.0, north, 180.0)]
+    west = (west + 180) % 360 - 180
+    east = (east + 180) % 360 - 180
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+def _location_item(uid: str, data: dict, roles: dict) -> dict:
+    room_data = rooms.get(data.get("roomName", "Genel"), {})
+    is_creator   = bool(room_data.get("createdBy")) and room_data.get("createdBy") == uid
+    is_super_now = uid in _admin_tokens_by_user
+    is_room_admin = is_creator or is_super_now
+    return {
+        "userId": uid, "deviceId": data.get("deviceId", ""),
+        "lat": data["lat"], "lng": data["lng"],
+        "deviceType": data.get("deviceType", "phone"),
+        "altitude": data.get("altitude", 0), "speed": data.get("speed", 0),
+        "animationType": data.get("animationType", "pulse"),
+        "roomName": data.get("roomName", "Genel"),
+        "idleStatus": data.get("idleStatus", "online"),
+        "idleMinutes": data.get("idleMinutes", 0),
+        "character": data.get("character", "🧍"),
+        "isHidden": False,
+        "isRoomAdmin": is_room_admin,
+        "isSuperAdmin": is_super_now,
+        "permMsg": data.get("permMsg", "odadakiler"),
+        "permLocationHist": data.get("permLocationHist", "yonetici"),
+        "transportRole": roles.get(uid, {}).get("role", ""),
+    }
+
 @app.get("/get_locations/{room_name}")
-def get_locations(room_name: str, viewer_id: str = "", viewer_device_id: str = ""):
-    result = []
-    viewer_is_banned = viewer_id in banned_users or (
-        viewer_device_id and viewer_device_id in banned_devices
-    )
-    for uid, data in locations.items():
-        if uid == viewer_id:
-            continue
-        if not is_user_online(data.get("lastSeen", "")):
-            continue
-        if data.get("roomName") != room_name:
-            continue
-        uid_is_banned = uid in banned_users
-        if viewer_is_banned and not uid_is_banned:
-            continue
-        if not viewer_is_banned and uid_is_banned:
+def get_locations(room_name: str, viewer_id: str = "", viewer_device_id: str = "",
+                  bbox: str = "", zoom: Optional[int] = None):
+    """bbox="güney,batı,kuzey,doğu" verilirse yalnızca (payıyla genişletilmiş)
+    görünümdeki kullanıcılar döner; dışarıdakiler görünüm boyutunda hücrelere
+    sayı olarak toplanır: {"users": [...], "outside": [{lat, lng, count}]}.
+    zoom < CLUSTER_MAX_ZOOM ise yakın kullanıcılar "clusters" altında
+    {lat, lng, count} olarak birleşir; "users" yalnızca tek kalanları içerir."""
+    viewer_is_banned = _viewer_is_banned(viewer_id, viewer_device_id)
+    viewer_room = locations.get(viewer_id, {}).get("roomName", room_name)
+    room_st = _peek_room(room_name)
+    roles = room_st.transport_roles if room_st else {}
+    _expire_admin_sessions()
+
+    def visible(uid, data):
+        return (uid != viewer_id and data.get("roomName") == room_name
+                and _visible_to(viewer_room, viewer_is_banned, uid, data))
+
+    clustered = zoom is not None and zoom < CLUSTER_MAX_ZOOM
+
+    def render(uids):
+        if not clustered:
+            return {"users": [_location_item(uid, locations[uid], roles) for uid in uids]}
+        singles, clusters = _cluster([(*_loc_merc[uid], locations[uid]["lat"], locations[uid]["lng"], uid)
+                                      for uid in uids], zoom)
+        return {"users": [_location_item(uid, locations[uid], roles) for uid in singles],
+                "clusters": clusters}
+
+    if not bbox and clustered:
+        # Tüm oda: hazır küme hücrelerinden yalnızca görünürleri say
+        singles, clusters = [], []
+        for members in _room_cluster_cells(room_name, zoom).values():
+            shown = [uid for uid in members if uid in locations and visible(uid, locations[uid])]
+            if len(shown) == 1:
+                singles.append(shown[0])
+            elif shown:
+                clusters.append({"lat": sum(locations[u]["lat"] for u in shown) / len(shown),
+                                 "lng": sum(locations[u]["lng"] for u in shown) / len(shown),
+                                 "count": len(shown)})
+        return {"users": [_location_item(uid, locations[uid], roles) for uid in singles],
+                "clusters": clusters}
+    if not bbox:
+        uids = [uid for uid, data in locations.items() if visible(uid, data)]
+        return render(uids)["users"]
+    boxes = _parse_bbox(bbox)
+    inside: dict = {}   # sıralı küme
+    for south, west, north, east in boxes:
+        for uid in _users_in_box(south, west, north, east):
+            data = locations[uid]
+            if (south <= data["lat"] <= north and west <= data["lng"] <= east
+                    and uid not in inside and visible(uid, data)):
+                inside[uid] = None
+    # Dışarıdakiler: görünüm boyutunda hücre başına sayı ve ağırlık merkezi
+    cell_h = max(boxes[0][2] - boxes[0][0], NEARBY_CELL_DEG)
+    cell_w = max(sum(e - w for _, w, _, e in boxes), NEARBY_CELL_DEG)
+    # Odanın üyeleri eksi görünümdekiler — diğer odaların kullanıcılarına bakılmaz;
+    # görünürlük izleyiciye göre değiştiğinden kalanlar yine tek tek süzülür
+    cells: dict = {}
+    for uid in _room_members.get(room_name, set()).difference(inside):
+        data = locations.get(uid)
+        if data is None or not visible(uid, data):
             continue
-        vis = visibility_settings.get(uid, {"mode": "all"})
-        if vis["mode"] == "hidden":
-            continue
-        if vis["mode"] == "room":
-            viewer_room = locations.get(viewer_id, {}).get("roomName", room_name)
-            if viewer_room != data.get("roomName"):
+        cell = cells.setdefault((floor(data["lat"] / cell_h), floor(data["lng"] / cell_w)), [0, 0.0, 0.0])
+        cell[0] += 1; cell[1] += data["lat"]; cell[2] += data["lng"]
+    outside = [{"lat": lat_sum / n, "lng": lng_sum / n, "count": n}
+               for n, lat_sum, lng_sum in cells.values()]
+    return {**render(inside), "outside": outside}
+
+def _locations_payload(room_name: str, viewer_id: str, viewer_device_id: str,
+                       bbox: str, zoom: Optional[int]) -> str:
+    """(Aktörde) WebSocket aboneliği için get_locations çıktısı — JSON metni."""
+    try:
+        result = get_locations(room_name, viewer_id, viewer_device_id, bbox, zoom)
+    except HTTPException as e:
+        result = {"error": e.detail}
+    return json.dumps(_render_user_ids(result), ensure_ascii=False)
+
+@app.websocket("/ws/locations/{room_name}")
+async def ws_locations(ws: WebSocket, room_name: str, viewer_id: str = "",
+                       viewer_device_id: str = "", bbox: str = "", zoom: Optional[int] = None):
+    """get_locations aboneliği — LOCATIONS_PUSH_SECS'te bir güncel liste gönderir.
+    İstemci {"bbox": "güney,batı,kuzey,doğu", "zoom": z} göndererek görünümü
+    değiştirir (boş bbox: tüm oda); yeni görünümün listesi hemen gelir."""
+    await ws.accept()
+    uid = await _in_state_actor(user_id_of, viewer_id) if viewer_id else ""
+    try:
+        while True:
+            await ws.send_text(await _in_state_actor(
+                _locations_payload, room_name, uid, viewer_device_id, bbox, zoom))
+            try:
+                msg = await asyncio.wait_for(ws.receive_json(), LOCATIONS_PUSH_SECS)
+            except asyncio.TimeoutError:
                 continue
-        user_room = data.get("roomName", "Genel")
-        room_data = rooms.get(user_room, {})
-        is_creator   = bool(room_data.get("createdBy")) and room_data.get("createdBy") == uid
-        is_super_now = any(
-            s["userId"] == uid and datetime.now(DEFAULT_TIMEZONE) < s["expiresAt"]
-            for s in _super_admin_sessions.values()
-        )
-        is_room_admin = is_creator or is_super_now
-        result.append({
-            "userId": uid, "deviceId": data.get("deviceId", ""),
-            "lat": data["lat"], "lng": data["lng"],
-            "deviceType": data.get("deviceType", "phone"),
-            "altitude": data.get("altitude", 0), "speed": data.get("speed", 0),
-            "animationType": data.get("animationType", "pulse"),
-            "roomName": data.get("roomName", "Genel"),
-            "idleStatus": data.get("idleStatus", "online"),
-            "idleMinutes": data.get("idleMinutes", 0),
-            "character": data.get("character", "🧍"),
-            "isHidden": False,
-            "isRoomAdmin": is_room_admin,
-            "isSuperAdmin": is_super_now,
-            "permMsg": data.get("permMsg", "odadakiler"),
-            "permLocationHist": data.get("permLocationHist", "yonetici"),
-            "transportRole": transport_roles.get(data.get("roomName",""), {}).get(uid, {}).get("role", ""),
-        })
-    return result
+            if not isinstance(msg, dict):
+                continue
+            if isinstance(msg.get("bbox"), str):
+                bbox = msg["bbox"]
+            if "zoom" in msg and (msg["zoom"] is None or isinstance(msg["zoom"], int)):
+                zoom = msg["zoom"]
+    except WebSocketDisconnect:
+        pass
+
+@app.get("/nearby/{room_name}")
+def nearby(room_name: str, viewer_id: str = "", viewer_device_id: str = "",
+           lat: Optional[float] = None, lng: Optional[float] = None,
+           radius: float = 500, k: int = 0):
+    """Odada radius metre içindeki görünür kullanıcılar, yakından uzağa.
+    k > 0 ise yarıçap yerine en yakın k kişi (NEARBY_MAX_RADIUS_M içinde).
+    lat/lng verilmezse izleyicinin son konumu kullanılır."""
+    if lat is None or lng is None:
+        own = locations.get(viewer_id)
+        if own is None:
+            raise HTTPException(status_code=400, detail="Konum gerekli (lat/lng)")
+        lat, lng = own["lat"], own["lng"]
+    viewer_is_banned = _viewer_is_banned(viewer_id, viewer_device_id)
+    viewer_room = locations.get(viewer_id, {}).get("roomName", room_name)
+    k = max(0, min(k, NEARBY_MAX_K))
+    # k-en-yakın: yarıçapı ikiye katlayarak büyüt; r içinde k kişi bulunduysa
+    # dışarıdaki herkes onlardan uzaktır
+    search = min(max(radius, 1.0), NEARBY_MAX_RADIUS_M) if not k else NEARBY_CELL_DEG * 111320
+    while True:
+        search = min(search, NEARBY_MAX_RADIUS_M)
+        uids = [uid for uid in _users_near(lat, lng, search)
+                if uid != viewer_id and locations[uid].get("roomName") == room_name
+                and _visible_to(viewer_room, viewer_is_banned, uid, locations[uid])]
+        # Hücre kutusu daireden geniş — köşedekileri ucuz yaklaşımla ele
+        rough = equirect_many(lat, lng, [locations[u]["lat"] for u in uids],
+                              [locations[u]["lng"] for u in uids])
+        uids = [uid for uid, d in zip(uids, rough) if d <= search * EQUIRECT_SLACK]
+        dists = haversine_many(lat, lng, [locations[u]["lat"] for u in uids],
+                               [locations[u]["lng"] for u in uids])
+        found = sorted((d, uid) for d, uid in zip(dists, uids) if d <= search)
+        if not k or len(found) >= k or search >= NEARBY_MAX_RADIUS_M:
+            break
+        search *= 2
+    if k:
+        found = found[:k]
+    return {"radius": search, "users": [{
+        "userId": uid, "distance": round(d, 1),
+        "lat": locations[uid]["lat"], "lng": locations[uid]["lng"],
+        "character": locations[uid].get("character", "🧍"),
+        "idleStatus": locations[uid].get("idleStatus", "online"),
+        "speed": locations[uid].get("speed", 0),
+    } for d, uid in found]}
 
 @app.get("/get_offline_users")
 def get_offline_users(admin_id: str = "", device_id: str = "", token: str = ""):
@@ -1180,39 +4222,133 @@ def get_offline_users(admin_id: str = "", device_id: str = "", token: str = ""):
         })
     return result
 
-@app.get("/get_location_history/{user_id}")
-def get_location_history(user_id: str, period: str = "all",
-                          requester_id: str = "", device_id: str = ""):
-    # Yetki kontrolü
+def _check_history_access(user_id: str, requester_id: str, device_id: str):
     if requester_id and requester_id != user_id:
         admin_rooms = {name for name, room in rooms.items() if room.get("createdBy") == requester_id}
         target_room = locations.get(user_id, {}).get("roomName", "")
         if target_room not in admin_rooms and not is_super_admin(requester_id, device_id):
             raise HTTPException(status_code=403, detail="Bu kullanıcının geçmişini görme yetkiniz yok")
 
-    history = location_history.get(user_id, [])
-    if period == "all":
-        return history
-
+@app.get("/get_location_history/{user_id}")
+async def get_location_history(user_id: str, period: str = "all",
+                               requester_id: str = "", device_id: str = "", encoding: str = "json"):
+    """encoding=polyline: nokta listesi yerine kompakt iz (bkz. encode_track).
+    Pencere sıcak bölgenin dışına taşıyorsa arşiv günleri aktör dışında okunur."""
+    cutoff, hot, result = await _in_state_actor(_hot_history_window, user_id, period,
+                                                 requester_id, device_id, encoding)
+    if result is not None:
+        return result
+    return await _in_archive(_history_with_archive, user_id, period, cutoff, hot, encoding)
+
+def _hot_history_window(user_id: str, period: str, requester_id: str,
+                        device_id: str, encoding: str) -> tuple:
+    """(Aktörde) (cutoff, sıcak geçmiş kopyası, yanıt). Arşiv gerekmiyorsa yanıt
+    hazırdır, gerekiyorsa None."""
+    _check_history_access(user_id, requester_id, device_id)
+    hot = location_history.get(user_id, [])
     now = datetime.now(DEFAULT_TIMEZONE)
     cutoffs = {
         "day":   timedelta(days=1),
         "week":  timedelta(weeks=1),
         "month": timedelta(days=30),
         "year":  timedelta(days=365),
+        "all":   timedelta(days=MAX_HISTORY_DAYS),
     }
-    cutoff = now - cutoffs.get(period, timedelta(days=1))
-    return [
-        p for p in history
-        if datetime.strptime(p["timestamp"], "%Y-%m-%d %H:%M:%S")
-           .replace(tzinfo=DEFAULT_TIMEZONE) > cutoff
-    ]
+    cutoff = (now - cutoffs.get(period, timedelta(days=1))).strftime("%Y-%m-%d %H:%M:%S")
+    if cutoff[:10] < _hot_cutoff_date():
+        return cutoff, list(hot), None
+    return cutoff, None, _history_response(list(hot), period, cutoff, encoding)
+
+def _history_with_archive(user_id: str, period: str, cutoff: str,
+                          hot: list, encoding: str):
+    """(Arşiv thread'inde) arşiv günleri + sıcak kopya. Aradaki bir arşivleme
+    sıcak kopyadaki noktaları diske taşımış olabilir — ikisini sayma."""
+    archived = _archived_history(user_id, cutoff[:10])
+    if hot:
+        archived = [p for p in archived if p["timestamp"] < hot[0]["timestamp"]]
+    return _history_response(archived + hot, period, cutoff, encoding)
+
+def _history_response(history: list, period: str, cutoff: str, encoding: str):
+    if period != "all":
+        history = [p for p in history if p["timestamp"] > cutoff]
+    if encoding == "polyline":
+        return encode_track(history, TRACK_PRECISION_API)
+    return history
+
+@app.get("/get_trip_stats/{user_id}")
+def get_trip_stats(user_id: str, days: int = 7,
+                   requester_id: str = "", device_id: str = ""):
+    """Son `days` günün mesafe/hareket süresi/yolculuk özeti (bugün dahil).
+    Tek noktalık yolculuklar (yerinde bekleme) listelenmez."""
+    _check_history_access(user_id, requester_id, device_id)
+    days = max(1, min(days, MAX_HISTORY_DAYS))
+    since = (datetime.now(DEFAULT_TIMEZONE) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    st = trip_stats.get(user_id, {"days": {}})
+    result = []
+    totals = {"distance": 0.0, "movingSeconds": 0, "maxSpeed": 0, "trips": 0}
+    for date in sorted(d for d in st["days"] if d >= since):
+        day = st["days"][date]
+        trips = [{**t, "distance": round(t["distance"]),
+                  "from": list(t["from"]), "to": list(t["to"])}
+                 for t in day["trips"] if t["points"] > 1]
+        result.append({"date": date, "distance": round(day["distance"]),
+                       "movingSeconds": day["movingSeconds"], "maxSpeed": day["maxSpeed"],
+                       "points": day["points"], "trips": trips})
+        totals["distance"] += day["distance"]
+        totals["movingSeconds"] += day["movingSeconds"]
+        totals["maxSpeed"] = max(totals["maxSpeed"], day["maxSpeed"])
+        totals["trips"] += len(trips)
+    totals["distance"] = round(totals["distance"])
+    return {"days": result, "totals": totals}
+
+@app.get("/heatmap/{room_name}/{z}/{x}/{y}")
+def heatmap_tile(room_name: str, z: int, x: int, y: str,
+                 admin_id: str = "", device_id: str = "", token: str = "",
+                 format: str = "png"):
+    """Oda üyelerinin sıcak geçmişinden (son HOT_HISTORY_DAYS gün, arşiv hariç)
+    XYZ ısı haritası karosu (256 px PNG). y ".png" uzantılı gelebilir (harita
+    kütüphanesi şablonları için).
+    format=json: {"bins", "cells": [[sütun, satır, sayı], ...]} — istemci kendi çizer."""
+    room = rooms.get(room_name)
+    if room is None:
+        raise HTTPException(status_code=404, detail="Oda bulunamadı!")
+    if room.get("createdBy") != admin_id and not is_super_admin(admin_id, device_id, token):
+        raise HTTPException(status_code=403, detail="Yetkisiz!")
+    y, _, ext = y.partition(".")
+    if not y.isdigit() or not 0 <= z <= HEATMAP_MAX_ZOOM + HEATMAP_BIN_BITS:
+        raise HTTPException(status_code=400, detail="Geçersiz karo")
+    y = int(y)
+    if not (0 <= x < 1 << z and 0 <= y < 1 << z):
+        raise HTTPException(status_code=400, detail="Geçersiz karo")
+    if format == "json" or ext == "json":
+        span, cells = _heat_cells(room_name, z, x, y)
+        return {"bins": span, "cells": [[c, r, n] for (c, r), n in sorted(cells.items())]}
+    key = (room_name, z, x, y)
+    png = _heat_tiles.get(key)
+    if png is None:
+        png = _heat_render(*_heat_cells(room_name, z, x, y))
+        # Büyütülmüş karolar (z > HEATMAP_MAX_ZOOM) karo bazında düşürülemez
+        if z <= HEATMAP_MAX_ZOOM:
+            _heat_tiles[key] = png
+            while len(_heat_tiles) > HEATMAP_CACHE_TILES:
+                _heat_tiles.popitem(last=False)
+    else:
+        _heat_tiles.move_to_end(key)
+    return Response(content=png, media_type="image/png",
+                    headers={"Cache-Control": "private, max-age=60"})
 
 @app.delete("/clear_history/{user_id}")
 def clear_history(user_id: str):
     global _save_pending
     if user_id in location_history:
         location_history[user_id] = []
+        _share("location_history", user_id)
+    trip_stats.pop(user_id, None)
+    room = locations.get(user_id, {}).get("roomName")
+    if room:
+        _heat_drop(room)
+    # Bekleyen arşiv yazımından sonra çalışır (arşiv thread'i sıralı)
+    _archive_executor.submit(_drop_archive, user_id)
     _save_pending = True
     return {"message": "✅ Geçmiş temizlendi"}
 
@@ -1221,159 +4357,232 @@ def clear_history(user_id: str):
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/create_pin")
+@_room_scoped(_room_from_body, writes=("pins",))
+@_user_fields("creator")
 def create_pin(data: PinModel):
-    global _critical_save_pending
-    for pin in pins.values():
-        if pin["creator"] == data.creator and pin["roomName"] == data.roomName:
+    st = room_state(data.roomName)
+    for pin in st.pins.values():
+        if pin["creator"] == data.creator:
             raise HTTPException(status_code=400, detail="Zaten bir pininiz var! Önce kaldırın.")
     pin_id = str(uuid.uuid4())[:8]
-    pins[pin_id] = {
+    st.pins[pin_id] = {
         "id": pin_id, "roomName": data.roomName, "creator": data.creator,
         "lat": data.lat, "lng": data.lng, "createdAt": get_local_time(),
         "collectorId": None, "collectionStart": None, "collectionTime": 0,
     }
-    _critical_save_pending = True
     return {"message": "✅ Pin yerleştirildi", "pinId": pin_id}
 
 @app.get("/get_pins/{room_name}")
-def get_pins(room_name: str):
-    return [p for p in pins.values() if p.get("roomName") == room_name]
+@_room_scoped()
+@_user_fields("creator")
+def get_pins(room_name: str, zoom: Optional[int] = None):
+    """zoom < CLUSTER_MAX_ZOOM ise {"pins": [tekil pinler], "clusters": [{lat, lng, count}]}."""
+    st = _peek_room(room_name)
+    pins = list(st.pins.values()) if st else []
+    if zoom is None or zoom >= CLUSTER_MAX_ZOOM:
+        return pins
+    singles, clusters = _cluster([(*_mercator(p["lat"], p["lng"]), p["lat"], p["lng"], p) for p in pins], zoom)
+    return {"pins": singles, "clusters": clusters}
 
 @app.delete("/remove_pin/{pin_id}")
 def remove_pin(pin_id: str, user_id: str):
-    global _critical_save_pending
-    if pin_id not in pins:
+    st = next((s for s in list(_room_states.values()) if pin_id in s.pins), None)
+    if st is None:
         raise HTTPException(status_code=404, detail="Pin bulunamadı!")
-    if pins[pin_id]["creator"] != user_id:
-        raise HTTPException(status_code=403, detail="Sadece pin sahibi kaldırabilir!")
-    del pins[pin_id]
-    _critical_save_pending = True
+    with st.lock:
+        pin = st.pins.get(pin_id)
+        if pin is None:
+            raise HTTPException(status_code=404, detail="Pin bulunamadı!")
+        if pin["creator"] != user_id:
+            raise HTTPException(status_code=403, detail="Sadece pin sahibi kaldırabilir!")
+        del st.pins[pin_id]
+        _share_room(st.name, ("pins",))
+    _mark_critical_dirty("room_states")
     return {"message": "✅ Pin kaldırıldı"}
 
 @app.get("/get_scores/{room_name}")
-def get_scores(room_name: str):
-    result = [{"userId": key[len(f"{room_name}_"):], "score": score}
-              for key, score in scores.items() if key.startswith(f"{room_name}_")]
-    result.sort(key=lambda x: x["score"], reverse=True)
-    return result
+@_room_scoped()
+def get_scores(room_name: str, limit: int = 0, around_user: str = ""):
+    """Puan sırasına göre liste. limit>0 → ilk `limit` kişi; around_user verilirse
+    o kullanıcının çevresindeki `limit` (varsayılan 11) kişilik pencere."""
+    st = _peek_room(room_name)
+    if st is None:
+        return []
+    if around_user:
+        if around_user not in st.scores:
+            return []
+        size = limit if limit > 0 else 11
+        pos = bisect.bisect_left(st._ranking, (-st.scores[around_user], around_user))
+        start = max(0, min(pos - size // 2, len(st._ranking) - size))
+        return st.leaderboard(start, start + size)
+    return st.leaderboard(0, limit if limit > 0 else None)
+
+@app.get("/get_rank_events/{room_name}")
+@_room_scoped()
+def get_rank_events(room_name: str, after_seq: int = 0):
+    """Sıralama değişiklikleri — oyuncuya bildirim için yoklanır."""
+    st = _peek_room(room_name)
+    events = st.rank_events if st else []
+    return {"events": [e for e in events if e["seq"] > after_seq],
+            "head": events[-1]["seq"] if events else 0}
 
 @app.get("/get_collection_history/{room_name}/{user_id}")
+@_room_scoped()
 def get_collection_history(room_name: str, user_id: str):
-    return pin_collection_history.get(f"{room_name}_{user_id}", [])
+    st = _peek_room(room_name)
+    return st.collection_history.get(user_id, []) if st else []
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # 💬 1-1 MESAJLAŞMA
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/send_message")
+@_user_fields("from", "to")
 def send_message(data: MessageModel):
     global _critical_save_pending
     if data.fromUser in muted_users:
         raise HTTPException(403, "🔇 Mesaj gönderme yetkiniz kaldırılmıştır")
     key = get_conv_key(data.fromUser, data.toUser)
-    if key not in messages:
-        messages[key] = []
-    messages[key].append({
+    msg = {
         "id": str(uuid.uuid4())[:8],
         "from": data.fromUser, "to": data.toUser,
         "message": data.message, "timestamp": get_local_time(), "read": False,
-    })
+    }
+    _append_direct_message(key, msg)
     _critical_save_pending = True
     return {"message": "✅ Mesaj gönderildi"}
 
 @app.get("/get_conversation/{user1}/{user2}")
-def get_conversation(user1: str, user2: str):
-    return messages.get(get_conv_key(user1, user2), [])
+@_user_fields("from", "to")
+def get_conversation(user1: str, user2: str, before: int = 0,
+                     limit: Optional[int] = None):
+    """Parametresiz çağrıda konuşmanın tamamı (eski istemciler). limit ve/veya
+    before=<ilk mesajın seq'i> verilirse yalnızca o sayfa döner."""
+    conv = messages.get(get_conv_key(user1, user2), [])
+    if before <= 0 and limit is None:
+        return conv
+    end = bisect.bisect_left(conv, before, key=lambda m: m["seq"]) if before > 0 else len(conv)
+    limit = max(1, min(limit or CONVERSATION_PAGE_SIZE, MAX_CONVERSATION_PAGE))
+    return conv[max(0, end - limit):end]
+
+@app.get("/get_conversations/{user_id}")
+@_user_fields("from", "to", "peer")
+def get_conversations(user_id: str):
+    """Kullanıcının konuşma listesi: karşı taraf, son mesaj ve okunmamış sayısı."""
+    unread = unread_counts.get(user_id, {})
+    result = []
+    for peer, key in _user_convs.get(user_id, {}).items():
+        conv = messages.get(key)
+        if not conv:
+            continue
+        result.append({"peer": peer, "lastMessage": conv[-1], "unread": unread.get(peer, 0)})
+    result.sort(key=lambda c: c["lastMessage"].get("timestamp", ""), reverse=True)
+    return result
 
 @app.post("/mark_as_read/{user_id}/{other_user}")
+@_user_fields("from", "to")
 def mark_as_read(user_id: str, other_user: str):
     key = get_conv_key(user_id, other_user)
     if key in messages:
-        for msg in messages[key]:
+        conv = messages[key]
+        cursors = _read_cursors.setdefault(key, {})
+        # Yalnızca imleçten sonraki mesajlara bak — öncesi zaten okundu
+        for msg in conv[cursors.get(user_id, 0):]:
             if msg["to"] == user_id:
                 msg["read"] = True
+        cursors[user_id] = len(conv)
+        counts = unread_counts.get(user_id)
+        if counts is not None:
+            counts.pop(other_user, None)
+            if not counts:
+                unread_counts.pop(user_id, None)
+        _share("messages", key)
     return {"message": "✅ Okundu"}
 
 @app.get("/get_unread_count/{user_id}")
 def get_unread_count(user_id: str):
-    result = {}
-    for conv in messages.values():
-        for msg in conv:
-            if msg["to"] == user_id and not msg["read"]:
-                result[msg["from"]] = result.get(msg["from"], 0) + 1
-    return result
+    # Anahtarlar gönderen uid'leri — yanıt çevirisi yalnızca alanlara bakar
+    return {display_name(uid): n for uid, n in unread_counts.get(user_id, {}).items()}
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # 👥 GRUP MESAJLAŞMA
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/send_room_message")
+@_room_scoped(_room_from_body, writes=("messages",))
+@_user_fields("from")
 def send_room_message(data: RoomMessageModel):
-    global _critical_save_pending
     if data.fromUser in muted_users:
         raise HTTPException(403, "🔇 Mesaj gönderme yetkiniz kaldırılmıştır")
     room = data.roomName
     if room != "Genel" and room not in rooms:
         raise HTTPException(status_code=404, detail="Oda bulunamadı!")
-    if room not in room_messages:
-        room_messages[room] = []
-    room_messages[room].append({
+    st = room_state(room)
+    msg = {
         "id": str(uuid.uuid4())[:8],
         "from": data.fromUser,
         "message": data.message,
         "timestamp": get_local_time(),
         "character": locations.get(data.fromUser, {}).get("character", "🧍"),
-    })
-    if len(room_messages[room]) > MAX_ROOM_MESSAGES:
-        room_messages[room] = room_messages[room][-MAX_ROOM_MESSAGES:]
-    _critical_save_pending = True
-    return {"message": "✅ Grup mesajı gönderildi"}
+    }
+    st.messages.append(msg)
+    _share_append("room_messages", room, msg, MAX_ROOM_MESSAGES)
+    return {"message": "✅ Grup mesajı gönderildi", "seq": msg["seq"]}
 
 @app.get("/get_room_messages/{room_name}")
+@_room_scoped()
+@_user_fields("from")
 def get_room_messages(room_name: str, limit: int = 50):
-    return room_messages.get(room_name, [])[-limit:]
+    st = _peek_room(room_name)
+    return st.messages[-limit:] if st else []
 
 @app.get("/get_room_messages_since/{room_name}")
-def get_room_messages_since(room_name: str, last_id: str = ""):
-    msgs = room_messages.get(room_name, [])
-    if not last_id:
+@_room_scoped()
+@_user_fields("from")
+def get_room_messages_since(room_name: str, last_id: str = "", after_seq: int = -1):
+    """after_seq verilirse {messages, head, gap} döner; gap=True ise istemci
+    geride kalmış ve aradaki mesajlar tampondan düşmüştür. Eski istemciler için
+    last_id ile liste döndürme korunur (id tamponda yoksa son 50)."""
+    st = _peek_room(room_name)
+    msgs = st.messages if st else MessageRing(MAX_ROOM_MESSAGES)
+    if after_seq >= 0:
+        return {"messages": msgs.since(after_seq), "head": msgs.head,
+                "gap": after_seq < msgs.first_seq - 1}
+    seq = msgs.seq_of(last_id) if last_id else None
+    if seq is None:
         return msgs[-50:]
-    for i, msg in enumerate(msgs):
-        if msg["id"] == last_id:
-            return msgs[i+1:]
-    return msgs[-50:]
+    return msgs.since(seq)
 
 @app.get("/get_room_unread/{room_name}/{user_id}")
+@_room_scoped()
 def get_room_unread(room_name: str, user_id: str):
-    msgs = room_messages.get(room_name, [])
+    st = _peek_room(room_name)
+    msgs = st.messages if st else None
     if not msgs:
-        return {"count": 0, "lastId": ""}
-    last_read_id = room_message_reads.get(room_name, {}).get(user_id, "")
-    if not last_read_id:
-        return {"count": len(msgs), "lastId": msgs[-1]["id"]}
-    for i, msg in enumerate(msgs):
-        if msg["id"] == last_read_id:
-            unread = len(msgs) - i - 1
-            return {"count": unread, "lastId": msgs[-1]["id"]}
-    return {"count": len(msgs), "lastId": msgs[-1]["id"]}
+        return {"count": 0, "lastId": "", "head": msgs.head if msgs else 0}
+    # İmleç tamponun gerisindeyse okunmamış sayısı tampondakilerle sınırlı
+    read_seq = max(st.message_reads.get(user_id, 0), msgs.first_seq - 1)
+    return {"count": max(0, msgs.head - read_seq), "lastId": msgs[-1]["id"], "head": msgs.head}
 
 @app.post("/mark_room_read/{room_name}/{user_id}")
-def mark_room_read(room_name: str, user_id: str, last_id: str = ""):
-    """Kullanıcının okuduğu son mesajı işaretle."""
-    if room_name not in room_message_reads:
-        room_message_reads[room_name] = {}
-    msgs = room_messages.get(room_name, [])
-    if not last_id and msgs:
-        last_id = msgs[-1]["id"]
+@_room_scoped(writes=("message_reads",))
+def mark_room_read(room_name: str, user_id: str, last_id: str = "", seq: int = 0):
+    """Kullanıcının okuduğu son mesajı (id ya da seq ile) işaretle."""
+    st = room_state(room_name)
     if last_id:
-        room_message_reads[room_name][user_id] = last_id
-    return {"ok": True}
+        seq = st.messages.seq_of(last_id) or 0
+    elif not seq:
+        seq = st.messages.head
+    if seq:
+        st.message_reads[user_id] = min(seq, st.messages.head)
+    return {"ok": True, "seq": st.message_reads.get(user_id, 0)}
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # 🎙️ SESLİ MESAJLAR (1-1)
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/send_voice_message")
+@_user_fields("from", "to")
 def send_voice_message(data: VoiceMessageModel):
     if len(data.audioBase64) > MAX_AUDIO_B64:
         raise HTTPException(400, "Ses dosyası çok büyük (max 2MB)")
@@ -1385,23 +4594,25 @@ def send_voice_message(data: VoiceMessageModel):
         "durationSeconds": data.durationSeconds,
         "timestamp": get_local_time(), "read": False,
     }
+    _share("voice_messages", voice_id)
     key = get_conv_key(data.fromUser, data.toUser)
-    if key not in messages:
-        messages[key] = []
-    messages[key].append({
+    msg = {
         "id": str(uuid.uuid4())[:8],
         "from": data.fromUser, "to": data.toUser,
         "message": "", "type": "voice",
         "voiceId": voice_id,
         "durationSeconds": data.durationSeconds,
         "timestamp": get_local_time(), "read": False,
-    })
+    }
+    _append_direct_message(key, msg)
     if len(voice_messages) > MAX_VOICE_MESSAGES:
         oldest_key = next(iter(voice_messages))
         del voice_messages[oldest_key]
+        _share("voice_messages", oldest_key)
     return {"message": "✅ Sesli mesaj gönderildi", "voiceId": voice_id}
 
 @app.get("/get_voice_message/{voice_id}")
+@_user_fields("from", "to")
 def get_voice_message(voice_id: str):
     if voice_id not in voice_messages:
         raise HTTPException(status_code=404, detail="Sesli mesaj bulunamadı!")
@@ -1412,6 +4623,7 @@ def get_voice_message(voice_id: str):
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/send_room_voice_message")
+@_user_fields("from")
 def send_room_voice_message(data: RoomVoiceMessageModel):
     if len(data.audioBase64) > MAX_AUDIO_B64:
         raise HTTPException(400, "Ses dosyası çok büyük (max 2MB)")
@@ -1425,9 +4637,8 @@ def send_room_voice_message(data: RoomVoiceMessageModel):
         "durationSeconds": data.durationSeconds,
         "timestamp": get_local_time(),
     }
-    if room not in room_messages:
-        room_messages[room] = []
-    room_messages[room].append({
+    _share("room_voice_messages", voice_id)
+    msg = {
         "id": str(uuid.uuid4())[:8],
         "from": data.fromUser,
         "message": "", "type": "voice",
@@ -1435,12 +4646,15 @@ def send_room_voice_message(data: RoomVoiceMessageModel):
         "durationSeconds": data.durationSeconds,
         "timestamp": get_local_time(),
         "character": locations.get(data.fromUser, {}).get("character", "🧍"),
-    })
-    if len(room_messages[room]) > MAX_ROOM_MESSAGES:
-        room_messages[room] = room_messages[room][-MAX_ROOM_MESSAGES:]
+    }
+    st = room_state(room)
+    with st.lock:
+        st.messages.append(msg)
+        _share_append("room_messages", room, msg, MAX_ROOM_MESSAGES)
     return {"message": "✅ Sesli mesaj gönderildi", "voiceId": voice_id}
 
 @app.get("/get_room_voice_message/{voice_id}")
+@_user_fields("from")
 def get_room_voice_message(voice_id: str):
     if voice_id not in room_voice_messages:
         raise HTTPException(status_code=404, detail="Sesli mesaj bulunamadı!")
@@ -1451,6 +4665,7 @@ def get_room_voice_message(voice_id: str):
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/walkie_send")
+@_user_fields("from", "to")
 def walkie_send(data: WalkieSendModel):
     if len(data.audioBase64) > MAX_AUDIO_B64:
         raise HTTPException(400, "Ses dosyası çok büyük (max 2MB)")
@@ -1461,9 +4676,11 @@ def walkie_send(data: WalkieSendModel):
         "audioBase64": data.audioBase64,
         "timestamp": get_local_time(),
     }
+    _share("walkie_queue", key)
     return {"message": "✅ Walkie gönderildi"}
 
 @app.get("/walkie_listen/{user_id}/{other_user}")
+@_user_fields("from", "to")
 def walkie_listen(user_id: str, other_user: str, last_id: str = ""):
     key = get_conv_key(user_id, other_user)
     entry = walkie_queue.get(key)
@@ -1477,26 +4694,31 @@ def walkie_listen(user_id: str, other_user: str, last_id: str = ""):
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/room_walkie_send")
+@_room_scoped(_room_from_body, writes=("walkie_queue",))
+@_user_fields("from")
 def room_walkie_send(data: RoomWalkieSendModel):
     if len(data.audioBase64) > MAX_AUDIO_B64:
         raise HTTPException(400, "Ses dosyası çok büyük (max 2MB)")
     room = data.roomName
-    if room not in room_walkie_queue:
-        room_walkie_queue[room] = []
+    st = room_state(room)
     entry = {
         "id": str(uuid.uuid4())[:8],
         "from": data.fromUser, "roomName": room,
         "audioBase64": data.audioBase64,
         "timestamp": get_local_time(),
     }
-    room_walkie_queue[room].append(entry)
-    if len(room_walkie_queue[room]) > MAX_WALKIE_QUEUE:
-        room_walkie_queue[room] = room_walkie_queue[room][-MAX_WALKIE_QUEUE:]
+    st.walkie_queue.append(entry)
+    if len(st.walkie_queue) > MAX_WALKIE_QUEUE:
+        st.walkie_queue = st.walkie_queue[-MAX_WALKIE_QUEUE:]
+    _share_append("room_walkie_queue", room, entry, MAX_WALKIE_QUEUE)
     return {"message": "✅ Oda walkie gönderildi", "id": entry["id"]}
 
 @app.get("/room_walkie_listen/{room_name}")
+@_room_scoped()
+@_user_fields("from")
 def room_walkie_listen(room_name: str, user_id: str = "", last_id: str = ""):
-    queue = room_walkie_queue.get(room_name, [])
+    st = _peek_room(room_name)
+    queue = st.walkie_queue if st else []
     if not last_id:
         for entry in reversed(queue):
             if entry["from"] != user_id:
@@ -1518,8 +4740,9 @@ def room_walkie_listen(room_name: str, user_id: str = "", last_id: str = ""):
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/sos_alert")
+@_room_scoped(_room_from_body, writes=("sos",))
 def sos_alert(data: SosModel):
-    sos_alerts[data.roomName] = {
+    room_state(data.roomName).sos = {
         "userId": data.userId, "roomName": data.roomName,
         "lat": data.lat, "lng": data.lng,
         "message": data.message, "timestamp": get_local_time(), "active": True,
@@ -1527,13 +4750,17 @@ def sos_alert(data: SosModel):
     return {"message": "✅ SOS gönderildi"}
 
 @app.get("/get_sos/{room_name}")
+@_room_scoped()
 def get_sos(room_name: str):
-    return sos_alerts.get(room_name, {"active": False})
+    st = _peek_room(room_name)
+    return (st.sos if st else None) or {"active": False}
 
 @app.delete("/cancel_sos/{room_name}")
+@_room_scoped(writes=("sos",))
 def cancel_sos(room_name: str, user_id: str):
-    if room_name in sos_alerts:
-        sos_alerts[room_name]["active"] = False
+    st = _peek_room(room_name)
+    if st and st.sos:
+        st.sos["active"] = False
     return {"message": "✅ SOS iptal edildi"}
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -1541,20 +4768,22 @@ def cancel_sos(room_name: str, user_id: str):
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/music_start")
+@_room_scoped(_room_from_body, writes=("music",))
 def music_start(data: MusicStartModel):
-    music_broadcasts[data.roomName] = {
+    room_state(data.roomName).music = {
         "broadcasterId": data.broadcasterId, "title": data.title,
         "startedAt": get_local_time(), "chunks": [], "chunkIndex": 0,
     }
     return {"message": "✅ Yayın başladı"}
 
 @app.post("/music_chunk")
+@_room_scoped(_room_from_body, writes=("music",))
 def music_chunk(data: MusicChunkModel):
     if len(data.audioBase64) > MAX_AUDIO_B64:
         raise HTTPException(400, "Ses dosyası çok büyük (max 2MB)")
-    if data.roomName not in music_broadcasts:
+    broadcast = room_state(data.roomName).music
+    if not broadcast:
         raise HTTPException(status_code=404, detail="Yayın bulunamadı!")
-    broadcast = music_broadcasts[data.roomName]
     chunk_id = str(uuid.uuid4())[:8]
     broadcast["chunks"].append({
         "id": chunk_id, "index": broadcast["chunkIndex"],
@@ -1566,22 +4795,26 @@ def music_chunk(data: MusicChunkModel):
     return {"message": "✅ Chunk kaydedildi", "chunkId": chunk_id}
 
 @app.post("/music_stop")
+@_room_scoped(_room_from_body, writes=("music",))
 def music_stop(data: MusicStopModel):
-    if data.roomName in music_broadcasts:
-        del music_broadcasts[data.roomName]
+    room_state(data.roomName).music = None
     return {"message": "✅ Yayın durduruldu"}
 
 @app.get("/music_status/{room_name}")
+@_room_scoped()
 def music_status(room_name: str):
-    broadcast = music_broadcasts.get(room_name)
+    st = _peek_room(room_name)
+    broadcast = st.music if st else None
     if not broadcast:
         return {"active": False, "broadcasterId": None, "title": ""}
     return {"active": True, "broadcasterId": broadcast["broadcasterId"],
             "title": broadcast["title"], "chunkCount": len(broadcast["chunks"])}
 
 @app.get("/music_listen/{room_name}")
+@_room_scoped()
 def music_listen(room_name: str, after_index: int = 0):
-    broadcast = music_broadcasts.get(room_name)
+    st = _peek_room(room_name)
+    broadcast = st.music if st else None
     if not broadcast:
         return {"active": False, "chunks": []}
     chunks = [c for c in broadcast["chunks"] if c["index"] > after_index]
@@ -1590,8 +4823,10 @@ def music_listen(room_name: str, after_index: int = 0):
             "chunks": [{"id": c["id"], "index": c["index"]} for c in chunks]}
 
 @app.get("/music_chunk_data/{room_name}/{chunk_id}")
+@_room_scoped()
 def music_chunk_data(room_name: str, chunk_id: str):
-    broadcast = music_broadcasts.get(room_name)
+    st = _peek_room(room_name)
+    broadcast = st.music if st else None
     if not broadcast:
         raise HTTPException(status_code=404, detail="Yayın bulunamadı!")
     for chunk in broadcast["chunks"]:
@@ -1608,6 +4843,7 @@ def check_super_admin(user_id: str, device_id: str = "", token: str = ""):
     return {"isSuperAdmin": is_super_admin(user_id, device_id, token)}
 
 @app.post("/super_admin_login")
+@_raw_user_ids
 def super_admin_login(data: dict):
     admin_id  = data.get("adminId", "").strip()
     password  = data.get("password", "").strip()
@@ -1615,33 +4851,29 @@ def super_admin_login(data: dict):
         raise HTTPException(400, "ID ve Şifre gerekli")
     if SUPER_ADMIN_CREDENTIALS.get(admin_id) != password:
         raise HTTPException(403, "Hatalı ID veya Şifre")
-    now = datetime.now(DEFAULT_TIMEZONE)
     requester_device = data.get("deviceId", "").strip()
-    stale_tokens = [t for t, s in _super_admin_sessions.items()
-                    if s["userId"] == admin_id and now < s["expiresAt"]]
-    for t in stale_tokens:
-        del _super_admin_sessions[t]
+    for t in list(_admin_tokens_by_user.get(admin_id, ())):
+        _drop_admin_session(t)
     token = str(uuid.uuid4())
-    _super_admin_sessions[token] = {
+    _add_admin_session(token, {
         "userId": admin_id,
         "expiresAt": datetime.now(DEFAULT_TIMEZONE) + timedelta(hours=24),
         "deviceId": requester_device,
-    }
-    global _critical_save_pending
-    _critical_save_pending = True
-    _flush_critical_data()  # Anında diske yaz — restart sonrası kaybolmasın
+    })
+    # Bir sonraki periyodik kayıtta yazılır; aktörde disk yazımı yapılmaz
+    _mark_critical_dirty("super_admin_sessions")
     return {"token": token, "message": "✅ Süper admin girişi başarılı"}
 
 @app.post("/super_admin_logout")
+@_raw_user_ids
 def super_admin_logout(data: dict):
     admin_id = data.get("adminId", "")
     token    = data.get("token", "")
     if token and token in _super_admin_sessions:
-        del _super_admin_sessions[token]
+        _drop_admin_session(token)
         return {"message": "✅ Admin oturumu kapatıldı"}
-    to_delete = [t for t, s in _super_admin_sessions.items() if s["userId"] == admin_id]
-    for t in to_delete:
-        del _super_admin_sessions[t]
+    for t in list(_admin_tokens_by_user.get(admin_id, ())):
+        _drop_admin_session(t)
     return {"message": "✅ Çıkış yapıldı"}
 
 @app.get("/get_all_rooms_info")
@@ -1677,9 +4909,210 @@ def get_all_rooms_info(admin_id: str = "", device_id: str = "", token: str = "")
 def register_fcm_token(data: FcmTokenModel):
     global _critical_save_pending
     fcm_tokens[data.userId] = data.token
+    _share("fcm_tokens", data.userId)
     _critical_save_pending = True
     return {"message": "✅ FCM token kaydedildi"}
 
+# ═══════════════════════════════════════════════════════════════════════════════
+# 📡 MESAJ VERİYOLU — süreçler arası ses rölesi
+# ═══════════════════════════════════════════════════════════════════════════════
+# Ses WebSocket'leri gelen çerçeveyi doğrudan eşlere değil veriyoluna yayınlar;
+# her süreç veriyolundan gelen çerçeveyi kendi soketlerine dağıtır. Böylece
+# farklı worker'lara / makinelere bağlı iki kişi birbirini duyar.
+#   VOICE_BUS=local  — tek süreç (varsayılan)
+#   VOICE_BUS=unix   — aynı makinedeki worker'lar, VOICE_BUS_DIR altındaki
+#                      datagram soketleri üzerinden
+#   VOICE_BUS=redis  — birden çok makine, REDIS_URL üzerinden PUBLISH/PSUBSCRIBE
+# Kanal adları: "room:<oda>" ve "p2p:<alıcı>". Her çerçeve gönderen soketin
+# etiketini taşır; gönderen kendi sesini geri almaz. "perm:<admin>" kanalı ses
+# değil, yetki isteği olaylarını (JSON) admin paneline taşır; göndereni boştur.
+VOICE_BUS     = os.getenv("VOICE_BUS", "redis" if STATE_BACKEND == "redis" else "local")
+VOICE_BUS_DIR = os.getenv("VOICE_BUS_DIR", "/tmp/konum-voice-bus")
+_VOICE_CHANNEL_PREFIX = "konum:voice:"
+
+def _ws_tag(ws) -> str:
+    return f"{_WORKER_ID}:{id(ws)}"
+
+class _LocalBus:
+    """Süreç içi veriyolu — yayın doğrudan yerel dağıtıma gider."""
+
+    async def start(self, deliver):
+        self.deliver = deliver
+
+    async def publish(self, channel: str, sender: str, data: bytes):
+        await self.deliver(channel, sender, data)
+
+    async def stop(self):
+        pass
+
+class _UnixSocketBus:
+    """Her süreç VOICE_BUS_DIR/<worker>.sock adında bir datagram soketi açar;
+    yayın dizindeki tüm soketlere (kendisi dahil) gönderilir. Ses kayba toleranslı
+    olduğundan dolu kuyrukta çerçeve düşürülür."""
+
+    PEER_REFRESH_SECS = 2.0
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, f"{_WORKER_ID}.sock")
+        self.sock = None
+        self._peers: list = []
+        self._peers_at = 0.0
+
+    async def start(self, deliver):
+        self.deliver = deliver
+        os.makedirs(self.directory, exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.sock.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        while True:
+            try:
+                frame = self.sock.recv(1 << 20)
+            except (BlockingIOError, InterruptedError):
+                return
+            channel, _, rest = frame.partition(b"\n")
+            sender, _, data = rest.partition(b"\n")
+            asyncio.ensure_future(self.deliver(channel.decode("utf-8"),
+                                               sender.decode("ascii"), data))
+
+    def _peer_paths(self) -> list:
+        now = time.monotonic()
+        if now - self._peers_at >= self.PEER_REFRESH_SECS:
+            self._peers = [os.path.join(self.directory, f)
+                           for f in os.listdir(self.directory) if f.endswith(".sock")]
+            self._peers_at = now
+        return self._peers
+
+    async def publish(self, channel: str, sender: str, data: bytes):
+        frame = channel.encode("utf-8") + b"\n" + sender.encode("ascii") + b"\n" + data
+        for path in self._peer_paths():
+            try:
+                self.sock.sendto(frame, path)
+            except (BlockingIOError, InterruptedError):
+                pass
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Ölmüş süreçten kalan soket dosyası
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                self._peers_at = 0.0
+            except OSError as e:
+                print(f"❌ Ses veriyolu gönderim hatası: {e}")
+
+    async def stop(self):
+        if self.sock:
+            asyncio.get_running_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+class _RedisBus:
+    """PUBLISH/PSUBSCRIBE ile makineler arası ses rölesi."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.pub: Optional[_AsyncRespConnection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver):
+        self.deliver = deliver
+        self.pub = await _AsyncRespConnection(self.url).connect()
+        self._task = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        while True:
+            sub = None
+            try:
+                sub = await _AsyncRespConnection(self.url).connect()
+                await sub.send("PSUBSCRIBE", _VOICE_CHANNEL_PREFIX + "*")
+                while True:
+                    frame = await sub.read()
+                    if isinstance(frame, list) and frame and frame[0] == b"pmessage":
+                        sender, _, data = frame[3].partition(b"\n")
+                        await self.deliver(frame[2].decode("utf-8")[len(_VOICE_CHANNEL_PREFIX):],
+                                           sender.decode("ascii"), data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Ses veriyolu aboneliği koptu: {e} — 2 sn sonra yeniden")
+                await asyncio.sleep(2)
+            finally:
+                if sub:
+                    sub.close()
+
+    async def publish(self, channel: str, sender: str, data: bytes):
+        try:
+            if self.pub is None:
+                self.pub = await _AsyncRespConnection(self.url).connect()
+            await self.pub.execute("PUBLISH", _VOICE_CHANNEL_PREFIX + channel,
+                                   sender.encode("ascii") + b"\n" + data)
+        except Exception as e:
+            print(f"❌ Ses yayını hatası: {e}")
+            if self.pub:
+                self.pub.close()
+            self.pub = None
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        if self.pub:
+            self.pub.close()
+
+def _make_voice_bus():
+    if VOICE_BUS == "redis":
+        return _RedisBus(REDIS_URL)
+    if VOICE_BUS == "unix":
+        return _UnixSocketBus(VOICE_BUS_DIR)
+    return _LocalBus()
+
+_voice_bus = _LocalBus()
+_event_loop: Optional[asyncio.AbstractEventLoop] = None   # aktörden yayın için (startup'ta atanır)
+
+async def _deliver_voice(channel: str, sender: str, data: bytes):
+    """Veriyolundan gelen çerçeveyi bu süreçteki soketlere dağıt."""
+    if channel.startswith("room:"):
+        room_name = channel[5:]
+        dead = set()
+        for peer in list(_room_voice_ws.get(room_name, ())):
+            if _ws_tag(peer) == sender:
+                continue
+            try:
+                await peer.send_bytes(data)
+            except Exception:
+                dead.add(peer)
+        if dead:
+            _room_voice_ws[room_name] -= dead
+    elif channel.startswith("p2p:"):
+        callee = channel[4:]
+        peer = _p2p_voice_ws.get(callee)
+        if peer and _ws_tag(peer) != sender:
+            try:
+                await peer.send_bytes(data)
+            except Exception:
+                _p2p_voice_ws.pop(callee, None)
+    elif channel.startswith("perm:"):
+        await _send_text_to(_perm_request_ws, channel[5:], data)
+    elif channel.startswith("transport:"):
+        await _send_text_to(_transport_ws, channel[10:], data)
+
+async def _send_text_to(sockets: dict, key: str, data: bytes):
+    text = data.decode("utf-8")
+    dead = set()
+    for peer in list(sockets.get(key, ())):
+        try:
+            await peer.send_text(text)
+        except Exception:
+            dead.add(peer)
+    if dead:
+        sockets[key] -= dead
+
 # ═══════════════════════════════════════════════════════════════════════════════
 # 📞 GERÇEK ZAMANLI SESLİ ARAMA (WebSocket)
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -1692,15 +5125,7 @@ async def ws_room_voice(ws: WebSocket, room_name: str):
     try:
         while True:
             data = await ws.receive_bytes()
-            dead = set()
-            for peer in list(_room_voice_ws[room_name]):
-                if peer is ws:
-                    continue
-                try:
-                    await peer.send_bytes(data)
-                except Exception:
-                    dead.add(peer)
-            _room_voice_ws[room_name] -= dead
+            await _voice_bus.publish(f"room:{room_name}", _ws_tag(ws), data)
     except WebSocketDisconnect:
         _room_voice_ws[room_name].discard(ws)
 
@@ -1708,16 +5133,12 @@ async def ws_room_voice(ws: WebSocket, room_name: str):
 async def ws_p2p_voice(ws: WebSocket, caller: str, callee: str):
     """Birebir sesli arama — caller → callee yönünde PCM iletir."""
     await ws.accept()
+    caller, callee = user_id_of(caller), user_id_of(callee)
     _p2p_voice_ws[caller] = ws
     try:
         while True:
             data = await ws.receive_bytes()
-            peer = _p2p_voice_ws.get(callee)
-            if peer:
-                try:
-                    await peer.send_bytes(data)
-                except Exception:
-                    _p2p_voice_ws.pop(callee, None)
+            await _voice_bus.publish(f"p2p:{callee}", _ws_tag(ws), data)
     except WebSocketDisconnect:
         _p2p_voice_ws.pop(caller, None)
 
@@ -1727,127 +5148,27 @@ async def ws_p2p_voice(ws: WebSocket, caller: str, callee: str):
 
 @app.post("/change_username")
 def change_username(data: ChangeUsernameModel):
+    """Yalnızca isim ↔ uid eşlemesini günceller; veriler uid ile tutulduğu için
+    hiçbir koleksiyon yeniden yazılmaz."""
     old = data.oldName
     new = data.newName
     if not new or len(new.strip()) < 1:
         raise HTTPException(status_code=400, detail="İsim boş olamaz!")
-    if new in locations and new != old:
-        existing    = locations[new]
+    uid = user_id_of(old)
+    holder = _name_holder(new)
+    if holder is not None and holder != uid and holder in locations:
+        existing    = locations[holder]
         req_device  = (data.deviceId or "").strip()
         exist_device = existing.get("deviceId", "").strip()
         same_device = req_device and exist_device and req_device == exist_device
         timed_out   = not is_user_online(existing.get("lastSeen", ""))
         if same_device or timed_out:
-            locations.pop(new, None)
+            locations.pop(holder, None)
+            _share("locations", holder)
+            _place_location(holder)
         else:
             raise HTTPException(status_code=400, detail="Bu isim zaten kullanımda!")
-    if old in locations:
-        locations[new] = locations.pop(old)
-        locations[new]["userId"] = new
-    if old in location_history:
-        location_history[new] = location_history.pop(old)
-        global _save_pending
-        _save_pending = True
-    for key in list(scores.keys()):
-        if key.endswith(f"_{old}"):
-            room = key[:-(len(old)+1)]
-            scores[f"{room}_{new}"] = scores.pop(key)
-    for key in list(pin_collection_history.keys()):
-        if key.endswith(f"_{old}"):
-            room = key[:-(len(old)+1)]
-            pin_collection_history[f"{room}_{new}"] = pin_collection_history.pop(key)
-    for key in list(messages.keys()):
-        parts = key.split('_')
-        if old in parts:
-            conv = messages.pop(key)
-            for msg in conv:
-                if msg['from'] == old: msg['from'] = new
-                if msg['to']   == old: msg['to']   = new
-            other = parts[1] if parts[0] == old else parts[0]
-            new_key = '_'.join(sorted([new, other]))
-            if new_key in messages:
-                messages[new_key].extend(conv)
-                messages[new_key].sort(key=lambda m: m.get('timestamp', ''))
-            else:
-                messages[new_key] = conv
-    for room_msgs in room_messages.values():
-        for msg in room_msgs:
-            if msg.get('from') == old: msg['from'] = new
-    for room in rooms.values():
-        if room.get("createdBy") == old:
-            room["createdBy"] = new
-        collectors = room.get("collectors", [])
-        if old in collectors:
-            collectors.remove(old); collectors.append(new)
-        voice = room.get("voiceAllowed", [])
-        if old in voice:
-            voice.remove(old); voice.append(new)
-    for key in list(geofence_entries.keys()):
-        entry = geofence_entries[key]
-        if entry.get("userId") == old:
-            geofence_entries.pop(key)
-            entry["userId"] = new
-            geofence_entries[f"{new}_{entry['geofenceId']}"] = entry
-    for gf_list in room_geofences.values():
-        for gf in gf_list:
-            if gf.get("createdBy") == old: gf["createdBy"] = new
-    if old in fcm_tokens:
-        fcm_tokens[new] = fcm_tokens.pop(old)
-    if old in kicked_users:
-        kicked_users[new] = kicked_users.pop(old)
-    if old in muted_users:
-        muted_users[new] = muted_users.pop(old)
-    for pin in pins.values():
-        if pin.get("creator") == old: pin["creator"] = new
-    for key in list(walkie_queue.keys()):
-        entry = walkie_queue[key]
-        if entry.get("from") == old: entry["from"] = new
-        parts = key.split("_", 1)
-        if len(parts) == 2:
-            frm, to = parts
-            if frm == old or to == old:
-                walkie_queue.pop(key)
-                new_key = f"{new if frm==old else frm}_{new if to==old else to}"
-                walkie_queue[new_key] = entry
-    for room_queue in room_walkie_queue.values():
-        for entry in room_queue:
-            if entry.get("from") == old: entry["from"] = new
-    for vm in voice_messages.values():
-        if vm.get("fromUser") == old: vm["fromUser"] = new
-        if vm.get("toUser")   == old: vm["toUser"]   = new
-    for rvm in room_voice_messages.values():
-        if rvm.get("fromUser") == old: rvm["fromUser"] = new
-    for req in permission_requests.values():
-        if req.get("requesterUserId") == old: req["requesterUserId"] = new
-    for alert in sos_alerts.values():
-        if alert.get("userId") == old: alert["userId"] = new
-    for broadcast in music_broadcasts.values():
-        if broadcast.get("broadcasterId") == old: broadcast["broadcasterId"] = new
-    if old in visibility_settings:
-        visibility_settings[new] = visibility_settings.pop(old)
-    for vs in visibility_settings.values():
-        allowed = vs.get("allowed", [])
-        if old in allowed:
-            allowed.remove(old); allowed.append(new)
-    # Rota kütüphanesi: creator, participants, likes, suggestions
-    for room_routes in route_library.values():
-        for route in room_routes:
-            if route.get("creator") == old:
-                route["creator"] = new
-            if old in route.get("participants", []):
-                route["participants"].remove(old)
-                route["participants"].append(new)
-            if old in route.get("likes", []):
-                route["likes"].remove(old)
-                route["likes"].append(new)
-            for sug in route.get("suggestions", []):
-                if sug.get("userId") == old:
-                    sug["userId"] = new
-    _flush_route_library()
-    # Transport rolleri
-    for room_roles in transport_roles.values():
-        if old in room_roles:
-            room_roles[new] = room_roles.pop(old)
+    _rename_user(uid, new)
     return {"message": f"✅ İsim değiştirildi: {old} → {new}"}
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -1855,6 +5176,7 @@ def change_username(data: ChangeUsernameModel):
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/geofence/save")
+@_room_scoped(_room_from_body, writes=("geofences", "geofence_entries"))
 def geofence_save(data: GeofenceSaveModel):
     room = rooms.get(data.roomName)
     if not room:
@@ -1868,30 +5190,34 @@ def geofence_save(data: GeofenceSaveModel):
         "radius": gf["radius"], "createdBy": data.adminId,
         "createdAt": gf.get("createdAt", now),
     } for gf in data.geofences]
-    room_geofences[data.roomName] = saved
+    st = room_state(data.roomName)
+    kept = {gf["id"] for gf in saved}
+    for gid in [g for g in st.fence_occupancy.by_fence if g not in kept]:
+        st.fence_occupancy.drop_fence(gid)
+    st.geofences = saved
     return {"message": f"✅ {len(saved)} geofence kaydedildi"}
 
 @app.get("/geofence/get/{room_name}")
+@_room_scoped()
 def geofence_get(room_name: str):
-    gfs = room_geofences.get(room_name, [])
-    result = []
-    for gf in gfs:
-        entries = [v for k, v in geofence_entries.items()
-                   if k.endswith(f"_{gf['id']}") and v.get("roomName") == room_name]
-        result.append({**gf, "entries": entries})
-    return {"geofences": result}
+    st = _peek_room(room_name)
+    if st is None:
+        return {"geofences": []}
+    occupancy = st.fence_occupancy
+    return {"geofences": [{**gf, "entries": occupancy.occupants(gf["id"])} for gf in st.geofences]}
 
 @app.post("/geofence/entry")
+@_room_scoped(_room_from_body, writes=("geofence_entries",))
 def geofence_entry(data: GeofenceEntryModel):
-    key = f"{data.userId}_{data.geofenceId}"
-    now = get_local_time()
+    st = room_state(data.roomName)
     if data.inside:
-        geofence_entries[key] = {
+        # Tekrarlanan "içerideyim" bildirimi ilk giriş zamanını ezmez
+        st.fence_occupancy.enter(data.userId, data.geofenceId, {
             "userId": data.userId, "geofenceId": data.geofenceId,
-            "entryTime": now, "roomName": data.roomName,
-        }
+            "entryTime": get_local_time(), "roomName": data.roomName,
+        })
     else:
-        geofence_entries.pop(key, None)
+        st.fence_occupancy.leave(data.userId, data.geofenceId)
     return {"ok": True}
 
 @app.post("/geofence/personal/save")
@@ -1910,23 +5236,51 @@ def personal_geofence_save(data: dict):
         "threshold":  int(gf.get("threshold", 0)),
         "createdAt":  gf.get("createdAt", now),
     } for gf in geofences]
+    kept = {gf["id"] for gf in saved}
+    for gid in [g for g in _personal_fence_occupancy.by_user.get(user_id, ()) if g not in kept]:
+        _personal_fence_occupancy.forget(user_id, gid)
     user_geofences[user_id] = saved
+    _share("user_geofences", user_id)
+    _mark_critical_dirty("user_geofences")
     return {"message": f"✅ {len(saved)} kişisel geofence kaydedildi"}
 
+def _personal_fence_status(user_id: str, gf: dict) -> dict:
+    """Kişisel bölgeye bugünkü kalış süresi ve kota (threshold, dakika) durumu."""
+    dwell = _personal_fence_occupancy.dwell_seconds(user_id, gf["id"])
+    threshold = gf.get("threshold", 0)
+    return {**gf,
+            "inside": _personal_fence_occupancy.is_inside(user_id, gf["id"]),
+            "dwellMinutes": int(dwell // 60),
+            "overThreshold": bool(threshold) and dwell >= threshold * 60}
+
 @app.get("/geofence/personal/get/{user_id}")
 def personal_geofence_get(user_id: str, requester: str = ""):
-    if requester != user_id and not any(
-        s["userId"] == requester and datetime.now(DEFAULT_TIMEZONE) < s["expiresAt"]
-        for s in _super_admin_sessions.values()
-    ):
+    if requester != user_id and not has_admin_session(requester):
         raise HTTPException(403, "Yetkisiz")
-    return {"geofences": user_geofences.get(user_id, [])}
+    return {"geofences": [_personal_fence_status(user_id, gf) for gf in user_geofences.get(user_id, [])]}
+
+@app.post("/geofence/personal/entry")
+def personal_geofence_entry(data: dict):
+    user_id = data.get("userId", ""); geofence_id = data.get("geofenceId", "")
+    gf = next((g for g in user_geofences.get(user_id, []) if g["id"] == geofence_id), None)
+    if gf is None:
+        raise HTTPException(404, "Geofence bulunamadı")
+    if data.get("inside"):
+        _personal_fence_occupancy.enter(user_id, geofence_id, {
+            "userId": user_id, "geofenceId": geofence_id, "entryTime": get_local_time(),
+        })
+    else:
+        _personal_fence_occupancy.leave(user_id, geofence_id)
+    return _personal_fence_status(user_id, gf)
 
 @app.delete("/geofence/personal/delete/{user_id}/{geofence_id}")
 def personal_geofence_delete(user_id: str, geofence_id: str, requester: str = ""):
     if requester != user_id:
         raise HTTPException(403, "Sadece sahibi silebilir")
     user_geofences[user_id] = [g for g in user_geofences.get(user_id, []) if g["id"] != geofence_id]
+    _share("user_geofences", user_id)
+    _mark_critical_dirty("user_geofences")
+    _personal_fence_occupancy.forget(user_id, geofence_id)
     return {"message": "✅ Silindi"}
 
 @app.post("/geofence/personal/rename")
@@ -1938,6 +5292,8 @@ def personal_geofence_rename(data: dict):
     for gf in user_geofences.get(user_id, []):
         if gf["id"] == geofence_id:
             gf["name"] = new_name
+            _share("user_geofences", user_id)
+            _mark_critical_dirty("user_geofences")
             return {"message": "✅ İsim güncellendi"}
     raise HTTPException(404, "Geofence bulunamadı")
 
@@ -1948,31 +5304,35 @@ def personal_geofence_threshold(data: dict):
     for gf in user_geofences.get(user_id, []):
         if gf["id"] == geofence_id:
             gf["threshold"] = threshold
+            _share("user_geofences", user_id)
+            _mark_critical_dirty("user_geofences")
             return {"message": "✅ Kota güncellendi"}
     raise HTTPException(404, "Geofence bulunamadı")
 
 @app.post("/geofence/rename")
+@_room_scoped(_room_from_body, writes=("geofences",))
 def geofence_rename(data: GeofenceRenameModel):
     room = rooms.get(data.roomName)
     if not room:
         raise HTTPException(status_code=404, detail="Oda bulunamadı")
     if room.get("createdBy") != data.adminId and not is_super_admin(data.adminId):
         raise HTTPException(status_code=403, detail="Sadece oda admini veya süper admin yeniden adlandırabilir")
-    for gf in room_geofences.get(data.roomName, []):
+    st = _peek_room(data.roomName)
+    for gf in (st.geofences if st else []):
         if gf["id"] == data.geofenceId:
             gf["name"] = data.newName
             return {"message": "✅ İsim güncellendi"}
     raise HTTPException(status_code=404, detail="Geofence bulunamadı")
 
 @app.delete("/geofence/delete/{room_name}/{geofence_id}")
+@_room_scoped(writes=("geofences", "geofence_entries"))
 def geofence_delete(room_name: str, geofence_id: str, admin_id: str):
     room = rooms.get(room_name)
     if not room or (room.get("createdBy") != admin_id and not is_super_admin(admin_id)):
         raise HTTPException(status_code=403, detail="Yetkisiz")
-    room_geofences[room_name] = [g for g in room_geofences.get(room_name, []) if g["id"] != geofence_id]
-    for k in list(geofence_entries.keys()):
-        if k.endswith(f"_{geofence_id}"):
-            del geofence_entries[k]
+    st = room_state(room_name)
+    st.geofences = [g for g in st.geofences if g["id"] != geofence_id]
+    st.fence_occupancy.drop_fence(geofence_id)
     return {"message": "✅ Silindi"}
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -1980,32 +5340,43 @@ def geofence_delete(room_name: str, geofence_id: str, admin_id: str):
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/share_route")
+@_room_scoped(_room_from_body, writes=("shared_route",))
 def share_route(data: ShareRouteModel):
     room = rooms.get(data.roomName)
     if not room:
         raise HTTPException(status_code=404, detail="Oda bulunamadı")
-    shared_routes[data.roomName] = {
+    room_state(data.roomName).shared_route = {
         "sharedBy": data.sharedBy, "waypoints": data.waypoints,
         "active": True, "sharedAt": get_local_time(),
     }
     return {"message": "✅ Rota paylaşıldı"}
 
 @app.get("/get_shared_route/{room_name}")
-def get_shared_route(room_name: str):
-    route = shared_routes.get(room_name)
+@_room_scoped()
+def get_shared_route(room_name: str, encoding: str = "json"):
+    st = _peek_room(room_name)
+    route = st.shared_route if st else None
     if not route or not route.get("active"):
         return {"active": False}
-    return {"active": True, **route}
+    return {"active": True, **_route_payload(route, encoding)}
+
+def _route_payload(route: dict, encoding: str) -> dict:
+    """encoding=polyline ve waypoint'ler salt koordinatsa polyline metni döner."""
+    encoded = _encode_waypoints(route.get("waypoints")) if encoding == "polyline" else None
+    if encoded is None:
+        return route
+    return {**route, "waypoints": encoded, "waypointsEncoding": "polyline"}
 
 @app.delete("/clear_shared_route/{room_name}")
+@_room_scoped(writes=("shared_route",))
 def clear_shared_route(room_name: str, admin_id: str):
-    route = shared_routes.get(room_name)
-    if not route:
+    st = _peek_room(room_name)
+    if not st or not st.shared_route:
         return {"message": "Rota zaten yok"}
     room = rooms.get(room_name)
     if room and room.get("createdBy") != admin_id:
         raise HTTPException(status_code=403, detail="Sadece admin silebilir")
-    shared_routes[room_name] = {"active": False}
+    st.shared_route = {"active": False}
     return {"message": "✅ Rota temizlendi"}
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -2013,6 +5384,7 @@ def clear_shared_route(room_name: str, admin_id: str):
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/route_library")
+@_user_fields("creator")
 def add_route_library(data: RouteLibraryModel):
     if data.roomName not in route_library:
         route_library[data.roomName] = []
@@ -2039,10 +5411,12 @@ def add_route_library(data: RouteLibraryModel):
     return {"id": route_id, "message": "✅ Rota kütüphaneye eklendi"}
 
 @app.get("/route_library/{room_name}")
-def get_route_library(room_name: str):
-    return {"routes": route_library.get(room_name, [])}
+@_user_fields("creator")
+def get_route_library(room_name: str, encoding: str = "json"):
+    return {"routes": [_route_payload(r, encoding) for r in route_library.get(room_name, [])]}
 
 @app.post("/route_library/{room_name}/{route_id}/join")
+@_user_fields("creator")
 def join_route_organization(room_name: str, route_id: str, user_id: str):
     lib = route_library.get(room_name, [])
     route = next((r for r in lib if r["id"] == route_id), None)
@@ -2140,14 +5514,13 @@ def add_route_suggestion(room_name: str, route_id: str, data: dict):
     if creator and creator != user_id:
         route_name = route.get("name", "Rota")
         key = get_conv_key("sistem", creator)
-        if key not in messages:
-            messages[key] = []
-        messages[key].append({
+        msg = {
             "id": str(uuid.uuid4())[:8],
             "from": "sistem", "to": creator,
-            "message": f"💡 {user_id}, \"{route_name}\" organizasyonuna öneri ekledi: {text[:80]}",
+            "message": f"💡 {display_name(user_id)}, \"{route_name}\" organizasyonuna öneri ekledi: {text[:80]}",
             "timestamp": get_local_time(), "read": False,
-        })
+        }
+        _append_direct_message(key, msg)
     return {"message": "✅ Öneri eklendi", "suggestions": suggestions}
 
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -2221,19 +5594,18 @@ def kick_user(room_name: str, target_user: str, admin_id: str,
         raise HTTPException(status_code=403, detail="Sadece oda admini veya süper admin atabilir")
     if target_user == admin_id:
         raise HTTPException(status_code=400, detail="Kendinizi atamazsınız")
-    target_is_sadmin = any(
-        s["userId"] == target_user and datetime.now(DEFAULT_TIMEZONE) < s["expiresAt"]
-        for s in _super_admin_sessions.values()
-    )
-    if target_is_sadmin and not is_sadmin:
+    if has_admin_session(target_user) and not is_sadmin:
         raise HTTPException(status_code=403, detail="Süper admini atamazsınız")
     if room.get("createdBy") == target_user and not is_sadmin:
         raise HTTPException(status_code=403, detail="Oda kurucusunu atamazsınız")
     now = get_local_time()
     if target_user in locations and locations[target_user].get("roomName") == room_name:
         locations[target_user]["roomName"] = "Genel"
+        _share("locations", target_user)
+        _place_location(target_user)
     kicked_users[target_user] = {"roomName": room_name, "kickedAt": now, "kickedBy": admin_id}
-    return {"message": f"✅ {target_user} odadan atıldı"}
+    _share("kicked_users", target_user)
+    return {"message": f"✅ {display_name(target_user)} odadan atıldı"}
 
 @app.post("/super_admin_ban")
 def super_admin_ban(data: dict):
@@ -2248,13 +5620,18 @@ def super_admin_ban(data: dict):
     now = get_local_time()
     target_device = locations.get(target, {}).get("deviceId", "")
     banned_users[target]  = {"bannedAt": now, "bannedBy": admin_id, "reason": reason, "deviceId": target_device}
+    _share("banned_users", target)
     if target_device:
         banned_devices[target_device] = {"bannedAt": now, "bannedBy": admin_id, "reason": reason}
+        _share("banned_devices", target_device)
     if target in locations:
         locations[target]["roomName"] = "Genel"
-    kicked_users[target] = {"roomName": "Genel", "kickedAt": now, "kickedBy": f"⛔ BAN: {admin_id}"}
+        _share("locations", target)
+        _place_location(target)
+    kicked_users[target] = {"roomName": "Genel", "kickedAt": now, "kickedBy": f"⛔ BAN: {display_name(admin_id)}"}
+    _share("kicked_users", target)
     _critical_save_pending = True
-    return {"message": f"✅ {target} banlandı"}
+    return {"message": f"✅ {display_name(target)} banlandı"}
 
 @app.post("/super_admin_unban")
 def super_admin_unban(data: dict):
@@ -2265,9 +5642,12 @@ def super_admin_unban(data: dict):
     device = banned_users.get(target, {}).get("deviceId", "")
     global _critical_save_pending
     banned_users.pop(target, None)
-    if device: banned_devices.pop(device, None)
+    _share("banned_users", target)
+    if device:
+        banned_devices.pop(device, None)
+        _share("banned_devices", device)
     _critical_save_pending = True
-    return {"message": f"✅ {target} banı kaldırıldı"}
+    return {"message": f"✅ {display_name(target)} banı kaldırıldı"}
 
 @app.post("/super_admin_mute")
 def super_admin_mute(data: dict):
@@ -2280,11 +5660,14 @@ def super_admin_mute(data: dict):
     now = get_local_time()
     global _critical_save_pending
     muted_users[target] = {"mutedAt": now, "mutedBy": admin_id, "reason": reason}
-    for room in rooms.values():
+    _share("muted_users", target)
+    for room_name, room in rooms.items():
         va = room.get("voiceAllowed", [])
-        if target in va: va.remove(target)
+        if target in va:
+            va.remove(target)
+            _share("rooms", room_name)
     _critical_save_pending = True
-    return {"message": f"🔇 {target} susturuldu"}
+    return {"message": f"🔇 {display_name(target)} susturuldu"}
 
 @app.post("/super_admin_unmute")
 def super_admin_unmute(data: dict):
@@ -2294,8 +5677,9 @@ def super_admin_unmute(data: dict):
         raise HTTPException(403, "Yetkisiz")
     global _critical_save_pending
     muted_users.pop(target, None)
+    _share("muted_users", target)
     _critical_save_pending = True
-    return {"message": f"🔊 {target} susturması kaldırıldı"}
+    return {"message": f"🔊 {display_name(target)} susturması kaldırıldı"}
 
 @app.post("/super_admin_kick")
 def super_admin_kick(data: dict):
@@ -2307,11 +5691,14 @@ def super_admin_kick(data: dict):
     now = get_local_time()
     room = locations.get(target, {}).get("roomName", "Genel")
     if room == "Genel":
-        raise HTTPException(400, f"{target} zaten Genel odada")
+        raise HTTPException(400, f"{display_name(target)} zaten Genel odada")
     if target in locations:
         locations[target]["roomName"] = "Genel"
-    kicked_users[target] = {"roomName": room, "kickedAt": now, "kickedBy": f"⚡ {admin_id}"}
-    return {"message": f"🚪 {target} odadan atıldı ({room})"}
+        _share("locations", target)
+        _place_location(target)
+    kicked_users[target] = {"roomName": room, "kickedAt": now, "kickedBy": f"⚡ {display_name(admin_id)}"}
+    _share("kicked_users", target)
+    return {"message": f"🚪 {display_name(target)} odadan atıldı ({room})"}
 
 @app.get("/check_muted/{user_id}")
 def check_muted(user_id: str):
@@ -2329,6 +5716,7 @@ def check_kicked(user_id: str):
     if not kick:
         return {"kicked": False}
     del kicked_users[user_id]
+    _share("kicked_users", user_id)
     is_ban = "BAN" in str(kick.get("kickedBy", ""))
     return {"kicked": True, "isBan": is_ban,
             "roomName": kick["roomName"], "kickedBy": kick["kickedBy"]}
@@ -2341,16 +5729,33 @@ def check_kicked(user_id: str):
 def remove_user(user_id: str):
     if user_id in locations:
         del locations[user_id]
-    return {"message": f"✅ {user_id} silindi"}
+        _share("locations", user_id)
+        _place_location(user_id)
+    return {"message": f"✅ {display_name(user_id)} silindi"}
 
 @app.delete("/clear")
 def clear_all():
     global _save_pending
-    locations.clear(); location_history.clear(); pins.clear()
-    scores.clear(); pin_collection_history.clear(); messages.clear()
-    room_messages.clear(); walkie_queue.clear(); room_walkie_queue.clear()
-    voice_messages.clear(); room_voice_messages.clear()
-    sos_alerts.clear(); music_broadcasts.clear(); permission_requests.clear()
+    locations.clear(); location_history.clear(); messages.clear(); _reindex_locations()
+    _gps_filters.clear(); trip_stats.clear(); _heat_drop()
+    unread_counts.clear(); _read_cursors.clear(); _user_convs.clear()
+    walkie_queue.clear(); voice_messages.clear(); room_voice_messages.clear()
+    permission_requests.clear(); _reindex_permission_requests()
+    # Oda durumlarından yalnızca eskiden silinenleri temizle (geofence/durak kalır)
+    for st in list(_room_states.values()):
+        with st.lock:
+            st.pins.clear(); st.scores.clear(); st.collection_history.clear()
+            st.rebuild_ranking(); st.rank_events = []
+            st.messages = []; st.walkie_queue = []
+            st.sos = None; st.music = None
+    _archive_executor.submit(_drop_archive)
+    for name in ("locations", "location_history", "messages", "room_messages",
+                 "voice_messages", "room_voice_messages", "walkie_queue",
+                 "permission_requests", "room_pins", "room_scores",
+                 "room_collection_history", "room_rank_events", "room_walkie_queue",
+                 "room_sos"):
+        _share_collection(name)
+    _mark_critical_dirty("room_states", "permission_requests")
     _save_pending = True
     return {"message": "✅ Tüm veriler silindi"}
 
@@ -2359,6 +5764,7 @@ def clear_all():
 # ═══════════════════════════════════════════════════════════════════════════════
 
 @app.post("/set_transport_role")
+@_room_scoped(_room_from_body, writes=("transport_roles", "transport_visits"))
 def set_transport_role(data: dict):
     room = data.get("roomName", "Genel")
     uid = data.get("userId", "")
@@ -2366,26 +5772,43 @@ def set_transport_role(data: dict):
     vehicle = data.get("vehicleName", "")
     if not uid:
         raise HTTPException(400, "userId gerekli")
-    if room not in transport_roles:
-        transport_roles[room] = {}
+    st = room_state(room)
     if role:
-        transport_roles[room][uid] = {
+        st.transport_roles[uid] = {
             "role": role,
             "vehicleName": vehicle,
             "joinedAt": get_local_time(),
         }
     else:
-        transport_roles[room].pop(uid, None)
+        st.transport_roles.pop(uid, None)
+        st.transport_visits.pop(uid, None)
+        st.transport_etas.pop(uid, None)
     return {"ok": True}
 
 @app.get("/get_transport_status/{room_name}")
+@_room_scoped()
 def get_transport_status(room_name: str):
-    roles = transport_roles.get(room_name, {})
+    """Sürücü/yolcular bulundukları durakla (atStop); sürücülerde sıradaki
+    durakların tahmini varışı (etas) da döner. Anlık değişiklikler için
+    /ws/transport/{room_name}."""
+    return _transport_status(room_name)
+
+def _transport_status(room_name: str) -> dict:
+    st = _peek_room(room_name)
+    if st is None:
+        return {"drivers": [], "passengers": [], "managers": []}
+    with st.lock:
+        return _transport_status_locked(st)
+
+def _transport_status_locked(st: RoomState) -> dict:
+    roles = st.transport_roles
+    now_ts = time.time()
     drivers, passengers, managers = [], [], []
     for uid, info in roles.items():
         loc = locations.get(uid, {})
         if not is_user_online(loc.get("lastSeen", "")):
             continue
+        visit = st.transport_visits.get(uid, {})
         entry = {
             "userId": uid,
             "role": info["role"],
@@ -2394,8 +5817,10 @@ def get_transport_status(room_name: str):
             "lat": loc.get("lat", 0),
             "lng": loc.get("lng", 0),
             "speed": loc.get("speed", 0),
+            "atStop": visit.get("stopId"),
         }
         if info["role"] == "driver":
+            entry["etas"] = _transport_etas(st, visit, now_ts)
             drivers.append(entry)
         elif info["role"] == "passenger":
             passengers.append(entry)
@@ -2404,14 +5829,16 @@ def get_transport_status(room_name: str):
     return {"drivers": drivers, "passengers": passengers, "managers": managers}
 
 @app.post("/transport_broadcast")
+@_room_scoped(_room_from_body, writes=("transport_broadcast",))
 def transport_broadcast_msg(data: dict):
     room = data.get("roomName", "Genel")
     uid = data.get("fromUser", "")
     msg = data.get("message", "")
     if not msg:
         raise HTTPException(400, "Mesaj boş olamaz")
-    vehicle = transport_roles.get(room, {}).get(uid, {}).get("vehicleName", "")
-    transport_broadcasts[room] = {
+    st = room_state(room)
+    vehicle = st.transport_roles.get(uid, {}).get("vehicleName", "")
+    st.transport_broadcast = {
         "id": str(uuid.uuid4())[:8],
         "fromUser": uid,
         "vehicleName": vehicle,
@@ -2421,26 +5848,30 @@ def transport_broadcast_msg(data: dict):
     return {"ok": True}
 
 @app.get("/get_transport_broadcast/{room_name}")
+@_room_scoped()
 def get_transport_broadcast(room_name: str):
-    return transport_broadcasts.get(room_name, {})
+    st = _peek_room(room_name)
+    return st.transport_broadcast if st else {}
 
 # ─── Transport Durak (Stop) Yönetimi ─────────────────────────────────────────
 
+TRANSPORT_STOP_MAX_RADIUS_M = 1000
+
 class TransportStopModel(BaseModel):
     roomName: str
     id: str
     name: str
     lat: float
     lng: float
-    radius: float = 80.0
+    radius: float = Field(80.0, gt=0, le=TRANSPORT_STOP_MAX_RADIUS_M)
     addedBy: str = ""
     addedByRole: str = ""
 
 @app.post("/transport_stop")
+@_room_scoped(_room_from_body, writes=("transport_stops",))
 def add_transport_stop(data: TransportStopModel):
-    if data.roomName not in transport_stops:
-        transport_stops[data.roomName] = {}
-    transport_stops[data.roomName][data.id] = {
+    st = room_state(data.roomName)
+    stop = st.transport_stops[data.id] = {
         "id": data.id, "name": data.name,
         "lat": data.lat, "lng": data.lng,
         "radius": data.radius,
@@ -2448,22 +5879,28 @@ def add_transport_stop(data: TransportStopModel):
         "addedByRole": data.addedByRole,
         "createdAt": get_local_time(),
     }
+    st.stop_index.add(stop)
     return {"ok": True}
 
 @app.get("/transport_stops/{room_name}")
+@_room_scoped()
 def get_transport_stops(room_name: str):
-    return {"stops": list(transport_stops.get(room_name, {}).values())}
+    st = _peek_room(room_name)
+    return {"stops": list(st.transport_stops.values()) if st else []}
 
 @app.delete("/transport_stop/{room_name}/{stop_id}")
+@_room_scoped(writes=("transport_stops",))
 def delete_transport_stop(room_name: str, stop_id: str):
-    transport_stops.get(room_name, {}).pop(stop_id, None)
+    st = _peek_room(room_name)
+    if st:
+        st.transport_stops.pop(stop_id, None)
+        st.stop_index.remove(stop_id)
     return {"ok": True}
 
 @app.post("/transport_arrival")
+@_room_scoped(_room_from_body, writes=("transport_arrivals",))
 def report_transport_arrival(data: dict):
-    room = data.get("roomName", "Genel")
-    if room not in transport_arrivals:
-        transport_arrivals[room] = []
+    st = room_state(data.get("roomName", "Genel"))
     entry = {
         "id": str(uuid.uuid4())[:8],
         "stopId": data.get("stopId", ""),
@@ -2474,11 +5911,226 @@ def report_transport_arrival(data: dict):
         "boarding": bool(data.get("boarding", False)),
     }
     # Keep last 50 arrivals per room
-    transport_arrivals[room].append(entry)
-    if len(transport_arrivals[room]) > 50:
-        transport_arrivals[room] = transport_arrivals[room][-50:]
+    st.transport_arrivals.append(entry)
+    if len(st.transport_arrivals) > MAX_TRANSPORT_ARRIVALS:
+        st.transport_arrivals = st.transport_arrivals[-MAX_TRANSPORT_ARRIVALS:]
     return {"ok": True}
 
 @app.get("/transport_arrivals/{room_name}")
+@_room_scoped()
 def get_transport_arrivals(room_name: str):
-    return {"arrivals": transport_arrivals.get(room_name, [])}
+    st = _peek_room(room_name)
+    return {"arrivals": st.transport_arrivals if st else []}
+
+# ─── Sunucu tarafı durak algılama ve ETA ─────────────────────────────────────
+# update_location, rolü driver/passenger olan kullanıcının süzülmüş konumunu
+# odanın StopIndex'inde arar: yarıçapa girince varış (transport_arrivals'a
+# "auto" kaydı), yarıçapın STOP_EXIT_FACTOR katından çıkınca ayrılış olur.
+# Sürücülerin durak→durak yol süreleri ve durakta bekleme süreleri hareketli
+# ortalamayla öğrenilir; sıradaki duraklar en sık izlenen geçişlerden çıkarılır.
+# Olaylar /ws/transport/{oda} abonelerine veriyolu üzerinden gider.
+TRANSPORT_RIDER_ROLES      = ("driver", "passenger")
+STOP_EXIT_FACTOR           = 1.25   # yarıçap sınırında gidip gelmeyi önler
+TRANSPORT_TIMING_ALPHA     = 0.3    # yeni gözlemin ortalamadaki ağırlığı
+TRANSPORT_MAX_SEGMENT_SECS = 2 * 3600   # daha uzunu (mola, tur sonu) öğrenilmez
+TRANSPORT_ETA_STOPS        = 3
+TRANSPORT_ETA_PUSH_SECS    = 30     # ETA bu kadar kayınca yeniden gönderilir
+
+def _roll_timing(stats: dict, key: str, secs: float):
+    cur = stats.get(key)
+    if cur is None:
+        stats[key] = {"avg": secs, "n": 1}
+    else:
+        cur["avg"] += TRANSPORT_TIMING_ALPHA * (secs - cur["avg"])
+        cur["n"] += 1
+
+def _track_transport(st: RoomState, uid: str, lat: float, lng: float,
+                     character: str, now: str) -> list:
+    """(Oda kilidi altında) durak giriş/çıkışını işle; yayınlanacak olayları döndür."""
+    role = st.transport_roles.get(uid, {}).get("role")
+    if role not in TRANSPORT_RIDER_ROLES:
+        return []
+    now_ts = time.time()
+    visit = st.transport_visits.setdefault(uid, {"stopId": None})
+    events = []
+    cur_id = visit["stopId"]
+    cur = st.transport_stops.get(cur_id) if cur_id else None
+    if cur is None or haversine(lat, lng, cur["lat"], cur["lng"]) > cur["radius"] * STOP_EXIT_FACTOR:
+        if cur_id:
+            dwell = now_ts - visit["since"]
+            if role == "driver" and cur is not None and dwell <= TRANSPORT_MAX_SEGMENT_SECS:
+                _roll_timing(st.transport_dwell, cur_id, dwell)
+                _mark_critical_dirty("room_states")
+            visit.update(stopId=None, lastStopId=cur_id, departedAt=now_ts)
+            events.append({"type": "departure", "stopId": cur_id,
+                           "stopName": cur["name"] if cur else "",
+                           "userId": uid, "role": role, "timestamp": now})
+        stop = st.stop_index.nearest(lat, lng, st.transport_stops)
+        if stop is not None:
+            last = visit.get("lastStopId")
+            if role == "driver" and last and last != stop["id"]:
+                secs = now_ts - visit["departedAt"]
+                if secs <= TRANSPORT_MAX_SEGMENT_SECS:
+                    _roll_timing(st.transport_segments.setdefault(last, {}), stop["id"], secs)
+                    _mark_critical_dirty("room_states")
+            visit.update(stopId=stop["id"], since=now_ts)
+            entry = {
+                "id": str(uuid.uuid4())[:8],
+                "stopId": stop["id"],
+                "stopName": stop["name"],
+                "userId": uid,
+                "character": character,
+                "arrivalTime": now,
+                "boarding": False,
+                "auto": True,
+            }
+            st.transport_arrivals.append(entry)
+            if len(st.transport_arrivals) > MAX_TRANSPORT_ARRIVALS:
+                st.transport_arrivals = st.transport_arrivals[-MAX_TRANSPORT_ARRIVALS:]
+            events.append({"type": "arrival", "role": role, **entry})
+    if role == "driver":
+        etas = _transport_etas(st, visit, now_ts)
+        pushed = st.transport_etas.get(uid)
+        current = [(e["stopId"], now_ts + e["etaSeconds"]) for e in etas]
+        if (pushed is None or [s for s, _ in pushed] != [s for s, _ in current]
+                or any(abs(a[1] - b[1]) >= TRANSPORT_ETA_PUSH_SECS
+                       for a, b in zip(pushed, current))):
+            st.transport_etas[uid] = current
+            if etas or pushed:
+                events.append({"type": "eta", "userId": uid,
+                               "vehicleName": st.transport_roles[uid].get("vehicleName", ""),
+                               "atStop": visit["stopId"], "etas": etas})
+    return events
+
+def _transport_etas(st: RoomState, visit: dict, now_ts: float) -> list:
+    """Sıradaki TRANSPORT_ETA_STOPS durak için tahmini varış. Durakta bekliyorsa
+    kalan ortalama bekleme, yoldaysa ayrılıştan bu yana geçen süre hesaba katılır."""
+    if visit.get("stopId"):
+        origin = visit["stopId"]
+        dwell = st.transport_dwell.get(origin)
+        t = now_ts + max(0.0, (dwell["avg"] if dwell else 0.0) - (now_ts - visit["since"]))
+    elif visit.get("lastStopId"):
+        origin, t = visit["lastStopId"], visit["departedAt"]
+    else:
+        return []
+    result, seen, cur = [], {origin}, origin
+    while len(result) < TRANSPORT_ETA_STOPS:
+        options = [(seg["n"], nxt) for nxt, seg in st.transport_segments.get(cur, {}).items()
+                   if nxt not in seen and nxt in st.transport_stops]
+        if not options:
+            break
+        nxt = max(options)[1]
+        if cur != origin:
+            dwell = st.transport_dwell.get(cur)
+            t += dwell["avg"] if dwell else 0.0
+        # Gecikmedeki araç "her an" varabilir; tahmin şimdiden geriye düşmez
+        t = max(t + st.transport_segments[cur][nxt]["avg"], now_ts)
+        result.append({"stopId": nxt, "stopName": st.transport_stops[nxt]["name"],
+                       "etaSeconds": int(t - now_ts),
+                       "eta": datetime.fromtimestamp(t, DEFAULT_TIMEZONE).strftime(_TS_FORMAT)})
+        seen.add(nxt)
+        cur = nxt
+    return result
+
+@app.websocket("/ws/transport/{room_name}")
+async def ws_transport(ws: WebSocket, room_name: str):
+    """get_transport_status aboneliği — bağlanınca {"type":"status", ...}, sonra
+    durak varış/ayrılışları ({"type":"arrival"|"departure"}) ve sürücü ETA
+    değişiklikleri ({"type":"eta"}) anlık gelir."""
+    await ws.accept()
+    _transport_ws[room_name].add(ws)
+    try:
+        await ws.send_json(await _in_state_actor(
+            lambda: _render_user_ids({"type": "status", **_transport_status(room_name)})))
+        while True:
+            await ws.receive_text()   # istemciden mesaj beklenmez; kopmayı algılamak için
+    except WebSocketDisconnect:
+        pass
+    finally:
+        _transport_ws[room_name].discard(ws)
+
+def _stress_rooms(workers: int = 8, seconds: float = 5.0) -> bool:
+    """Eşzamanlılık sınaması: `python server.py stress-rooms`. Aynı odalara konum
+    güncelleme, isim değiştirme, oda silme/açma ile oda uçları (grup mesajı, pin,
+    durak) paralel gönderilirken kayıt bayrakları da ayrı bir thread'den alınır.
+    5xx yanıt ya da son kayıtta diske yazılacak kritik bölümün RAM'den farklı
+    olması (kaybolan bayrak) hata sayılır."""
+    import random
+    from fastapi.testclient import TestClient
+    client = TestClient(app)
+    room_names = [f"stres{i}" for i in range(4)]
+    deadline = time.monotonic() + seconds
+    failures, done = [], defaultdict(int)
+
+    def worker(n: int):
+        rnd = random.Random(n)
+        name = f"stres_kullanici{n}"
+        while time.monotonic() < deadline:
+            room = rnd.choice(room_names)
+            op = rnd.choice(("update_location", "change_username", "delete_room",
+                             "create_room", "send_room_message", "create_pin", "transport_stop"))
+            if op == "update_location":
+                r = client.post("/update_location", json={
+                    "userId": name, "deviceId": f"cihaz{n}", "roomName": room,
+                    "lat": 41.0 + rnd.uniform(-0.01, 0.01), "lng": 29.0 + rnd.uniform(-0.01, 0.01)})
+            elif op == "change_username":
+                new = f"stres_kullanici{n}_{rnd.randrange(3)}"
+                r = client.post("/change_username", json={
+                    "deviceId": f"cihaz{n}", "oldName": name, "newName": new})
+                if r.status_code == 200:
+                    name = new
+            elif op == "delete_room":
+                r = client.delete(f"/delete_room/{room}", params={"admin_id": "stres"})
+            elif op == "create_room":
+                r = client.post("/create_room", json={
+                    "roomName": room, "password": "stres", "createdBy": "stres"})
+            elif op == "send_room_message":
+                r = client.post("/send_room_message", json={
+                    "roomName": room, "fromUser": name, "message": "stres"})
+            elif op == "create_pin":
+                r = client.post("/create_pin", json={
+                    "roomName": room, "creator": name, "lat": 41.0, "lng": 29.0})
+            else:
+                r = client.post("/transport_stop", json={
+                    "roomName": room, "id": f"durak{n}", "name": "Durak",
+                    "lat": 41.0, "lng": 29.0, "addedBy": name})
+            done[op] += 1
+            if r.status_code >= 500:
+                failures.append(f"{op}: {r.status_code} {r.text[:200]}")
+
+    def snapshots():
+        while time.monotonic() < deadline:
+            _state_executor.submit(_take_pending_snapshots).result()
+            time.sleep(0.01)
+
+    _state_executor.submit(_critical_sections).result()   # bölüm önbelleğini doldur
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(workers)]
+    threads.append(threading.Thread(target=snapshots))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    def check():
+        _take_pending_snapshots()
+        return [name for name, section in _CRITICAL_SECTIONS.items()
+                if _critical_section_cache.get(name) != _dump_section(section())]
+    # _from_room ile sıraya konan son bayraklar bu işten önce çalışır
+    stale = _state_executor.submit(check).result()
+    failures += [f"kayıt bayrağı kayboldu: {name}" for name in stale]
+    print(" | ".join(f"{op}: {n}" for op, n in sorted(done.items())))
+    for line in failures[:20]:
+        print(f"❌ {line}")
+    print("✅ Hata yok" if not failures else f"❌ {len(failures)} hata")
+    return not failures
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["bench-distances"]:
+        _bench_distances()
+    elif sys.argv[1:] == ["bench-snapshots"]:
+        _bench_snapshots()
+    elif sys.argv[1:] == ["bench-gps"]:
+        _bench_gps()
+    elif sys.argv[1:] == ["stress-rooms"]:
+        sys.exit(0 if _stress_rooms() else 1)